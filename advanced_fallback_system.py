@@ -5,13 +5,17 @@
 
 import json
 import re
+import string
 import random
 import logging
 from datetime import datetime, timedelta
 from typing import Dict, List, Tuple, Optional, Union, Any
-from dataclasses import dataclass, field
+from dataclasses import asdict, dataclass, field, fields
 from enum import Enum
 
+from metrics import FALLBACK_ACTIVATIONS
+from session_store import MemorySessionStore, SessionStore
+
 # Setup logging
 logger = logging.getLogger(__name__)
 
@@ -101,18 +105,127 @@ class SessionData:
     last_update: str = field(default_factory=lambda: datetime.now().isoformat())
     session_start: str = field(default_factory=lambda: datetime.now().isoformat())
     interaction_count: int = 0
+    
+    def trim(self, max_history: int):
+        """שמירת ההיסטוריה האחרונה בלבד כדי שהסשן לא יגדל ללא גבול"""
+        if max_history <= 0:
+            return
+        self.messages = self.messages[-max_history:]
+        self.identified_intents = self.identified_intents[-max_history:]
+        self.conversation_stages = self.conversation_stages[-max_history:]
+        self.emotional_states = self.emotional_states[-max_history:]
+
+@dataclass
+class FallbackAnswer:
+    """תגובת fallback שחושבה, עם מצב הסשן שיישמר אם תישלח"""
+    response: str
+    intent: str
+    session_id: Optional[str] = None
+    session_data: Optional[SessionData] = None
+
+# תבנית מפורקת מראש: רצף של (טקסט קבוע, שם שדה או None)
+TemplateSegments = Tuple[Tuple[str, Optional[str]], ...]
+
+def compile_template(template: str) -> TemplateSegments:
+    """פירוק תבנית str.format לקטעים, כך שמילוי השדות לא יסרוק שוב את כל הטקסט"""
+    return tuple((literal, field_name) for literal, field_name, _, _ in string.Formatter().parse(template))
+
+@dataclass(frozen=True)
+class ResponseFragments:
+    """
+    גוף תגובה מוכן מראש לשילוב (אתגר, קבוצת גיל, טכניקת CBT).
+
+    All static text (challenge paragraph, CBT card, numbered action steps) is
+    rendered once at startup; only {child_name} / {child_age} are filled in
+    per request.
+    """
+    body: TemplateSegments                 # CBT card + action steps
+    body_with_challenge: TemplateSegments  # age-specific challenge paragraph + body
+
+    def render(self, with_challenge: bool, child_name: str, child_age: Any) -> str:
+        """מילוי שם הילד וגילו בתבנית המוכנה"""
+        values = {'child_name': child_name, 'child_age': str(child_age)}
+        segments = self.body_with_challenge if with_challenge else self.body
+        return "".join([literal + values[field_name] if field_name else literal
+                        for literal, field_name in segments])
+
+class PhraseMatcher:
+    """
+    זיהוי כל הביטויים מתוך רשימה בסריקה אחת של הטקסט.
+
+    All phrases are compiled into one trie-shaped regex. Scanning resumes one
+    character after the start of every hit, so the scan reports, at every
+    position where some phrase starts, the longest phrase starting there (the
+    regex engine skips positions that cannot start a phrase in C). Each phrase
+    is mapped in advance to the labels of every phrase that is a prefix of it,
+    which makes overlapping matches (e.g. "מספיק" inside "מספיק לי") count
+    exactly like independent substring checks.
+    """
+    
+    def __init__(self, phrase_labels: Dict[str, List[Any]]):
+        phrases = [phrase for phrase in phrase_labels if phrase]
+        
+        # labels for the longest match include those of all phrases that prefix it
+        self._labels_by_phrase: Dict[str, frozenset] = {}
+        for phrase in phrases:
+            labels = set()
+            for other in phrases:
+                if phrase.startswith(other):
+                    labels.update(phrase_labels[other])
+            self._labels_by_phrase[phrase] = frozenset(labels)
+        
+        self._pattern = re.compile(self._build_trie_regex(phrases)) if phrases else None
+    
+    @staticmethod
+    def _build_trie_regex(phrases: List[str]) -> str:
+        """בניית regex בצורת trie כך שכל מיקום נבדק במעבר אחד על העץ"""
+        trie: Dict[str, Any] = {}
+        for phrase in phrases:
+            node = trie
+            for char in phrase:
+                node = node.setdefault(char, {})
+            node[""] = {}  # end-of-phrase marker
+        
+        def build(node: Dict[str, Any]) -> str:
+            branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+            if not branches:
+                return ""
+            pattern = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+            if "" in node:
+                pattern = "(?:" + pattern + ")?"
+            return pattern
+        
+        return build(trie)
+    
+    def match(self, text: str) -> set:
+        """כל התוויות של ביטויים שמופיעים בטקסט"""
+        matched = set()
+        if self._pattern is None:
+            return matched
+        labels_by_phrase = self._labels_by_phrase
+        search = self._pattern.search
+        found = search(text)
+        while found is not None:
+            matched.update(labels_by_phrase[found.group()])
+            found = search(text, found.start() + 1)
+        return matched
 
 class AdvancedFallbackSystem:
     """מערכת fallback מתקדמת"""
     
-    def __init__(self):
+    def __init__(self, state_store: Optional[SessionStore] = None, max_history: int = 50):
         """אתחול המערכת"""
-        self.conversation_state: Dict[str, SessionData] = {}
+        # מצב השיחות נשמר באחסון חיצוני (בזיכרון, SQLite או Redis) - ראה session_store.py
+        self.state_store: SessionStore = state_store or MemorySessionStore()
+        self.max_history = max_history
         self.challenge_database: Dict[ChallengeCategory, Dict[str, Any]] = self._build_challenge_database()
         self.cbt_techniques: Dict[CBTTechnique, Dict[str, Any]] = self._build_cbt_techniques()
         self.response_templates: Dict[str, List[str]] = self._build_response_templates()
         self.intent_patterns: Dict[str, Any] = self._build_intent_patterns()
+        self.emotional_indicators: Dict[str, Dict[str, List[str]]] = self._build_emotional_indicators()
         self.conversation_flows: Dict[str, List[ConversationStage]] = self._build_conversation_flows()
+        self.message_matcher: PhraseMatcher = self._build_message_matcher()
+        self.response_fragments: Dict[Tuple[ChallengeCategory, AgeGroup, CBTTechnique], ResponseFragments] = self._build_response_fragments()
         
         logger.info("🚀 מערכת Fallback מתקדמת אותחלה בהצלחה")
     
@@ -463,6 +576,73 @@ class AdvancedFallbackSystem:
             ]
         }
     
+    def _build_emotional_indicators(self) -> Dict[str, Dict[str, List[str]]]:
+        """בניית מחווני מצב רגשי"""
+        return {
+            "stress": {
+                "keywords": ["מתח", "לחץ", "עייף", "מותש", "עמוס", "לא מספיק"],
+                "patterns": [r"אין לי כוח", r"מספיק לי", r"נמאס לי"]
+            },
+            "anger": {
+                "keywords": ["כועס", "זועם", "עצבני", "מתוסכל", "מרגיז"],
+                "patterns": [r"מספיק כבר", r"לא יכול יותר", r"מטריף אותי"]
+            },
+            "sadness": {
+                "keywords": ["עצוב", "מדוכא", "כואב", "קשה", "בוכה"],
+                "patterns": [r"לא יודע מה לעשות", r"מרגיש רע", r"כל כך קשה"]
+            },
+            "anxiety": {
+                "keywords": ["חרד", "דואג", "פחד", "מתרגש", "בהלה"],
+                "patterns": [r"מה יהיה", r"איך אני", r"מה אם"]
+            },
+            "hope": {
+                "keywords": ["מקווה", "רוצה לנסות", "יש אפשרות", "אולי"],
+                "patterns": [r"אם רק", r"בואו ננסה", r"יש לי תקווה"]
+            }
+        }
+    
+    def _build_message_matcher(self) -> PhraseMatcher:
+        """
+        בניית מזהה אחד לכל דפוסי הכוונות והרגשות.
+
+        Intent and emotion patterns are alternations of literal phrases; every
+        phrase is labelled with the id of the pattern/keyword slot it scores
+        for, so one scan of the message yields everything identify_intent()
+        and detect_emotional_state() need.
+        """
+        phrase_labels: Dict[str, List[int]] = {}
+        # slot id -> pattern family (each intent pattern counts once)
+        self._intent_slots: Dict[int, str] = {}
+        # slot id -> (emotion, weight): keyword = 1 point, pattern = 2 points
+        self._emotion_slots: Dict[int, Tuple[str, int]] = {}
+        
+        def add(phrase: str, slot: int):
+            phrase = phrase.lower()
+            if set(phrase) & set(".^$*+?{}[]\\|()"):
+                raise ValueError(f"Matcher phrases must be literal text: {phrase!r}")
+            phrase_labels.setdefault(phrase, []).append(slot)
+        
+        slot = 0
+        for family, patterns in self.intent_patterns.items():
+            for pattern in patterns:
+                self._intent_slots[slot] = family
+                for phrase in pattern.split("|"):
+                    add(phrase, slot)
+                slot += 1
+        
+        for emotion, indicators in self.emotional_indicators.items():
+            for keyword in indicators["keywords"]:
+                self._emotion_slots[slot] = (emotion, 1)
+                add(keyword, slot)
+                slot += 1
+            for pattern in indicators["patterns"]:
+                self._emotion_slots[slot] = (emotion, 2)
+                for phrase in pattern.split("|"):
+                    add(phrase, slot)
+                slot += 1
+        
+        return PhraseMatcher(phrase_labels)
+    
     def _build_conversation_flows(self) -> Dict[str, List[ConversationStage]]:
         """בניית זרימות שיחה"""
         return {
@@ -492,28 +672,33 @@ class AdvancedFallbackSystem:
             ]
         }
     
+    def analyze_message(self, user_input: str) -> Tuple[Tuple[str, float], Tuple[str, float]]:
+        """זיהוי כוונה ומצב רגשי בסריקה אחת של ההודעה"""
+        matched = self.message_matcher.match(user_input.lower())
+        return self._score_intent(matched), self._score_emotional_state(matched)
+    
     def identify_intent(self, user_input: str) -> Tuple[str, float]:
         """זיהוי כוונת המשתמש"""
-        user_input_lower = user_input.lower()
-        
-        # בדיקת דחיפות
-        urgency_score = self._calculate_pattern_score(user_input_lower, self.intent_patterns["urgency"])
-        
-        # זיהוי רגש כללי
-        emotional_score = self._calculate_pattern_score(user_input_lower, self.intent_patterns["emotional_expression"])
-        
-        # זיהוי בקשה לעזרה
-        advice_seeking_score = self._calculate_pattern_score(user_input_lower, self.intent_patterns["seeking_advice"])
+        return self._score_intent(self.message_matcher.match(user_input.lower()))
+    
+    def _score_intent(self, matched: set) -> Tuple[str, float]:
+        """חישוב ציוני הכוונות מתוך הדפוסים שזוהו"""
+        hits: Dict[str, int] = {}
+        intent_slots = self._intent_slots
+        for slot in matched:
+            family = intent_slots.get(slot)
+            if family is not None:
+                hits[family] = hits.get(family, 0) + 1
         
-        # זיהוי התנגדות
-        resistance_score = self._calculate_pattern_score(user_input_lower, self.intent_patterns["resistance"])
+        if not hits:
+            return "general_conversation", 0.5
         
-        # החלטה על כוונה עיקרית
+        # כוונה -> משפחת הדפוסים שלה (הסדר קובע בשוויון ציונים)
         scores = {
-            "urgent_help": urgency_score,
-            "emotional_expression": emotional_score,
-            "seeking_advice": advice_seeking_score,
-            "resistance": resistance_score
+            "urgent_help": self._pattern_ratio(hits, "urgency"),
+            "emotional_expression": self._pattern_ratio(hits, "emotional_expression"),
+            "seeking_advice": self._pattern_ratio(hits, "seeking_advice"),
+            "resistance": self._pattern_ratio(hits, "resistance")
         }
         
         if max(scores.values()) > 0:
@@ -523,28 +708,27 @@ class AdvancedFallbackSystem:
         
         return "general_conversation", 0.5
     
-    def _calculate_pattern_score(self, text: str, patterns: List[str]) -> float:
-        """חישוב ציון התאמה לדפוס"""
-        score = 0
-        for pattern in patterns:
-            if re.search(pattern, text):
-                score += 1
-        return score / len(patterns) if patterns else 0
+    def _pattern_ratio(self, hits: Dict[str, int], family: str) -> float:
+        """חלק הדפוסים במשפחה שזוהו בהודעה"""
+        patterns = self.intent_patterns[family]
+        return hits.get(family, 0) / len(patterns) if patterns else 0
+    
+    # מיפוי טקסט האתגר מהשאלון לקטגוריה
+    CHALLENGE_MAPPING = {
+        "תקשורת וריבים": ChallengeCategory.COMMUNICATION,
+        "קשיים בלימודים": ChallengeCategory.ACADEMICS,
+        "ויסות רגשי והתפרצויות": ChallengeCategory.EMOTIONAL_REGULATION,
+        "זמן מסך והתמכרויות": ChallengeCategory.SCREEN_TIME,
+        "קשיים חברתיים": ChallengeCategory.SOCIAL_ISSUES,
+        "התנהגות מרדנית": ChallengeCategory.BEHAVIORAL_ISSUES,
+        "חרדה ולחץ": ChallengeCategory.ANXIETY_STRESS,
+        "בעיות שינה": ChallengeCategory.SLEEP_ROUTINE,
+        "עצמאות ואחריות": ChallengeCategory.INDEPENDENCE
+    }
     
     def get_challenge_category(self, challenge_text: str) -> ChallengeCategory:
         """מיפוי טקסט לקטגוריית אתגר"""
-        challenge_mapping = {
-            "תקשורת וריבים": ChallengeCategory.COMMUNICATION,
-            "קשיים בלימודים": ChallengeCategory.ACADEMICS,
-            "ויסות רגשי והתפרצויות": ChallengeCategory.EMOTIONAL_REGULATION,
-            "זמן מסך והתמכרויות": ChallengeCategory.SCREEN_TIME,
-            "קשיים חברתיים": ChallengeCategory.SOCIAL_ISSUES,
-            "התנהגות מרדנית": ChallengeCategory.BEHAVIORAL_ISSUES,
-            "חרדה ולחץ": ChallengeCategory.ANXIETY_STRESS,
-            "בעיות שינה": ChallengeCategory.SLEEP_ROUTINE,
-            "עצמאות ואחריות": ChallengeCategory.INDEPENDENCE
-        }
-        return challenge_mapping.get(challenge_text, ChallengeCategory.COMMUNICATION)
+        return self.CHALLENGE_MAPPING.get(challenge_text, ChallengeCategory.COMMUNICATION)
     
     def get_contextual_response(self, 
                                context: ResponseContext, 
@@ -557,12 +741,9 @@ class AdvancedFallbackSystem:
             challenge_category = self.get_challenge_category(context.main_challenge)
             age_group = context.get_age_group()
             
-            # קבלת נתוני האתגר הספציפי
-            challenge_data = self.challenge_database.get(challenge_category, {})
-            age_specific_data = challenge_data.get("age_variations", {}).get(age_group, {})
-            
             # בחירת טכניקת CBT מתאימה
             cbt_technique = self._select_cbt_technique(intent, challenge_category)
+            fragments = self.response_fragments[(challenge_category, age_group, cbt_technique)]
             
             # בניית התגובה לפי השלב בשיחה
             response_parts = []
@@ -573,18 +754,12 @@ class AdvancedFallbackSystem:
             else:
                 response_parts.append(self._get_empathy_response(context, intent))
             
-            # הוספת תוכן ספציפי לפי הכוונה
-            if intent in ["communication", "academics", "screen_time", "behavior"]:
-                response_parts.append(self._get_specific_challenge_response(
-                    challenge_category, age_group, age_specific_data, context
-                ))
-            
-            # הוספת כלי CBT
-            if cbt_technique:
-                response_parts.append(self._get_cbt_response(cbt_technique, context))
-            
-            # הוספת צעדים פרקטיים
-            response_parts.append(self._get_action_steps(challenge_category, age_group, context))
+            # תוכן ספציפי לפי הכוונה, כלי CBT וצעדים פרקטיים - מוכנים מראש, רק השמות מושלמים כאן
+            response_parts.append(fragments.render(
+                intent in self.CHALLENGE_INTENTS,
+                context.child_name,
+                context.child_age
+            ))
             
             # הוספת עידוד וסיכום
             response_parts.append(self._get_encouragement(context))
@@ -595,19 +770,23 @@ class AdvancedFallbackSystem:
             logger.error(f"Error generating contextual response: {e}")
             return self._get_fallback_error_response(context)
     
-    def _select_cbt_technique(self, intent: str, challenge_category: ChallengeCategory) -> Optional[CBTTechnique]:
+    # כוונות שמקבלות פסקה ספציפית לאתגר ולגיל
+    CHALLENGE_INTENTS = ("communication", "academics", "screen_time", "behavior")
+    
+    # מיפוי כוונה לטכניקת CBT
+    TECHNIQUE_MAPPING = {
+        "emotional_expression": CBTTechnique.EMOTION_REGULATION,
+        "communication": CBTTechnique.COMMUNICATION_SKILLS,
+        "academics": CBTTechnique.PROBLEM_SOLVING,
+        "screen_time": CBTTechnique.BEHAVIORAL_ACTIVATION,
+        "behavior": CBTTechnique.POSITIVE_REINFORCEMENT,
+        "resistance": CBTTechnique.COGNITIVE_RESTRUCTURING,
+        "urgent_help": CBTTechnique.GROUNDING_TECHNIQUES
+    }
+    
+    def _select_cbt_technique(self, intent: str, challenge_category: ChallengeCategory) -> CBTTechnique:
         """בחירת טכניקת CBT מתאימה"""
-        technique_mapping = {
-            "emotional_expression": CBTTechnique.EMOTION_REGULATION,
-            "communication": CBTTechnique.COMMUNICATION_SKILLS,
-            "academics": CBTTechnique.PROBLEM_SOLVING,
-            "screen_time": CBTTechnique.BEHAVIORAL_ACTIVATION,
-            "behavior": CBTTechnique.POSITIVE_REINFORCEMENT,
-            "resistance": CBTTechnique.COGNITIVE_RESTRUCTURING,
-            "urgent_help": CBTTechnique.GROUNDING_TECHNIQUES
-        }
-        
-        return technique_mapping.get(intent, CBTTechnique.THOUGHT_CHALLENGING)
+        return self.TECHNIQUE_MAPPING.get(intent, CBTTechnique.THOUGHT_CHALLENGING)
     
     def _get_greeting_response(self, context: ResponseContext) -> str:
         """יצירת תגובת פתיחה"""
@@ -625,27 +804,36 @@ class AdvancedFallbackSystem:
         template = random.choice(templates)
         return template.format(parent_name=context.parent_name)
     
-    def _get_specific_challenge_response(self, 
-                                       challenge_category: ChallengeCategory, 
-                                       age_group: AgeGroup,
-                                       age_specific_data: Dict[str, Any],
-                                       context: ResponseContext) -> str:
-        """יצירת תגובה ספציפית לאתגר"""
+    @staticmethod
+    def _escape_template(text: str) -> str:
+        """הגנה על סוגריים מסולסלים בטקסט סטטי לפני שילובו בתבנית"""
+        return text.replace("{", "{{").replace("}", "}}")
+    
+    def _get_age_specific_data(self, challenge_category: ChallengeCategory, age_group: AgeGroup) -> Dict[str, Any]:
+        """נתוני האתגר לקבוצת הגיל"""
+        challenge_data = self.challenge_database.get(challenge_category, {})
+        return challenge_data.get("age_variations", {}).get(age_group, {})
+    
+    def _build_specific_challenge_template(self, 
+                                           challenge_category: ChallengeCategory, 
+                                           age_group: AgeGroup) -> str:
+        """תבנית תגובה ספציפית לאתגר ({child_name}, {child_age})"""
+        age_specific_data = self._get_age_specific_data(challenge_category, age_group)
         common_issues = age_specific_data.get("common_issues", [])
         cbt_approach = age_specific_data.get("cbt_approach", "")
         
-        response = f"מה שאת/ה מתאר/ת מאוד נפוץ עם {context.child_name} בגיל {context.child_age}. "
+        response = "מה שאת/ה מתאר/ת מאוד נפוץ עם {child_name} בגיל {child_age}. "
         
         if common_issues:
-            response += f"הרבה הורים מדווחים על דברים כמו: {', '.join(common_issues[:2])}. "
+            response += self._escape_template(f"הרבה הורים מדווחים על דברים כמו: {', '.join(common_issues[:2])}. ")
         
         if cbt_approach:
-            response += f"הגישה שלי כאן היא {cbt_approach}. "
+            response += self._escape_template(f"הגישה שלי כאן היא {cbt_approach}. ")
         
         return response
     
-    def _get_cbt_response(self, technique: CBTTechnique, context: ResponseContext) -> str:
-        """יצירת תגובה עם כלי CBT"""
+    def _build_cbt_template(self, technique: CBTTechnique) -> str:
+        """תבנית תגובה עם כלי CBT (ללא שדות אישיים)"""
         technique_data = self.cbt_techniques.get(technique, {})
         title = technique_data.get("title", "")
         description = technique_data.get("description", "")
@@ -656,16 +844,13 @@ class AdvancedFallbackSystem:
         if example_card:
             response += f"\n\n{example_card}"
         
-        return response
+        return self._escape_template(response)
     
-    def _get_action_steps(self, 
-                         challenge_category: ChallengeCategory,
-                         age_group: AgeGroup,
-                         context: ResponseContext) -> str:
-        """יצירת צעדים פרקטיים"""
-        challenge_data = self.challenge_database.get(challenge_category, {})
-        age_specific_data = challenge_data.get("age_variations", {}).get(age_group, {})
-        practical_tools = age_specific_data.get("practical_tools", [])
+    def _build_action_steps_template(self, 
+                                     challenge_category: ChallengeCategory,
+                                     age_group: AgeGroup) -> str:
+        """תבנית צעדים פרקטיים ({child_name})"""
+        practical_tools = self._get_age_specific_data(challenge_category, age_group).get("practical_tools", [])
         
         if not practical_tools:
             return "הנה כמה צעדים שיכולים לעזור: [תתחיל לאט], [תהיה סבלן/ית], [תשמור על רוגע]"
@@ -673,12 +858,31 @@ class AdvancedFallbackSystem:
         response = "הנה תוכנית פעולה פרקטית:\n\n"
         
         for i, tool in enumerate(practical_tools[:4], 1):
-            response += f"[צעד {i}: {tool}]\n"
+            response += self._escape_template(f"[צעד {i}: {tool}]\n")
         
-        response += f"\nמה דעתך שנתחיל עם אחד מהצעדים האלה עם {context.child_name}?"
+        response += "\nמה דעתך שנתחיל עם אחד מהצעדים האלה עם {child_name}?"
         
         return response
     
+    def _build_response_fragments(self) -> Dict[Tuple[ChallengeCategory, AgeGroup, CBTTechnique], ResponseFragments]:
+        """רינדור מראש של גוף התגובה לכל שילוב אתגר / גיל / טכניקה"""
+        cbt_templates = {technique: self._build_cbt_template(technique) for technique in CBTTechnique}
+        fragments = {}
+        
+        for challenge_category in ChallengeCategory:
+            for age_group in AgeGroup:
+                challenge_template = self._build_specific_challenge_template(challenge_category, age_group)
+                action_steps_template = self._build_action_steps_template(challenge_category, age_group)
+                
+                for technique, cbt_template in cbt_templates.items():
+                    body = "\n\n".join([cbt_template, action_steps_template])
+                    fragments[(challenge_category, age_group, technique)] = ResponseFragments(
+                        body=compile_template(body),
+                        body_with_challenge=compile_template("\n\n".join([challenge_template, body]))
+                    )
+        
+        return fragments
+    
     def _get_encouragement(self, context: ResponseContext) -> str:
         """יצירת מסר עידוד"""
         templates = self.response_templates["encouragement"]
@@ -691,60 +895,57 @@ class AdvancedFallbackSystem:
     
     def detect_emotional_state(self, user_input: str) -> Tuple[str, float]:
         """זיהוי מצב רגשי של המשתמש"""
-        emotional_indicators = {
-            "stress": {
-                "keywords": ["מתח", "לחץ", "עייף", "מותש", "עמוס", "לא מספיק"],
-                "patterns": [r"אין לי כוח", r"מספיק לי", r"נמאס לי"]
-            },
-            "anger": {
-                "keywords": ["כועס", "זועם", "עצבני", "מתוסכל", "מרגיז"],
-                "patterns": [r"מספיק כבר", r"לא יכול יותר", r"מטריף אותי"]
-            },
-            "sadness": {
-                "keywords": ["עצוב", "מדוכא", "כואב", "קשה", "בוכה"],
-                "patterns": [r"לא יודע מה לעשות", r"מרגיש רע", r"כל כך קשה"]
-            },
-            "anxiety": {
-                "keywords": ["חרד", "דואג", "פחד", "מתרגש", "בהלה"],
-                "patterns": [r"מה יהיה", r"איך אני", r"מה אם"]
-            },
-            "hope": {
-                "keywords": ["מקווה", "רוצה לנסות", "יש אפשרות", "אולי"],
-                "patterns": [r"אם רק", r"בואו ננסה", r"יש לי תקווה"]
-            }
-        }
-        
-        user_input_lower = user_input.lower()
-        emotion_scores = {}
-        
-        for emotion, indicators in emotional_indicators.items():
-            score = 0
-            
-            # בדיקת מילות מפתח
-            for keyword in indicators["keywords"]:
-                if keyword in user_input_lower:
-                    score += 1
-            
-            # בדיקת דפוסים
-            for pattern in indicators["patterns"]:
-                if re.search(pattern, user_input_lower):
-                    score += 2
-            
-            if score > 0:
-                emotion_scores[emotion] = score / (len(indicators["keywords"]) + len(indicators["patterns"]))
+        return self._score_emotional_state(self.message_matcher.match(user_input.lower()))
+    
+    def _score_emotional_state(self, matched: set) -> Tuple[str, float]:
+        """חישוב ציוני הרגשות מתוך מילות המפתח והדפוסים שזוהו"""
+        raw_scores: Dict[str, int] = {}
+        emotion_slots = self._emotion_slots
+        for slot in matched:
+            entry = emotion_slots.get(slot)
+            if entry is not None:
+                emotion, weight = entry
+                raw_scores[emotion] = raw_scores.get(emotion, 0) + weight
         
-        if not emotion_scores:
+        if not raw_scores:
             return "neutral", 0.5
         
+        # נרמול לפי מספר המחוונים, בסדר הגדרת הרגשות (קובע בשוויון ציונים)
+        emotion_scores = {}
+        for emotion, indicators in self.emotional_indicators.items():
+            if emotion in raw_scores:
+                emotion_scores[emotion] = raw_scores[emotion] / (len(indicators["keywords"]) + len(indicators["patterns"]))
+        
         # מציאת הרגש הדומיננטי
         dominant_emotion = max(emotion_scores, key=emotion_scores.get)
         confidence = emotion_scores[dominant_emotion]
         
         return dominant_emotion, confidence
     
+    def load_session(self, session_id: str) -> Optional[SessionData]:
+        """טעינת נתוני סשן מהאחסון"""
+        try:
+            state = self.state_store.get(session_id)
+        except Exception as e:
+            logger.error(f"Error loading fallback session state: {e}")
+            return None
+        if state is None:
+            return None
+        known_fields = {f.name for f in fields(SessionData)}
+        return SessionData(**{key: value for key, value in state.items() if key in known_fields})
+    
+    def save_session(self, session_id: str, session_data: SessionData):
+        """שמירת נתוני סשן באחסון (אחרי קיצור ההיסטוריה)"""
+        session_data.trim(self.max_history)
+        try:
+            self.state_store.set(session_id, asdict(session_data))
+        except Exception as e:
+            logger.error(f"Error saving fallback session state: {e}")
+    
     def analyze_conversation_pattern(self, session_id: str) -> Dict[str, Any]:
         """ניתוח דפוסי שיחה לתובנות"""
-        if session_id not in self.conversation_state:
+        session_data = self.load_session(session_id)
+        if session_data is None:
             return {
                 "session_found": False,
                 "primary_concerns": [],
@@ -752,7 +953,6 @@ class AdvancedFallbackSystem:
                 "recommendations": []
             }
         
-        session_data = self.conversation_state[session_id]
         
         # ניתוח הדפוסים
         primary_concerns = list(set(session_data.identified_intents))
@@ -775,7 +975,7 @@ class AdvancedFallbackSystem:
             "primary_concerns": primary_concerns,
             "conversation_flow": conversation_flow,
             "recommendations": recommendations,
-            "session_length": len(session_data.messages),
+            "session_length": session_data.interaction_count,
             "last_interaction": session_data.last_update
         }
     
@@ -815,11 +1015,11 @@ class AdvancedFallbackSystem:
         
         return "\n\n".join(summary_parts)
     
-    def get_fallback_response(self, 
-                             user_input: str, 
-                             session_id: Optional[str] = None,
-                             questionnaire_data: Optional[Dict[str, Any]] = None) -> str:
-        """נקודת הכניסה הראשית למערכת Fallback"""
+    def compute_fallback(self,
+                         user_input: str,
+                         session_id: Optional[str] = None,
+                         questionnaire_data: Optional[Dict[str, Any]] = None) -> FallbackAnswer:
+        """חישוב תגובת fallback בלי תופעות לוואי - מצב הסשן נשמר ונספר רק ב-record_served"""
         
         try:
             # קביעת קונטקסט
@@ -834,12 +1034,10 @@ class AdvancedFallbackSystem:
             else:
                 context = ResponseContext()
             
-            # אתחול מצב שיחה
+            # מצב השיחה אחרי התור הזה (עדיין לא נשמר)
+            session_data = None
             if session_id:
-                if session_id not in self.conversation_state:
-                    self.conversation_state[session_id] = SessionData()
-                
-                session_data = self.conversation_state[session_id]
+                session_data = self.load_session(session_id) or SessionData()
                 session_data.messages.append(user_input)
                 session_data.interaction_count += 1
                 session_data.last_update = datetime.now().isoformat()
@@ -847,16 +1045,13 @@ class AdvancedFallbackSystem:
             # טיפול בהודעת התחלה
             if user_input == "START_CONVERSATION":
                 context.conversation_stage = ConversationStage.GREETING
-                response = self._get_greeting_response(context)
-                return response
+                return FallbackAnswer(self._get_greeting_response(context), 'greeting', session_id, session_data)
             
             # זיהוי כוונה ומצב רגשי
-            intent, confidence = self.identify_intent(user_input)
-            emotional_state, emotion_confidence = self.detect_emotional_state(user_input)
+            (intent, confidence), (emotional_state, emotion_confidence) = self.analyze_message(user_input)
             
-            # שמירת הכוונה והרגש במצב השיחה
-            if session_id:
-                session_data = self.conversation_state[session_id]
+            # הכוונה והרגש במצב השיחה
+            if session_data is not None:
                 session_data.identified_intents.append(intent)
                 session_data.emotional_states.append(emotional_state)
                 session_data.conversation_stages.append(context.conversation_stage.value)
@@ -868,19 +1063,38 @@ class AdvancedFallbackSystem:
             response += "\n\n💡 *תגובה מהמערכת החכמה של יונתן הפסיכו-בוט*"
             
             logger.info(f"Generated fallback response for intent: {intent} (confidence: {confidence})")
-            return response
+            return FallbackAnswer(response, intent, session_id, session_data)
             
         except Exception as e:
             logger.error(f"Error in fallback system: {e}")
             # תגובת חירום
             parent_name = questionnaire_data.get("parent_name", "הורה יקר") if questionnaire_data else "הורה יקר"
-            return f"אני מתנצל, {parent_name}, נתקלתי בקושי טכני. בינתיים, זכור/י שאת/ה עושה עבודה חשובה כהורה. 🤗"
+            return FallbackAnswer(
+                f"אני מתנצל, {parent_name}, נתקלתי בקושי טכני. בינתיים, זכור/י שאת/ה עושה עבודה חשובה כהורה. 🤗",
+                'error'
+            )
+    
+    def record_served(self, answer: FallbackAnswer):
+        """תגובת fallback נשלחה בפועל: שמירת מצב הסשן וספירת ההפעלה"""
+        if answer.session_id and answer.session_data is not None:
+            self.save_session(answer.session_id, answer.session_data)
+        FALLBACK_ACTIVATIONS.labels(intent=answer.intent).inc()
+    
+    def get_fallback_response(self, 
+                             user_input: str, 
+                             session_id: Optional[str] = None,
+                             questionnaire_data: Optional[Dict[str, Any]] = None) -> str:
+        """נקודת הכניסה הראשית למערכת Fallback"""
+        answer = self.compute_fallback(user_input, session_id, questionnaire_data)
+        self.record_served(answer)
+        return answer.response
 
 # יצירת מופע גלובלי
-def create_advanced_fallback_system() -> Optional[AdvancedFallbackSystem]:
+def create_advanced_fallback_system(state_store: Optional[SessionStore] = None,
+                                    max_history: int = 50) -> Optional[AdvancedFallbackSystem]:
     """יצירת מערכת fallback מתקדמת עם טיפול בשגיאות"""
     try:
-        return AdvancedFallbackSystem()
+        return AdvancedFallbackSystem(state_store=state_store, max_history=max_history)
     except Exception as e:
         logger.error(f"שגיאה ביצירת מערכת fallback: {e}")
         return None
@@ -888,7 +1102,11 @@ def create_advanced_fallback_system() -> Optional[AdvancedFallbackSystem]:
 # Export
 __all__ = [
     'AdvancedFallbackSystem',
+    'PhraseMatcher',
     'ResponseContext',
+    'ResponseFragments',
+    'SessionData',
+    'FallbackAnswer',
     'AgeGroup',
     'ChallengeCategory',
     'ConversationStage',
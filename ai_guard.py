@@ -0,0 +1,227 @@
+# ai_guard.py - דדליין לקריאת Gemini ו-circuit breaker למעבר מיידי ל-fallback
+"""
+Deadline and circuit breaker for the Gemini call.
+
+Deadline: the first chunk (and every following chunk) must arrive within
+FALLBACK_TIMEOUT seconds. The sync route runs the Gemini stream on a worker
+thread and waits on a queue; the async route wraps each `__anext__` in
+`asyncio.wait_for`. While Gemini works, the chat routes compute the fallback
+answer in parallel, so a missed deadline switches to it immediately.
+
+Circuit breaker: errors caused by the request itself (a 4xx other than 429, a
+blocked prompt or stopped candidate) never count. Other failures are
+classified with `handle_generic_error`. A quota or rate-limit error (429)
+opens the circuit at once. CIRCUIT_BREAKER_FAILURE_THRESHOLD consecutive
+5xx-class failures (including missed deadlines) open it too. While open, every
+turn without a cached answer goes straight to the fallback system. After
+CIRCUIT_BREAKER_COOLDOWN seconds a single request probes Gemini again
+(half-open): success closes the circuit, failure re-opens it.
+
+The breaker is per worker - each process learns about an outage from its own
+first failures.
+"""
+
+import asyncio
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, Optional
+
+from ai_limiter import AICallAbandoned
+from errors import AICapacityExceededError, AIModelError, handle_generic_error
+import metrics
+
+try:
+    from google.api_core.exceptions import ClientError, TooManyRequests
+    from google.generativeai.types import BlockedPromptException, StopCandidateException
+    CONTENT_ERRORS = (BlockedPromptException, StopCandidateException)
+except ImportError:
+    ClientError = TooManyRequests = None
+    CONTENT_ERRORS = ()
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+class AIDeadlineExceeded(AIModelError):
+    """Gemini לא החזיר chunk בזמן"""
+    error_type = "ai_deadline_exceeded"
+
+def is_request_error(error: Exception) -> bool:
+    """שגיאה שנגרמה מהבקשה עצמה (4xx חוץ מ-429, פרומפט חסום) ולא מ-Gemini"""
+    if isinstance(error, CONTENT_ERRORS):
+        return True
+    return ClientError is not None and isinstance(error, ClientError) and not isinstance(error, TooManyRequests)
+
+class CircuitBreaker:
+    """מפסק לקריאות AI: closed -> open (אחרי כשלים) -> half_open (בדיקה) -> closed"""
+
+    def __init__(self, failure_threshold: int = 3, cooldown_seconds: float = 30):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_started_at = 0.0
+        self.last_error: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def configure(self, failure_threshold: int, cooldown_seconds: float):
+        """עדכון הגדרות (נקרא בזמן אתחול האפליקציה)"""
+        with self._lock:
+            self.failure_threshold = max(1, failure_threshold)
+            self.cooldown_seconds = cooldown_seconds
+            self._transition(CLOSED)
+            self.consecutive_failures = 0
+
+    def _transition(self, state: str):
+        if state != self.state:
+            logger.warning(f"AI circuit breaker: {self.state} -> {state}")
+            metrics.AI_CIRCUIT_TRANSITIONS.labels(state=state).inc()
+        self.state = state
+
+    def allow(self) -> bool:
+        """האם לנסות את Gemini בתור הזה"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            now = time.monotonic()
+            if self.state == OPEN:
+                if now - self.opened_at < self.cooldown_seconds:
+                    return False
+                self._transition(HALF_OPEN)
+                self.probe_started_at = now
+                return True
+            # Half-open: one probe at a time; a probe that never reported back is replaced after a cool-down
+            if now - self.probe_started_at >= self.cooldown_seconds:
+                self.probe_started_at = now
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self._transition(CLOSED)
+
+    def record_failure(self, error: Exception):
+        """רישום כשל. רק 429 ושגיאות 5xx נספרים - שגיאות של הבקשה עצמה (תוכן, 4xx) לא מפילות את המפסק"""
+        if isinstance(error, (AICapacityExceededError, AICallAbandoned)):
+            # Local load shedding / a coalesced leader that gave up - not an upstream failure
+            return
+        if is_request_error(error):
+            # One bad prompt (blocked, too large, invalid) says nothing about Gemini's health
+            return
+        classified = error if isinstance(error, AIModelError) else handle_generic_error(error)
+        with self._lock:
+            self.last_error = f"{type(error).__name__}: {error}"[:200]
+            if classified.status_code == 429:
+                self._open()
+            elif classified.status_code >= 500:
+                self.consecutive_failures += 1
+                if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                    self._open()
+
+    def _open(self):
+        self.opened_at = time.monotonic()
+        self._transition(OPEN)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.consecutive_failures,
+                'last_error': self.last_error
+            }
+
+# מופע גלובלי לכל worker
+ai_circuit = CircuitBreaker()
+
+# Threads for the Gemini producer of sync turns (they may block waiting for a limiter slot)
+ai_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='ai-call')
+
+# Speculative fallback answers run apart, so they are never queued behind blocked Gemini producers
+fallback_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='fallback')
+
+def init_ai_guard(app):
+    """הגדרת הדדליין וה-circuit breaker לפי הגדרות האפליקציה"""
+    global ai_executor
+    ai_circuit.configure(
+        failure_threshold=app.config.get('CIRCUIT_BREAKER_FAILURE_THRESHOLD', 3),
+        cooldown_seconds=app.config.get('CIRCUIT_BREAKER_COOLDOWN', 30)
+    )
+    ai_executor = ThreadPoolExecutor(
+        max_workers=app.config.get('AI_WORKER_THREADS', 32), thread_name_prefix='ai-call'
+    )
+
+def run_in_background(fn: Callable, *args, **kwargs):
+    """הרצת fallback ספקולטיבי ב-thread נפרד מקריאות ה-AI"""
+    return fallback_executor.submit(fn, *args, **kwargs)
+
+
+_DONE = object()
+
+class _Failure:
+    __slots__ = ('error',)
+
+    def __init__(self, error: Exception):
+        self.error = error
+
+def stream_with_deadline(start_stream: Callable[[], Iterator[str]], chunk_timeout: float) -> Iterator[str]:
+    """הרצת זרם Gemini ב-thread והעברת ה-chunks, עם דדליין לכל chunk"""
+    chunks: "queue.Queue[Any]" = queue.Queue()
+    cancelled = threading.Event()
+
+    def produce():
+        try:
+            for chunk in start_stream():
+                if cancelled.is_set():
+                    break
+                chunks.put(chunk)
+            chunks.put(_DONE)
+        except Exception as e:
+            chunks.put(_Failure(e))
+
+    ai_executor.submit(produce)
+    try:
+        while True:
+            try:
+                item = chunks.get(timeout=chunk_timeout)
+            except queue.Empty:
+                raise AIDeadlineExceeded(f"No Gemini chunk within {chunk_timeout}s")
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        # Let the producer stop at its next chunk (the blocking call itself can't be interrupted)
+        cancelled.set()
+
+async def stream_with_deadline_async(stream: AsyncIterator[str], chunk_timeout: float) -> AsyncIterator[str]:
+    """העברת זרם Gemini אסינכרוני עם דדליין לכל chunk"""
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(stream.__anext__(), chunk_timeout)
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                raise AIDeadlineExceeded(f"No Gemini chunk within {chunk_timeout}s")
+            yield chunk
+    finally:
+        await stream.aclose()
+
+__all__ = [
+    'AIDeadlineExceeded',
+    'CircuitBreaker',
+    'is_request_error',
+    'ai_circuit',
+    'init_ai_guard',
+    'run_in_background',
+    'stream_with_deadline',
+    'stream_with_deadline_async'
+]
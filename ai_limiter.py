@@ -0,0 +1,368 @@
+# ai_limiter.py - הגבלת קריאות Gemini מקבילות ואיחוד פרומפטים זהים
+"""
+Concurrency limiter and in-flight coalescing for Gemini calls.
+
+Limiter: at most AI_MAX_CONCURRENT_CALLS upstream calls run at once in a
+worker. The sync and async chat routes share the same limiter. Further calls
+wait in a FIFO queue. The queue holds at most AI_MAX_QUEUED_CALLS, and each
+call waits at most AI_QUEUE_TIMEOUT seconds. A call that cannot get a slot
+raises AICapacityExceededError and the turn is answered by the fallback system.
+We shed load locally instead of bursting into the provider's rate limit. The
+limit is per worker, so the fleet-wide ceiling is
+workers x AI_MAX_CONCURRENT_CALLS - size it against the provider quota.
+
+Coalescing: a call whose prompt is identical to one already in flight (a
+client retry, a double submit) does not go upstream. It follows the leader's
+stream, replaying the chunks received so far and then the rest as they
+arrive. Only the leader takes a limiter slot. If the leader fails or its
+client goes away, the followers fail too and answer from the fallback system.
+
+Exported: queue depth, calls in flight, queue wait time by outcome, and
+coalesced calls.
+"""
+
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+
+from errors import AICapacityExceededError, AIModelError
+import metrics
+
+logger = logging.getLogger(__name__)
+
+class AICallAbandoned(AIModelError):
+    """הקריאה המובילה שעליה המתין קורא מאוחד הופסקה לפני שהסתיימה"""
+    error_type = "ai_call_abandoned"
+
+def _wake(future: "asyncio.Future"):
+    if not future.done():
+        future.set_result(None)
+
+class _Waiter:
+    """ממתין בתור: thread (Event) או coroutine (Future על לולאה מסוימת)"""
+    __slots__ = ('event', 'loop', 'future', 'granted')
+
+    def __init__(self, event: Optional[threading.Event] = None,
+                 loop: Optional[asyncio.AbstractEventLoop] = None, future: Optional["asyncio.Future"] = None):
+        self.event = event
+        self.loop = loop
+        self.future = future
+        self.granted = False
+
+    def notify(self) -> bool:
+        if self.event is not None:
+            self.event.set()
+            return True
+        try:
+            self.loop.call_soon_threadsafe(_wake, self.future)
+            return True
+        except RuntimeError:
+            # The waiter's event loop is closed - nobody is left to take the slot
+            return False
+
+class ConcurrencyLimiter:
+    """סמפור הוגן (FIFO) לקריאות AI, משותף ל-threads ול-asyncio, עם תור המתנה מוגבל"""
+
+    def __init__(self, max_concurrent: int = 8, max_queue: int = 32, queue_timeout: float = 5):
+        self._lock = threading.Lock()
+        self._waiters: "deque[_Waiter]" = deque()
+        self._active = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.configure(max_concurrent, max_queue, queue_timeout)
+
+    def configure(self, max_concurrent: int, max_queue: int, queue_timeout: float):
+        """עדכון הגדרות (נקרא בזמן אתחול האפליקציה)"""
+        with self._lock:
+            self.max_concurrent = max(1, max_concurrent)
+            self.max_queue = max(0, max_queue)
+            self.queue_timeout = queue_timeout
+
+    def _try_enter(self, waiter_factory: Callable[[], _Waiter]) -> Optional[_Waiter]:
+        """כניסה מיידית (None) או הצטרפות לתור (ממתין). זורק אם התור מלא"""
+        with self._lock:
+            if self._active < self.max_concurrent and not self._waiters:
+                self._active += 1
+                return None
+            if len(self._waiters) >= self.max_queue:
+                self.rejected += 1
+                reject = True
+            else:
+                reject = False
+                waiter = waiter_factory()
+                self._waiters.append(waiter)
+        if reject:
+            metrics.AI_QUEUE_WAIT.labels(outcome='rejected').observe(0)
+            raise AICapacityExceededError(f"AI call queue is full ({self.max_queue} waiting)")
+        metrics.AI_QUEUE_DEPTH.inc()
+        return waiter
+
+    def _abandon(self, waiter: _Waiter) -> bool:
+        """יציאה מהתור בלי slot. False אם ה-slot כבר הועבר לממתין בינתיים"""
+        with self._lock:
+            if waiter.granted:
+                return False
+            self._waiters.remove(waiter)
+        metrics.AI_QUEUE_DEPTH.dec()
+        return True
+
+    def _entered(self, started: float):
+        metrics.AI_QUEUE_WAIT.labels(outcome='acquired').observe(time.perf_counter() - started)
+        metrics.AI_CALLS_IN_FLIGHT.inc()
+
+    def _timed_out(self, started: float):
+        with self._lock:
+            self.timed_out += 1
+        metrics.AI_QUEUE_WAIT.labels(outcome='timeout').observe(time.perf_counter() - started)
+        raise AICapacityExceededError(f"No AI call slot within {self.queue_timeout}s")
+
+    def acquire(self):
+        """המתנה ל-slot (thread). זורק AICapacityExceededError בתור מלא או בתום ההמתנה"""
+        started = time.perf_counter()
+        waiter = self._try_enter(lambda: _Waiter(event=threading.Event()))
+        if waiter is not None and not waiter.event.wait(self.queue_timeout) and self._abandon(waiter):
+            self._timed_out(started)
+        self._entered(started)
+
+    async def acquire_async(self):
+        """המתנה ל-slot בלי לחסום את ה-event loop"""
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        waiter = self._try_enter(lambda: _Waiter(loop=loop, future=loop.create_future()))
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+            except asyncio.TimeoutError:
+                if self._abandon(waiter):
+                    self._timed_out(started)
+            except asyncio.CancelledError:
+                if not self._abandon(waiter):
+                    # The slot arrived together with the cancellation - hand it on
+                    self._entered(started)
+                    self.release()
+                raise
+        self._entered(started)
+
+    def release(self):
+        """שחרור slot - מועבר ישירות לממתין הבא בתור, אם יש"""
+        metrics.AI_CALLS_IN_FLIGHT.dec()
+        while True:
+            with self._lock:
+                if not self._waiters:
+                    self._active -= 1
+                    return
+                waiter = self._waiters.popleft()
+                waiter.granted = True
+            metrics.AI_QUEUE_DEPTH.dec()
+            if waiter.notify():
+                return
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def slot_async(self):
+        await self.acquire_async()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'max_concurrent': self.max_concurrent,
+                'in_flight': self._active,
+                'queued': len(self._waiters),
+                'max_queue': self.max_queue,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out
+            }
+
+class _Flight:
+    """קריאה אחת בדרך: ה-chunks שהתקבלו עד כה, משותפים למוביל ולעוקבים"""
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[Exception] = None
+        self.followers = 0
+        self._cond = threading.Condition()
+        self._async_waiters: List[Tuple[asyncio.AbstractEventLoop, "asyncio.Future"]] = []
+
+    def _notify(self):
+        self._cond.notify_all()
+        waiters, self._async_waiters = self._async_waiters, []
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, future)
+            except RuntimeError:
+                pass
+
+    def publish(self, chunk: str):
+        with self._cond:
+            self.chunks.append(chunk)
+            self._notify()
+
+    def finish(self, error: Optional[Exception] = None):
+        with self._cond:
+            self.done = True
+            self.error = error
+            self._notify()
+
+    def read(self, index: int) -> Tuple[List[str], bool, Optional[Exception]]:
+        """chunks חדשים מהמיקום הנתון (ממתין אם אין עדיין)"""
+        with self._cond:
+            while index >= len(self.chunks) and not self.done:
+                self._cond.wait()
+            return self.chunks[index:], self.done, self.error
+
+    def read_nowait(self, loop: asyncio.AbstractEventLoop, index: int):
+        """כמו read, בלי לחסום: מחזיר Future להמתנה כשאין chunks חדשים"""
+        with self._cond:
+            if index < len(self.chunks) or self.done:
+                return self.chunks[index:], self.done, self.error, None
+            future = loop.create_future()
+            self._async_waiters.append((loop, future))
+            return [], False, None, future
+
+def _abandoned(error: BaseException) -> Exception:
+    if isinstance(error, Exception):
+        return error
+    return AICallAbandoned("The coalesced AI call was abandoned before it finished")
+
+class AICallGate:
+    """כל קריאה ל-Gemini עוברת כאן: איחוד פרומפטים זהים, ואז slot ב-limiter למוביל"""
+
+    def __init__(self, limiter: ConcurrencyLimiter, coalesce: bool = True):
+        self.limiter = limiter
+        self.coalesce = coalesce
+        self.coalesced = 0
+        self._flights: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(prompt: str) -> str:
+        return hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+
+    def _join(self, prompt: str) -> Tuple[Optional[str], _Flight, bool]:
+        """(key, flight, leader?) - מצטרף לקריאה זהה שבדרך אם יש"""
+        flight = _Flight()
+        if not self.coalesce:
+            return None, flight, True
+        key = self._key(prompt)
+        with self._lock:
+            existing = self._flights.get(key)
+            if existing is None:
+                self._flights[key] = flight
+                return key, flight, True
+            existing.followers += 1
+            self.coalesced += 1
+        metrics.AI_COALESCED_CALLS.inc()
+        return key, existing, False
+
+    def _land(self, key: Optional[str], flight: _Flight):
+        if key is None:
+            return
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def stream(self, prompt: str, start: Callable[[], Iterator[str]]) -> Iterator[str]:
+        """זרם chunks לפרומפט: קריאה חדשה (בתוך slot) או מעקב אחרי קריאה זהה שבדרך"""
+        key, flight, leader = self._join(prompt)
+        if not leader:
+            index = 0
+            while True:
+                chunks, done, error = flight.read(index)
+                index += len(chunks)
+                yield from chunks
+                if done:
+                    if error is not None:
+                        raise error
+                    return
+
+        try:
+            with self.limiter.slot():
+                for chunk in start():
+                    flight.publish(chunk)
+                    yield chunk
+            flight.finish()
+        except BaseException as e:
+            flight.finish(_abandoned(e))
+            raise
+        finally:
+            self._land(key, flight)
+
+    async def stream_async(self, prompt: str, start: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        """הגרסה האסינכרונית של stream()"""
+        key, flight, leader = self._join(prompt)
+        if not leader:
+            loop = asyncio.get_running_loop()
+            index = 0
+            while True:
+                chunks, done, error, future = flight.read_nowait(loop, index)
+                if future is not None:
+                    await future
+                    continue
+                index += len(chunks)
+                for chunk in chunks:
+                    yield chunk
+                if done:
+                    if error is not None:
+                        raise error
+                    return
+
+        try:
+            async with self.limiter.slot_async():
+                async for chunk in start():
+                    flight.publish(chunk)
+                    yield chunk
+            flight.finish()
+        except BaseException as e:
+            flight.finish(_abandoned(e))
+            raise
+        finally:
+            self._land(key, flight)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            in_flight = len(self._flights)
+        return {
+            **self.limiter.get_stats(),
+            'coalescing': self.coalesce,
+            'coalesced': self.coalesced,
+            'distinct_prompts_in_flight': in_flight
+        }
+
+# מופעים גלובליים לכל worker
+ai_limiter = ConcurrencyLimiter()
+ai_calls = AICallGate(ai_limiter)
+
+def init_ai_limiter(app):
+    """הגדרת ה-limiter והאיחוד לפי הגדרות האפליקציה"""
+    ai_limiter.configure(
+        max_concurrent=app.config.get('AI_MAX_CONCURRENT_CALLS', 8),
+        max_queue=app.config.get('AI_MAX_QUEUED_CALLS', 32),
+        queue_timeout=app.config.get('AI_QUEUE_TIMEOUT', 5)
+    )
+    ai_calls.coalesce = app.config.get('AI_COALESCE_PROMPTS', True)
+
+__all__ = [
+    'AICallAbandoned',
+    'ConcurrencyLimiter',
+    'AICallGate',
+    'ai_limiter',
+    'ai_calls',
+    'init_ai_limiter'
+]
@@ -1,6 +1,6 @@
 # app.py - קובץ מתוקן בשלמותו (כולל Endpoints חסרים ושינוי CSP)
 
-from flask import Flask, request, jsonify, Response, render_template, send_from_directory
+from flask import Flask, request, jsonify, Response, render_template, send_from_directory, stream_with_context
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_cors import CORS
@@ -11,17 +11,59 @@ import os
 from datetime import datetime, timezone, timedelta
 import json
 import re
-from typing import Dict, Any
+import time
+from dataclasses import replace
+from typing import Dict, Any, Optional, Tuple
 
 # Import models and db initialization
-from models import db, init_app_db, Parent, Child, Conversation, Message, QuestionnaireResponse, generate_secure_id
+from models import db, init_app_db, Parent, Child, Conversation, Message, generate_secure_id
+
+# Import session context loader
+from session_context import get_session_context, init_session_context_cache, invalidate_session_context, session_context_cache
+
+# Import conversation history for multi-turn prompts
+from conversation_history import ConversationHistory, history_builder, init_history_builder
+
+# Import Gemini response cache
+from response_cache import cache_allowed, init_response_cache, response_cache
+
+# Import deadline and circuit breaker for the Gemini call
+from ai_guard import ai_circuit, init_ai_guard, run_in_background, stream_with_deadline
+
+# Import concurrency limiter and in-flight coalescing for Gemini calls
+from ai_limiter import ai_calls, init_ai_limiter
+
+# Import keyset-paginated history pages
+from history_pages import open_history_page
+
+# Import streaming per-parent data export
+from data_export import open_parent_export
+
+# Import post-turn analytics pipeline
+from background_tasks import background_tasks
 
 # Import Config and error handling
-from config import get_config, validate_config
-from errors import BotError, ValidationError, handle_generic_error, QuotaExceededError, RateLimitExceededError, AIModelError, FallbackSystemError, SessionNotFoundError, DatabaseError # Added SessionNotFoundError, DatabaseError for specific raises
+from config import get_config, validate_config, ADVANCED_SETTINGS
+from errors import BotError, ValidationError, handle_generic_error, QuotaExceededError, RateLimitExceededError, AIModelError, FallbackSystemError, SessionNotFoundError, DatabaseError, SecurityError # Added SessionNotFoundError, DatabaseError for specific raises
 
 # Import advanced_fallback_system
-from advanced_fallback_system import create_advanced_fallback_system, ResponseContext, AgeGroup, ChallengeCategory, ConversationStage, CBTTechnique
+from advanced_fallback_system import create_advanced_fallback_system, FallbackAnswer, ResponseContext, AgeGroup, ChallengeCategory, ConversationStage, CBTTechnique
+
+# Import metrics (no-ops unless ENABLE_METRICS)
+import metrics
+from metrics import init_metrics, render_metrics
+
+# Import request profiler (inactive unless ENABLE_PROFILING)
+from profiling import request_profiler
+
+# Import write-behind message persistence
+from message_writer import message_writer
+
+# Import fallback session state store
+from session_store import create_session_store
+
+# Import cached health probes
+from health import create_health_prober
 
 # Import Google Generative AI
 import google.generativeai as genai
@@ -42,6 +84,15 @@ if not validate_config(current_config):
 
 # Initialize database
 init_app_db(app)
+init_session_context_cache(app)
+init_history_builder(app)
+init_response_cache(app)
+init_ai_guard(app)
+init_ai_limiter(app)
+background_tasks.init_app(app)
+message_writer.init_app(app)
+init_metrics(app, db)
+request_profiler.init_app(app)
 
 # Initialize CORS
 CORS(app, resources={r"/api/*": {"origins": app.config['CORS_ORIGINS']}})
@@ -76,14 +127,39 @@ else:
     logger.warning("GOOGLE_API_KEY not set. AI model will not be available.")
 
 # Initialize advanced fallback system
-advanced_fallback_system = create_advanced_fallback_system()
+fallback_state_store = create_session_store(
+    backend=app.config['FALLBACK_STATE_BACKEND'],
+    url=app.config['FALLBACK_STATE_URL'],
+    ttl_seconds=app.config['FALLBACK_STATE_TTL'],
+    max_sessions=app.config['FALLBACK_STATE_MAX_SESSIONS'],
+    max_bytes=app.config['FALLBACK_STATE_MAX_BYTES']
+)
+advanced_fallback_system = create_advanced_fallback_system(
+    state_store=fallback_state_store,
+    max_history=app.config['FALLBACK_STATE_MAX_HISTORY']
+)
 if not advanced_fallback_system:
     logger.error("❌ Advanced Fallback System could not be initialized.")
 
+# Initialize background health prober (DB + AI reachability, cached per worker)
+health_prober = create_health_prober(app, db, model)
+health_prober.ensure_started()
+
 # Initialize CSRF Serializer (used for token generation if not using Flask-WTF forms)
 # Use a strong SECRET_KEY. Ensure it's defined in your .env or Render settings.
 s = URLSafeTimedSerializer(app.config.get('SECRET_KEY', 'default-dev-secret-key-please-change')) # Fallback for dev
 
+# Canned replies used when neither the AI nor the fallback system can answer
+BASIC_RESPONSE = "שלום! אני יונתן. מצטער, יש לי קושי טכני כרגע, אבל אני כאן לעזור לך. איך אני יכול לסייע?"
+STREAM_ERROR_RESPONSE = "מצטער, אירעה שגיאה טכנית. אנא נסה שוב."
+
+# Headers for streamed chat responses (disable proxy buffering so chunks flush immediately)
+STREAM_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'Connection': 'keep-alive',
+    'X-Accel-Buffering': 'no'
+}
+
 
 # --- Helper Functions ---
 
@@ -106,6 +182,218 @@ def sanitize_input(text: str) -> str:
     return cleaned_text.strip()
 
 
+def parse_chat_payload(data: Any) -> Tuple[str, str]:
+    """Validate a chat request body and return (session_id, sanitized message)"""
+    if not data:
+        raise ValidationError("Missing JSON body", user_message="נתוני JSON חסרים")
+
+    session_id = data.get('session_id')
+    message = data.get('message')
+
+    if not session_id:
+        raise ValidationError("Missing session_id", user_message="שדה session_id חסר")
+    if not message:
+        raise ValidationError("Missing message", user_message="שדה message חסר")
+
+    if not validate_session_id(session_id):
+        raise ValidationError("Invalid session_id", user_message="session_id לא תקין")
+
+    if not isinstance(message, str) or not message.strip():
+        raise ValidationError("Invalid message", user_message="שדה message לא תקין")
+
+    if len(message) > app.config.get('MAX_MESSAGE_LENGTH', 5000):
+        raise ValidationError("Message too long", user_message="ההודעה ארוכה מדי")
+
+    if is_suspicious_request():
+        log_security_event("suspicious_chat_request", {
+            "session_id": session_id[:8] + "...",
+            "message_length": len(message)
+        })
+        raise SecurityError("Suspicious chat request blocked")
+
+    message = sanitize_input(message)
+    if not message:
+        raise ValidationError("Empty message after sanitizing", user_message="הודעה לא תקינה אחרי ניקוי")
+
+    return session_id, message
+
+def prepare_chat_turn(session_id: str, message: str) -> Tuple[Dict[str, Any], int, Optional[ConversationHistory]]:
+    """Load the session context and persist the user message.
+
+    The context comes from the per-worker session context cache, or from a
+    single joined query on a miss. The conversation history for the prompt is
+    read before the new message is stored, so it never repeats it. Returns
+    (questionnaire_data, conversation_id, history); history is None when
+    ENABLE_CONVERSATION_HISTORY is off, the AI model is unavailable or the
+    conversation is new. Safe to call from a worker thread since it pushes
+    its own application context.
+    """
+    try:
+        with app.app_context(): # Ensure app context for DB operations
+            context = get_session_context(session_id)
+            if context is None:
+                # If parent not found, it means session_id is invalid or not initialized
+                raise SessionNotFoundError(f"Parent session {session_id} not found.")
+
+            history = None
+            if context.conversation_id and model and ADVANCED_SETTINGS['ENABLE_CONVERSATION_HISTORY']:
+                history = history_builder.build(context.conversation_id, message)
+
+            if not context.conversation_id:
+                # Create new conversation
+                child_id = context.child_id
+                if not child_id:
+                    logger.warning(f"No child associated with parent {session_id} for new conversation. Creating a dummy child.")
+                    # Create a default child if none exists
+                    new_child = Child(
+                        name="ילד_ברירת_מחדל", # Default child name
+                        gender="לא צוין",
+                        age=15,
+                        parent_id=session_id,
+                        created_at=datetime.now(timezone.utc)
+                    )
+                    db.session.add(new_child)
+                    db.session.flush() # Get ID for current transaction
+                    child_id = new_child.id
+
+                conversation = Conversation(
+                    parent_id=session_id,
+                    child_id=child_id,
+                    topic=context.questionnaire_data.get('main_challenge', 'שיחה כללית')
+                )
+                db.session.add(conversation)
+                db.session.flush() # Get ID without committing yet
+                context = replace(context, conversation_id=conversation.id, child_id=child_id)
+
+            user_turn = message != "START_CONVERSATION"
+            if user_turn and not message_writer.enabled:
+                db.session.add(Message(
+                    conversation_id=context.conversation_id,
+                    sender_type='user',
+                    content=message
+                ))
+
+            db.session.commit()
+
+            # Write-behind: queue only after the conversation row is committed
+            if user_turn and message_writer.enabled and not message_writer.write(context.conversation_id, 'user', message):
+                db.session.add(Message(
+                    conversation_id=context.conversation_id,
+                    sender_type='user',
+                    content=message
+                ))
+                db.session.commit()
+            session_context_cache.set(context)
+            return context.questionnaire_data, context.conversation_id, history
+
+    except SessionNotFoundError:
+        raise
+    except Exception as db_error:
+        logger.error(f"Database error in chat: {db_error}")
+        db.session.rollback() # Rollback transaction if any error occurs
+        invalidate_session_context(session_id)
+        raise DatabaseError(f"Failed to interact with database: {db_error}")
+
+
+def build_chat_prompt(questionnaire_data: Dict[str, Any], message: str,
+                      history: Optional[ConversationHistory] = None) -> str:
+    """Build the Gemini prompt from the questionnaire context, the conversation history and the user message"""
+    context = ""
+    if questionnaire_data:
+        context = f"""
+הורה: {questionnaire_data.get('parent_name', 'הורה')}
+ילד/ה: {questionnaire_data.get('child_name', 'ילד/ה')} בן/בת {questionnaire_data.get('child_age', 'לא ידוע')}
+אתגר עיקרי: {questionnaire_data.get('main_challenge', 'לא צוין')}
+רמת מצוקה: {questionnaire_data.get('distress_level', 'לא צוין')}/10
+ניסיונות קודמים: {questionnaire_data.get('past_solutions', 'לא צוין')}
+מטרת השיחה: {questionnaire_data.get('goal', 'לא צוין')}
+"""
+
+    if history and not history.is_empty():
+        context += f"""
+{history.to_prompt()}
+"""
+
+    return f"""
+אתה יונתן, פסיכו-בוט חינוכי מתקדם המתמחה בהורות למתבגרים ומבוסס על עקרונות CBT.
+
+{context}
+
+עקרונות התגובה שלך:
+1. הגב בעברית בלבד עם טון חם, תומך ומקצועי
+2. השתמש בעקרונות CBT: זיהוי מחשבות, אתגור אמונות, שינוי התנהגות
+3. תן כלים פרקטיים ומעשיים שאפשר ליישם מיד
+4. השתמש בפורמט CARD[כותרת|תוכן] לטיפים חשובים
+5. הוסף כפתורי הצעה בפורמט [טקסט כפתור] לפעולות נוספות
+6. התמקד בפתרונות ולא בבעיות
+7. הכר ברגשות ההורה ותן legitimacy למצוקה
+8. תן דוגמאות קונקרטיות ומעשיות
+
+הודעת המשתמש: {message}
+"""
+
+def stream_ai_response(prompt: str):
+    """Yield text chunks from Gemini - an identical prompt already in flight is shared, not re-sent"""
+    return ai_calls.stream(prompt, lambda: _stream_gemini(prompt))
+
+def _stream_gemini(prompt: str):
+    """Yield text chunks from Gemini as they are generated"""
+    with metrics.track_gemini_call():
+        response_ai = model.generate_content(prompt, stream=True)
+        for chunk in response_ai:
+            try:
+                text = chunk.text
+            except ValueError:
+                # Chunk without text parts (e.g. safety block or finish marker)
+                continue
+            if text:
+                yield text
+
+def is_cacheable_turn(use_cache: bool, history: Optional[ConversationHistory]) -> bool:
+    """Only turns without earlier context may share a cached answer"""
+    return use_cache and response_cache.enabled and (history is None or history.is_empty())
+
+def get_fallback_text(message: str, session_id: str, questionnaire_data: Dict[str, Any]) -> str:
+    """Answer from the advanced fallback system, or a basic apology if it is unavailable"""
+    if advanced_fallback_system:
+        return advanced_fallback_system.get_fallback_response(
+            user_input=message, session_id=session_id, questionnaire_data=questionnaire_data
+        )
+    return BASIC_RESPONSE
+
+def speculative_fallback(message: str, session_id: str, questionnaire_data: Dict[str, Any]) -> Optional[FallbackAnswer]:
+    """Fallback answer computed alongside the Gemini call - nothing is saved or counted unless it is served"""
+    if advanced_fallback_system:
+        return advanced_fallback_system.compute_fallback(message, session_id, questionnaire_data)
+    return None
+
+def serve_speculative_fallback(answer: Optional[FallbackAnswer]) -> str:
+    """Persist the fallback session state of a speculative answer that is actually sent, and return its text"""
+    if answer is None:
+        return BASIC_RESPONSE
+    advanced_fallback_system.record_served(answer)
+    return answer.response
+
+def save_bot_message(conversation_id, content: str):
+    """Persist the assembled bot reply once the stream has finished"""
+    if not conversation_id or not content:
+        return
+    if not message_writer.write(conversation_id, 'bot', content):
+        try:
+            bot_message = Message(
+                conversation_id=conversation_id,
+                sender_type='bot',
+                content=content
+            )
+            db.session.add(bot_message)
+            db.session.commit()
+        except Exception as save_error:
+            logger.warning(f"Could not save message to DB: {save_error}")
+            db.session.rollback()
+    # The reply has been streamed - analytics run off the request path
+    background_tasks.schedule_turn_analytics(conversation_id)
+
+
 # --- Routes ---
 
 @app.route('/')
@@ -194,12 +482,13 @@ def init_session():
 
 
 @app.route('/api/chat', methods=['POST'])
-@limiter.limit("30 per minute")
+@limiter.limit(app.config['CHAT_RATE_LIMIT'])
 # Temporarily disable CSRF for this route to debug functionality.
 # REMOVE THIS LINE IN PRODUCTION AFTER CSRF IS FULLY WORKING CLIENT-SIDE!
 @csrf.exempt # TEMPORARY: For debugging CSRF token issues. REMOVE IN PRODUCTION!
 def chat():
     """Enhanced chat endpoint with proper validation and streaming response"""
+    turn_started = time.perf_counter()
     try:
         # Ensure that CSRF token is checked if @csrf.exempt is removed
         # csrf.check() # Uncomment this line in production
@@ -208,210 +497,72 @@ def chat():
             return jsonify({"error": "הבקשה חייבת להיות בפורמט JSON"}), 400
 
         data = request.get_json()
-        if not data:
-            return jsonify({"error": "נתוני JSON חסרים"}), 400
-
-        session_id = data.get('session_id')
-        message = data.get('message')
-        
-        if not session_id:
-            return jsonify({"error": "שדה session_id חסר"}), 400
-        if not message:
-            return jsonify({"error": "שדה message חסר"}), 400
-        
-        if not validate_session_id(session_id):
-            return jsonify({"error": "session_id לא תקין"}), 400
-            
-        if not isinstance(message, str) or not message.strip():
-            return jsonify({"error": "שדה message לא תקין"}), 400
-            
-        if len(message) > app.config.get('MAX_MESSAGE_LENGTH', 5000):
-            return jsonify({"error": "ההודעה ארוכה מדי"}), 400
-
-        if is_suspicious_request():
-            log_security_event("suspicious_chat_request", {
-                "session_id": session_id[:8] + "...",
-                "message_length": len(message)
-            })
-            return jsonify({"error": "בקשה חשודה נחסמה"}), 403
-
-        message = sanitize_input(message)
-        if not message:
-            return jsonify({"error": "הודעה לא תקינה אחרי ניקוי"}), 400
-
-        conversation = None
-        parent = None
-        try:
-            with app.app_context(): # Ensure app context for DB operations
-                questionnaire_data = {}
-                if session_id:
-                    questionnaire = QuestionnaireResponse.query.filter_by(parent_id=session_id).first()
-                    if questionnaire:
-                        questionnaire_data = questionnaire.get_response_data()
-
-                parent = Parent.query.filter_by(id=session_id).first()
-                if not parent:
-                    # If parent not found, it means session_id is invalid or not initialized
-                    raise SessionNotFoundError(f"Parent session {session_id} not found.")
-
-                conversation = Conversation.query.filter_by(
-                    parent_id=session_id,
-                    status='active'
-                ).first()
-                
-                if not conversation:
-                    # Create new conversation
-                    # Ensure parent has children. If not, you might need to create a dummy child first.
-                    child_id = parent.children[0].id if parent.children else None
-                    if not child_id:
-                        logger.warning(f"No child associated with parent {parent.id} for new conversation. Creating a dummy child.")
-                        # Create a default child if none exists
-                        new_child = Child(
-                            name="ילד_ברירת_מחדל", # Default child name
-                            gender="לא צוין",
-                            age=15,
-                            parent_id=parent.id,
-                            created_at=datetime.now(timezone.utc)
-                        )
-                        db.session.add(new_child)
-                        db.session.flush() # Get ID for current transaction
-                        child_id = new_child.id
-
-                    conversation = Conversation(
-                        parent_id=session_id,
-                        child_id=child_id,
-                        topic=questionnaire_data.get('main_challenge', 'שיחה כללית')
-                    )
-                    db.session.add(conversation)
-                    db.session.flush() # Get ID without committing yet
-
-                if message != "START_CONVERSATION":
-                    user_message = Message(
-                        conversation_id=conversation.id,
-                        sender_type='user',
-                        content=message
-                    )
-                    db.session.add(user_message)
-                    db.session.commit()
-                    
-        except Exception as db_error:
-            logger.error(f"Database error in chat: {db_error}")
-            db.session.rollback() # Rollback transaction if any error occurs
-            raise DatabaseError(f"Failed to interact with database: {db_error}")
-
+        session_id, message = parse_chat_payload(data)
+        use_cache = cache_allowed(data, request.headers.get('Cache-Control'))
+        questionnaire_data, conversation_id, history = prepare_chat_turn(session_id, message)
 
         def generate_response_stream():
-            current_conversation = conversation
-            
+            metrics.ACTIVE_STREAMS.inc()
             try:
-                if model:
-                    try:
-                        context = ""
-                        if questionnaire_data:
-                            context = f"""
-הורה: {questionnaire_data.get('parent_name', 'הורה')}
-ילד/ה: {questionnaire_data.get('child_name', 'ילד/ה')} בן/בת {questionnaire_data.get('child_age', 'לא ידוע')}
-אתגר עיקרי: {questionnaire_data.get('main_challenge', 'לא צוין')}
-רמת מצוקה: {questionnaire_data.get('distress_level', 'לא צוין')}/10
-ניסיונות קודמים: {questionnaire_data.get('past_solutions', 'לא צוין')}
-מטרת השיחה: {questionnaire_data.get('goal', 'לא צוין')}
-"""
-
-                        prompt = f"""
-אתה יונתן, פסיכו-בוט חינוכי מתקדם המתמחה בהורות למתבגרים ומבוסס על עקרונות CBT.
-
-{context}
-
-עקרונות התגובה שלך:
-1. הגב בעברית בלבד עם טון חם, תומך ומקצועי
-2. השתמש בעקרונות CBT: זיהוי מחשבות, אתגור אמונות, שינוי התנהגות
-3. תן כלים פרקטיים ומעשיים שאפשר ליישם מיד
-4. השתמש בפורמט CARD[כותרת|תוכן] לטיפים חשובים
-5. הוסף כפתורי הצעה בפורמט [טקסט כפתור] לפעולות נוספות
-6. התמקד בפתרונות ולא בבעיות
-7. הכר ברגשות ההורה ותן legitimacy למצוקה
-8. תן דוגמאות קונקרטיות ומעשיות
-
-הודעת המשתמש: {message}
-"""
+                fallback_future = None
+                # Before the breaker: cached answers are served while it is open, and a hit never takes the half-open probe
+                cacheable = is_cacheable_turn(use_cache, history)
+                cached_response = response_cache.get(message, questionnaire_data) if cacheable else None
+                if cached_response:
+                    metrics.CHAT_TIME_TO_FIRST_CHUNK.labels(source='cache').observe(time.perf_counter() - turn_started)
+                    yield cached_response
+                    save_bot_message(conversation_id, cached_response)
+                    return
 
-                        response_ai = model.generate_content(prompt)
-                        
-                        if response_ai and response_ai.text:
-                            full_response = response_ai.text
-                            
-                            try:
-                                if current_conversation:
-                                    with app.app_context(): # Ensure app context for DB commit
-                                        bot_message = Message(
-                                            conversation_id=current_conversation.id,
-                                            sender_type='bot',
-                                            content=full_response
-                                        )
-                                        db.session.add(bot_message)
-                                        current_conversation.update_message_count()
-                                        db.session.commit()
-                            except Exception as save_error:
-                                logger.warning(f"Could not save message to DB: {save_error}")
-                                db.session.rollback()
-                            
-                            chunk_size = 50
-                            for i in range(0, len(full_response), chunk_size):
-                                chunk = full_response[i:i+chunk_size]
-                                yield chunk
-                            return
-                            
+                if model and ai_circuit.allow():
+                    # Ready by the time a missed deadline or an AI error needs it
+                    fallback_future = run_in_background(speculative_fallback, message, session_id, questionnaire_data)
+                    collected_chunks = []
+                    ai_completed = False
+                    try:
+                        prompt = build_chat_prompt(questionnaire_data, message, history)
+                        for chunk in stream_with_deadline(lambda: stream_ai_response(prompt), app.config['FALLBACK_TIMEOUT']):
+                            if not collected_chunks:
+                                metrics.CHAT_TIME_TO_FIRST_CHUNK.labels(source='ai').observe(time.perf_counter() - turn_started)
+                            collected_chunks.append(chunk)
+                            yield chunk
+                        ai_completed = True
+                        ai_circuit.record_success()
                     except Exception as ai_error:
                         logger.error(f"AI model error: {ai_error}")
-                        # Fall through to fallback system
-
-                if advanced_fallback_system:
-                    fallback_response = advanced_fallback_system.get_fallback_response(
-                        user_input=message, session_id=session_id, questionnaire_data=questionnaire_data
-                    )
-                    
-                    try:
-                        if current_conversation:
-                            with app.app_context(): # Ensure app context for DB commit
-                                bot_message = Message(
-                                    conversation_id=current_conversation.id,
-                                    sender_type='bot',
-                                    content=fallback_response
-                                )
-                                db.session.add(bot_message)
-                                current_conversation.update_message_count()
-                                db.session.commit()
-                    except Exception as save_error:
-                        logger.warning(f"Could not save fallback message to DB: {save_error}")
-                        db.session.rollback()
-                    
-                    chunk_size = 50
-                    for i in range(0, len(fallback_response), chunk_size):
-                        chunk = fallback_response[i:i+chunk_size]
-                        yield chunk
-                    return
-                
-                basic_response = "שלום! אני יונתן. מצטער, יש לי קושי טכני כרגע, אבל אני כאן לעזור לך. איך אני יכול לסייע?"
-                yield basic_response
+                        ai_circuit.record_failure(ai_error)
+                        # Fall through to fallback system only if nothing was sent yet
+
+                    if collected_chunks:
+                        full_response = "".join(collected_chunks)
+                        if ai_completed and cacheable:
+                            response_cache.set(message, questionnaire_data, full_response)
+                        save_bot_message(conversation_id, full_response)
+                        return
+
+                if fallback_future is not None:
+                    fallback_response = serve_speculative_fallback(fallback_future.result())
+                else:
+                    fallback_response = get_fallback_text(message, session_id, questionnaire_data)
+                metrics.CHAT_TIME_TO_FIRST_CHUNK.labels(source='fallback').observe(time.perf_counter() - turn_started)
+                yield fallback_response
+                save_bot_message(conversation_id, fallback_response)
                 
             except Exception as e:
                 logger.error(f"Error in generate_response_stream: {e}")
-                error_response = "מצטער, אירעה שגיאה טכנית. אנא נסה שוב."
-                yield error_response
+                yield STREAM_ERROR_RESPONSE
+            finally:
+                metrics.ACTIVE_STREAMS.dec()
 
         return Response(
-            generate_response_stream(),
+            stream_with_context(generate_response_stream()),
             mimetype='text/plain',
-            headers={
-                'Cache-Control': 'no-cache',
-                'Connection': 'keep-alive',
-                'X-Accel-Buffering': 'no'
-            }
+            headers=STREAM_HEADERS
         )
 
     except ValidationError as e:
         db.session.rollback()
-        return jsonify({"error": "נתונים לא תקינים", "details": e.messages}), 400
+        return jsonify({"error": e.user_message, "details": e.error_details}), e.status_code
     except BotError as e:
         db.session.rollback()
         return jsonify(e.to_dict()), e.status_code
@@ -421,39 +572,151 @@ def chat():
         error = handle_generic_error(e)
         return jsonify(error.to_dict()), error.status_code
 
-# Health check endpoint
-@app.route('/api/health', methods=['GET'])
-def health_check():
-    """Health check endpoint to verify service status."""
-    db_connected = False
+@app.route('/api/history', methods=['GET'])
+@limiter.limit("60 per minute")
+def conversation_history_page():
+    """Streams one keyset page of a conversation's messages (newest first by default).
+
+    Query: session_id, conversation_id (default: the session's active
+    conversation), cursor (next_cursor of the previous page), limit, order.
+    """
     try:
-        with db.engine.connect() as connection:
-            connection.execute(db.text("SELECT 1"))
-        db_connected = True
-    except Exception as e:
-        logger.error(f"Database health check failed: {e}")
-        db_connected = False
+        session_id = request.args.get('session_id', '')
+        if not validate_session_id(session_id):
+            raise ValidationError("Invalid session_id", user_message="session_id לא תקין")
 
-    ai_model_working = False
-    if model:
         try:
-            response = model.generate_content("hello")
-            if response and response.text:
-                ai_model_working = True
-        except Exception as e:
-            logger.error(f"AI model health check failed: {e}")
-            ai_model_working = False
-    
-    fallback_system_available = advanced_fallback_system is not None
+            limit = int(request.args.get('limit', app.config['HISTORY_PAGE_SIZE']))
+            conversation_id = request.args.get('conversation_id')
+            if conversation_id is not None:
+                conversation_id = int(conversation_id)
+        except ValueError:
+            raise ValidationError("Invalid history paging parameters", user_message="פרמטרי דפדוף לא תקינים")
+        limit = max(1, min(limit, app.config['HISTORY_MAX_PAGE_SIZE']))
+
+        if conversation_id is None:
+            context = get_session_context(session_id)
+            if context is None:
+                raise SessionNotFoundError(f"Parent session {session_id} not found.")
+            if not context.conversation_id:
+                return jsonify({"conversation_id": None, "messages": [], "count": 0, "next_cursor": None}), 200
+            conversation_id = context.conversation_id
+
+        page = open_history_page(
+            session_id, conversation_id,
+            cursor=request.args.get('cursor'),
+            limit=limit,
+            order=request.args.get('order', 'desc')
+        )
+        return Response(
+            stream_with_context(page),
+            mimetype='application/json',
+            headers={'Cache-Control': 'no-store'}
+        )
+
+    except BotError as e:
+        db.session.rollback()
+        return jsonify(e.to_dict()), e.status_code
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Unexpected error in history endpoint: {e}")
+        error = handle_generic_error(e)
+        return jsonify(error.to_dict()), error.status_code
+
+@app.route('/api/export', methods=['GET'])
+@limiter.limit("2 per minute")
+def export_parent_data():
+    """Streams everything stored for the session's parent as NDJSON (privacy / data access requests)."""
+    try:
+        session_id = request.args.get('session_id', '')
+        if not validate_session_id(session_id):
+            raise ValidationError("Invalid session_id", user_message="session_id לא תקין")
+
+        lines = open_parent_export(session_id)
+        filename = f"export-{session_id[:8]}-{datetime.now(timezone.utc):%Y%m%d}.ndjson"
+        return Response(
+            stream_with_context(lines),
+            mimetype='application/x-ndjson',
+            headers={
+                'Cache-Control': 'no-store',
+                'Content-Disposition': f'attachment; filename="{filename}"',
+                'X-Accel-Buffering': 'no'
+            }
+        )
+
+    except BotError as e:
+        db.session.rollback()
+        return jsonify(e.to_dict()), e.status_code
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Unexpected error in export endpoint: {e}")
+        error = handle_generic_error(e)
+        return jsonify(error.to_dict()), error.status_code
+
+# Metrics endpoint (Prometheus text exposition) - 404 unless ENABLE_METRICS
+@app.route('/api/metrics', methods=['GET'])
+@limiter.exempt
+def metrics_endpoint():
+    """Exposes Prometheus metrics aggregated across workers."""
+    if not metrics.METRICS_ENABLED:
+        return jsonify({"error": "Metrics are disabled"}), 404
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
+
+# Profiling window - samples every thread of the worker that receives it
+@app.route('/api/profiling/window', methods=['POST'])
+@limiter.limit("5 per minute")
+@csrf.exempt
+def open_profiling_window():
+    """Starts a time-boxed profiling window on this worker (requires X-Profile token)."""
+    if not request_profiler.enabled or not request_profiler.token_matches(request.headers.get('X-Profile')):
+        return jsonify({"error": "Not found"}), 404
+    data = request.get_json(silent=True) or {}
+    try:
+        seconds = float(data.get('seconds', 30))
+    except (TypeError, ValueError):
+        return jsonify({"error": "seconds must be a number"}), 400
+    if not request_profiler.open_window(seconds):
+        return jsonify({"error": "A profiling window is already open"}), 409
+    return jsonify({"status": "profiling", "pid": os.getpid(), **request_profiler.get_stats()}), 200
+
+# Health check endpoints - answer from the prober's cached results, no Gemini call per hit
+@app.route('/api/health', methods=['GET'])
+@limiter.exempt
+def health_check():
+    """Health check endpoint to verify service status."""
+    health_prober.ensure_started()
+    snapshot = health_prober.snapshot()
 
     return jsonify({
-        "status": "healthy",
-        "database_connected": db_connected,
-        "ai_model_working": ai_model_working,
-        "fallback_system_available": fallback_system_available,
+        "status": "healthy" if health_prober.ready else "degraded",
+        "database_connected": snapshot['database']['ok'],
+        "ai_model_working": snapshot['ai_model']['ok'],
+        "fallback_system_available": advanced_fallback_system is not None,
+        "ai_circuit": ai_circuit.get_stats(),
+        "ai_calls": ai_calls.get_stats(),
+        "background_tasks": background_tasks.get_stats(),
+        "checks": snapshot,
         "timestamp": datetime.now(timezone.utc).isoformat()
     }), 200
 
+@app.route('/api/health/live', methods=['GET'])
+@limiter.exempt
+def liveness_check():
+    """Liveness probe: the process is up and serving requests."""
+    return jsonify({"status": "alive"}), 200
+
+@app.route('/api/health/ready', methods=['GET'])
+@limiter.exempt
+def readiness_check():
+    """Readiness probe: 503 until the database answers (the AI is optional thanks to fallback)."""
+    health_prober.ensure_started()
+    ready = health_prober.ready
+    return jsonify({
+        "status": "ready" if ready else "not_ready",
+        "checks": health_prober.snapshot()
+    }), 200 if ready else 503
+
 # Main entry point for running the app directly (for development)
 if __name__ == '__main__':
     app.run(debug=current_config.DEBUG, host='0.0.0.0', port=5000)
\ No newline at end of file
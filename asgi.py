@@ -0,0 +1,295 @@
+# asgi.py - נקודת כניסה אסינכרונית ליונתן הבוט
+"""
+ASGI entry point that serves /api/chat on an asyncio event loop.
+
+The long part of every chat turn is waiting on Gemini while it streams tokens.
+Under the sync Flask route each of those waits pins a gunicorn worker; here it
+is an `await`, so a single process can keep hundreds of conversations in
+flight. Short blocking work (SQLAlchemy queries, the rate limiter storage) runs
+in the default thread pool via `asyncio.to_thread`.
+
+Every other route is delegated unchanged to the Flask app.
+
+Run with:
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+or:
+    gunicorn asgi:application -k uvicorn.workers.UvicornWorker
+"""
+
+import asyncio
+import json
+import logging
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from asgiref.wsgi import WsgiToAsgi
+from limits import parse as parse_rate_limit
+
+import app as chat_app
+import metrics
+from ai_guard import ai_circuit, stream_with_deadline_async
+from ai_limiter import ai_calls
+from app import app, limiter
+from conversation_history import ConversationHistory
+from errors import BotError, RateLimitExceededError, ValidationError, handle_generic_error
+from message_writer import message_writer
+from response_cache import cache_allowed, response_cache
+
+logger = logging.getLogger(__name__)
+
+# The sync /api/chat route's limit and bucket (Flask-Limiter scopes a route limit by its endpoint name),
+# so a client has one budget whichever entry point serves it
+CHAT_RATE_LIMIT = parse_rate_limit(app.config['CHAT_RATE_LIMIT'])
+CHAT_RATE_LIMIT_SCOPE = 'chat'
+
+flask_application = WsgiToAsgi(app)
+
+
+# --- ASGI helpers ---
+
+def _get_header(scope: Dict[str, Any], name: bytes) -> Optional[str]:
+    """Read a request header from the ASGI scope"""
+    for key, value in scope.get('headers', []):
+        if key.lower() == name:
+            return value.decode('latin-1')
+    return None
+
+def _response_headers(scope: Dict[str, Any], content_type: str, extra: Optional[Dict[str, str]] = None) -> List[Tuple[bytes, bytes]]:
+    """Build response headers including security and CORS headers"""
+    headers = {'Content-Type': content_type}
+    headers.update(app.config.get('SECURITY_HEADERS', {}))
+    if extra:
+        headers.update(extra)
+
+    origin = _get_header(scope, b'origin')
+    if origin and origin in app.config.get('CORS_ORIGINS', []):
+        headers['Access-Control-Allow-Origin'] = origin
+        headers['Vary'] = 'Origin'
+
+    return [(key.encode('latin-1'), value.encode('latin-1')) for key, value in headers.items()]
+
+async def _read_body(receive, max_length: int) -> bytes:
+    """Read the full request body, refusing anything above max_length"""
+    body = b''
+    more_body = True
+    while more_body:
+        event = await receive()
+        if event['type'] == 'http.disconnect':
+            raise ConnectionError("Client disconnected before sending the body")
+        body += event.get('body', b'')
+        if len(body) > max_length:
+            raise ValidationError("Request body too large", status_code=413, user_message="הבקשה גדולה מדי")
+        more_body = event.get('more_body', False)
+    return body
+
+async def _send_json(scope: Dict[str, Any], send, payload: Dict[str, Any], status: int):
+    """Send a complete JSON response"""
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': _response_headers(scope, 'application/json; charset=utf-8')
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+def _hit_rate_limit(client_ip: str) -> bool:
+    """Consume one unit of the chat rate limit for this client"""
+    return limiter.limiter.hit(CHAT_RATE_LIMIT, client_ip, CHAT_RATE_LIMIT_SCOPE)
+
+def _save_bot_message(conversation_id: int, content: str):
+    """Persist the bot reply from a worker thread"""
+    with app.app_context():
+        chat_app.save_bot_message(conversation_id, content)
+
+
+# --- Async chat pipeline ---
+
+def stream_ai_response_async(prompt: str) -> AsyncIterator[str]:
+    """Yield text chunks from Gemini - an identical prompt already in flight is shared, not re-sent"""
+    return ai_calls.stream_async(prompt, lambda: _stream_gemini_async(prompt))
+
+async def _stream_gemini_async(prompt: str) -> AsyncIterator[str]:
+    """Yield text chunks from Gemini without blocking the event loop"""
+    with metrics.track_gemini_call():
+        response_ai = await chat_app.model.generate_content_async(prompt, stream=True)
+        async for chunk in response_ai:
+            try:
+                text = chunk.text
+            except ValueError:
+                # Chunk without text parts (e.g. safety block or finish marker)
+                continue
+            if text:
+                yield text
+
+def _retrieve_task_exception(task: asyncio.Task):
+    # An unused speculative task must not log "Task exception was never retrieved"
+    if not task.cancelled() and task.exception() is not None:
+        logger.debug(f"Speculative fallback failed: {task.exception()}")
+
+async def generate_response_stream_async(session_id: str,
+                                         message: str,
+                                         questionnaire_data: Dict[str, Any],
+                                         conversation_id: int,
+                                         turn_started: float,
+                                         history: Optional[ConversationHistory] = None,
+                                         use_cache: bool = True) -> AsyncIterator[str]:
+    """Async counterpart of the chat route's generate_response_stream()"""
+    metrics.ACTIVE_STREAMS.inc()
+    fallback_task = None
+    try:
+        # Before the breaker: cached answers are served while it is open, and a hit never takes the half-open probe
+        cacheable = chat_app.is_cacheable_turn(use_cache, history)
+        cached_response = response_cache.get(message, questionnaire_data) if cacheable else None
+        if cached_response:
+            metrics.CHAT_TIME_TO_FIRST_CHUNK.labels(source='cache').observe(time.perf_counter() - turn_started)
+            yield cached_response
+            await asyncio.to_thread(_save_bot_message, conversation_id, cached_response)
+            return
+
+        if chat_app.model and ai_circuit.allow():
+            # Ready by the time a missed deadline or an AI error needs it
+            fallback_task = asyncio.create_task(asyncio.to_thread(
+                chat_app.speculative_fallback, message, session_id, questionnaire_data
+            ))
+            fallback_task.add_done_callback(_retrieve_task_exception)
+            collected_chunks = []
+            ai_completed = False
+            try:
+                prompt = chat_app.build_chat_prompt(questionnaire_data, message, history)
+                deadline = app.config['FALLBACK_TIMEOUT']
+                async for chunk in stream_with_deadline_async(stream_ai_response_async(prompt), deadline):
+                    if not collected_chunks:
+                        metrics.CHAT_TIME_TO_FIRST_CHUNK.labels(source='ai').observe(time.perf_counter() - turn_started)
+                    collected_chunks.append(chunk)
+                    yield chunk
+                ai_completed = True
+                ai_circuit.record_success()
+            except Exception as ai_error:
+                logger.error(f"AI model error: {ai_error}")
+                ai_circuit.record_failure(ai_error)
+                # Fall through to fallback system only if nothing was sent yet
+
+            if collected_chunks:
+                full_response = "".join(collected_chunks)
+                if ai_completed and cacheable:
+                    response_cache.set(message, questionnaire_data, full_response)
+                await asyncio.to_thread(_save_bot_message, conversation_id, full_response)
+                return
+
+        if fallback_task is not None:
+            fallback_response = await asyncio.to_thread(chat_app.serve_speculative_fallback, await fallback_task)
+        else:
+            # State-store I/O - off the event loop
+            fallback_response = await asyncio.to_thread(chat_app.get_fallback_text, message, session_id, questionnaire_data)
+        metrics.CHAT_TIME_TO_FIRST_CHUNK.labels(source='fallback').observe(time.perf_counter() - turn_started)
+        yield fallback_response
+        await asyncio.to_thread(_save_bot_message, conversation_id, fallback_response)
+
+    except Exception as e:
+        logger.error(f"Error in generate_response_stream_async: {e}")
+        yield chat_app.STREAM_ERROR_RESPONSE
+    finally:
+        if fallback_task is not None and not fallback_task.done():
+            # Gemini answered (or the client left) - the speculative fallback is not needed
+            fallback_task.cancel()
+        metrics.ACTIVE_STREAMS.dec()
+
+async def chat_endpoint(scope: Dict[str, Any], receive, send):
+    """Async /api/chat: validation, DB lookups, AI call, persistence and streaming"""
+    turn_started = time.perf_counter()
+    try:
+        content_type = _get_header(scope, b'content-type') or ''
+        if 'application/json' not in content_type:
+            await _send_json(scope, send, {"error": "הבקשה חייבת להיות בפורמט JSON"}, 400)
+            return
+
+        client = scope.get('client')
+        client_ip = client[0] if client else '127.0.0.1'
+        if app.config.get('RATELIMIT_ENABLED', True):
+            if not await asyncio.to_thread(_hit_rate_limit, client_ip):
+                raise RateLimitExceededError(f"Chat rate limit exceeded for {client_ip}")
+
+        body = await _read_body(receive, app.config.get('MAX_CONTENT_LENGTH') or 16 * 1024 * 1024)
+        try:
+            data = json.loads(body or b'null')
+        except ValueError:
+            raise ValidationError("Malformed JSON body", user_message="נתוני JSON חסרים")
+
+        session_id, message = chat_app.parse_chat_payload(data)
+        use_cache = cache_allowed(data, _get_header(scope, b'cache-control'))
+        questionnaire_data, conversation_id, history = await asyncio.to_thread(
+            chat_app.prepare_chat_turn, session_id, message
+        )
+
+    except ValidationError as e:
+        await _send_json(scope, send, {"error": e.user_message, "details": e.error_details}, e.status_code)
+        return
+    except BotError as e:
+        await _send_json(scope, send, e.to_dict(), e.status_code)
+        return
+    except ConnectionError:
+        return
+    except Exception as e:
+        logger.error(f"Unexpected error in async chat endpoint: {e}")
+        error = handle_generic_error(e)
+        await _send_json(scope, send, error.to_dict(), error.status_code)
+        return
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': _response_headers(scope, 'text/plain; charset=utf-8', chat_app.STREAM_HEADERS)
+    })
+    stream = generate_response_stream_async(session_id, message, questionnaire_data, conversation_id,
+                                            turn_started, history, use_cache)
+    try:
+        async for chunk in stream:
+            await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        await stream.aclose()
+
+async def instrumented_chat_endpoint(scope: Dict[str, Any], receive, send):
+    """chat_endpoint with request latency and per-request DB metrics (Flask routes get these from hooks)"""
+    started = time.perf_counter()
+    status = 500
+
+    async def send_and_record(event: Dict[str, Any]):
+        nonlocal status
+        if event['type'] == 'http.response.start':
+            status = event['status']
+        await send(event)
+
+    # asyncio.to_thread copies the context, so DB work in worker threads lands in these stats
+    db_stats = metrics.start_request_db_stats()
+    try:
+        await chat_endpoint(scope, receive, send_and_record)
+    finally:
+        metrics.REQUEST_LATENCY.labels(endpoint='/api/chat', method='POST', status=str(status)).observe(
+            time.perf_counter() - started
+        )
+        metrics.finish_request_db_stats('/api/chat', db_stats)
+
+async def lifespan(scope: Dict[str, Any], receive, send):
+    """Minimal lifespan protocol support (WsgiToAsgi does not implement it)"""
+    while True:
+        event = await receive()
+        if event['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif event['type'] == 'lifespan.shutdown':
+            await asyncio.to_thread(message_writer.close)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope: Dict[str, Any], receive, send):
+    """ASGI application: async /api/chat, everything else handled by Flask"""
+    if scope['type'] == 'lifespan':
+        await lifespan(scope, receive, send)
+    elif scope['type'] == 'http' and scope['path'] == '/api/chat' and scope['method'] == 'POST':
+        if metrics.METRICS_ENABLED:
+            await instrumented_chat_endpoint(scope, receive, send)
+        else:
+            await chat_endpoint(scope, receive, send)
+    else:
+        await flask_application(scope, receive, send)
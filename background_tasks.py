@@ -0,0 +1,350 @@
+# background_tasks.py - ניתוח שיחה ברקע אחרי כל תור (מופעל עם ENABLE_BACKGROUND_TASKS)
+"""
+Post-turn analytics, off the request path.
+
+With ENABLE_BACKGROUND_TASKS=true every chat turn schedules
+`analyze_conversation(conversation_id)` once the reply has been streamed and
+saved. The task fills the analytics columns nothing else writes:
+
+- Message.sentiment_score / toxicity_score - text_analytics lexicon scores
+- Message.response_time - seconds since the previous message in the conversation
+- Conversation.avg_response_time - average response_time of the bot replies
+- Conversation.tags - topics (ChallengeCategory values) found in the parent's messages
+
+A message with sentiment_score NULL has not been analysed yet. Each run picks
+up every such message in the conversation, so the task is idempotent, and a
+turn whose rows were still in the write-behind queue is covered by the next
+run. BACKGROUND_TASK_DELAY (seconds) gives queued rows time to land first.
+
+Broker (BACKGROUND_TASK_BROKER):
+- local (default): an in-process queue with one worker thread per web worker.
+  It is the stand-in broker for development and small deployments. Pending
+  runs are deduplicated per conversation and lost on restart, which is
+  harmless because the next turn picks the messages up.
+- a Celery broker URL (e.g. redis://localhost:6379/1): tasks go to Celery -
+  run `celery -A celery_worker.celery_app worker`.
+
+Scheduling is a deque append or one broker publish. The chat turn never waits
+for the analytics themselves.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Iterator, Optional, Set, Tuple
+
+from sqlalchemy import and_, bindparam, func, or_, select, update
+
+from config import ADVANCED_SETTINGS
+from models import db, Conversation, Message
+from text_analytics import detect_topics, score_batch
+import metrics
+
+logger = logging.getLogger(__name__)
+
+BACKGROUND_TASKS_ENABLED = ADVANCED_SETTINGS['ENABLE_BACKGROUND_TASKS']
+
+try:
+    from celery import Celery
+    CELERY_AVAILABLE = True
+except ImportError:
+    CELERY_AVAILABLE = False
+
+# Messages analysed per statement batch
+ANALYTICS_BATCH_SIZE = 500
+
+def analyze_conversation(conversation_id: int, batch_size: int = ANALYTICS_BATCH_SIZE) -> int:
+    """ניתוח ההודעות שטרם נותחו בשיחה ועדכון סיכומי השיחה. מחזיר את מספר ההודעות שנותחו (דורש app context)"""
+    message = Message.__table__
+    conversation = Conversation.__table__
+    analysed = 0
+
+    while True:
+        rows = db.session.execute(
+            select(message.c.id, message.c.sender_type, message.c.content, message.c.timestamp)
+            .where(message.c.conversation_id == conversation_id, message.c.sentiment_score.is_(None))
+            .order_by(message.c.timestamp, message.c.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+
+        first = rows[0]
+        previous = db.session.scalar(
+            select(message.c.timestamp)
+            .where(
+                message.c.conversation_id == conversation_id,
+                or_(
+                    message.c.timestamp < first.timestamp,
+                    and_(message.c.timestamp == first.timestamp, message.c.id < first.id)
+                )
+            )
+            .order_by(message.c.timestamp.desc(), message.c.id.desc())
+            .limit(1)
+        )
+
+        values = []
+        for row, (sentiment, toxicity) in zip(rows, score_batch([row.content for row in rows])):
+            response_time = None
+            if previous is not None and row.timestamp is not None:
+                response_time = max(0.0, (row.timestamp - previous).total_seconds())
+            previous = row.timestamp
+            values.append({
+                'message_id': row.id,
+                'b_sentiment': sentiment,
+                'b_toxicity': toxicity,
+                'b_response_time': response_time
+            })
+
+        try:
+            db.session.execute(
+                update(message)
+                .where(message.c.id == bindparam('message_id'))
+                .values(
+                    sentiment_score=bindparam('b_sentiment'),
+                    toxicity_score=bindparam('b_toxicity'),
+                    response_time=bindparam('b_response_time')
+                ),
+                values
+            )
+
+            tags = json.loads(db.session.scalar(
+                select(conversation.c.tags).where(conversation.c.id == conversation_id)
+            ) or '[]')
+            for topic in detect_topics(row.content for row in rows if row.sender_type == 'user'):
+                if topic not in tags:
+                    tags.append(topic)
+
+            avg_response_time = (
+                select(func.avg(message.c.response_time))
+                .where(
+                    message.c.conversation_id == conversation_id,
+                    message.c.sender_type == 'bot',
+                    message.c.response_time.isnot(None)
+                )
+                .scalar_subquery()
+            )
+            db.session.execute(
+                update(conversation)
+                .where(conversation.c.id == conversation_id)
+                .values(
+                    avg_response_time=avg_response_time,
+                    tags=json.dumps(tags, ensure_ascii=False) if tags else None
+                )
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        analysed += len(rows)
+        if len(rows) < batch_size:
+            break
+
+    return analysed
+
+def backfill_message_scores(chunk_size: int = 5000, rescore: bool = False) -> Iterator[Tuple[int, float]]:
+    """ציון כל טבלת ההודעות בסדר id, chunk לכל טרנזקציה. מחזיר (הודעות ב-chunk, שניות חישוב) לכל chunk (דורש app context)
+
+    Keyset pagination on the primary key keeps every chunk an index range scan,
+    however far the backfill has progressed. Only sentiment_score and
+    toxicity_score are written - response_time is left to analyze_conversation.
+    """
+    message = Message.__table__
+    last_id = 0
+    while True:
+        query = select(message.c.id, message.c.content).where(message.c.id > last_id)
+        if not rescore:
+            query = query.where(message.c.sentiment_score.is_(None))
+        rows = db.session.execute(query.order_by(message.c.id).limit(chunk_size)).all()
+        if not rows:
+            return
+
+        started = time.perf_counter()
+        scores = score_batch([row.content for row in rows])
+        scoring_seconds = time.perf_counter() - started
+
+        try:
+            db.session.execute(
+                update(message)
+                .where(message.c.id == bindparam('message_id'))
+                .values(sentiment_score=bindparam('b_sentiment'), toxicity_score=bindparam('b_toxicity')),
+                [
+                    {'message_id': row.id, 'b_sentiment': sentiment, 'b_toxicity': toxicity}
+                    for row, (sentiment, toxicity) in zip(rows, scores)
+                ]
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        last_id = rows[-1].id
+        yield len(rows), scoring_seconds
+
+class LocalTaskRunner:
+    """ברוקר מקומי: תור בזיכרון ו-thread אחד לכל worker"""
+
+    def __init__(self, app, delay: float, max_queue: int):
+        self.app = app
+        self.delay = delay
+        self.max_queue = max_queue
+        self._queue: Deque[Tuple[float, int]] = deque()
+        self._pending: Set[int] = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def _ensure_started(self):
+        # Threads don't survive a fork - start one per worker process
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            if self._pid != os.getpid():
+                self._queue.clear()
+                self._pending.clear()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='background-tasks', daemon=True)
+            self._thread.start()
+
+    def submit(self, conversation_id: int) -> bool:
+        """תזמון ניתוח לשיחה. False אם התור מלא"""
+        self._ensure_started()
+        with self._lock:
+            if conversation_id in self._pending:
+                return True
+            if len(self._queue) >= self.max_queue:
+                self.dropped += 1
+                return False
+            self._pending.add(conversation_id)
+            self._queue.append((time.monotonic() + self.delay, conversation_id))
+        self._wakeup.set()
+        return True
+
+    def _next(self) -> Optional[int]:
+        with self._lock:
+            if not self._queue:
+                return None
+            ready_at, conversation_id = self._queue[0]
+            wait = ready_at - time.monotonic()
+            if wait <= 0:
+                self._queue.popleft()
+                self._pending.discard(conversation_id)
+                return conversation_id
+        # FIFO with a fixed delay - the head is always the first to become ready
+        time.sleep(wait)
+        return self._next()
+
+    def _run(self):
+        while True:
+            conversation_id = self._next()
+            if conversation_id is None:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            try:
+                with self.app.app_context():
+                    analyze_conversation(conversation_id)
+                self.completed += 1
+                metrics.BACKGROUND_TASKS.labels(task='analyze_conversation', outcome='ok').inc()
+            except Exception as e:
+                self.failed += 1
+                metrics.BACKGROUND_TASKS.labels(task='analyze_conversation', outcome='error').inc()
+                logger.error(f"Conversation {conversation_id} analytics failed: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            queued = len(self._queue)
+        return {
+            'broker': 'local',
+            'queued': queued,
+            'completed': self.completed,
+            'failed': self.failed,
+            'dropped': self.dropped
+        }
+
+class BackgroundTasks:
+    """נקודת התזמון של משימות הרקע - ברוקר מקומי או Celery"""
+
+    def __init__(self):
+        self.enabled = False
+        self.celery = None
+        self._celery_task = None
+        self._local: Optional[LocalTaskRunner] = None
+        self.delay = 2.0
+
+    def init_app(self, app):
+        """הגדרה לפי האפליקציה"""
+        self.enabled = BACKGROUND_TASKS_ENABLED
+        if not self.enabled:
+            return
+        self.delay = app.config.get('BACKGROUND_TASK_DELAY', 2.0)
+        broker = app.config.get('BACKGROUND_TASK_BROKER', 'local')
+
+        if broker != 'local' and not CELERY_AVAILABLE:
+            logger.warning("BACKGROUND_TASK_BROKER is set but celery is not installed - using the local broker")
+            broker = 'local'
+
+        if broker == 'local':
+            self._local = LocalTaskRunner(app, self.delay, app.config.get('BACKGROUND_TASK_MAX_QUEUE', 10000))
+        else:
+            self.celery = Celery('yonatan', broker=broker)
+            self.celery.conf.update(
+                task_ignore_result=True,
+                task_acks_late=True,
+                # Fail fast instead of stalling the chat worker when the broker is down
+                task_publish_retry=False,
+                broker_connection_timeout=2
+            )
+
+            @self.celery.task(name='yonatan.analyze_conversation')
+            def analyze_conversation_task(conversation_id: int):
+                with app.app_context():
+                    analyze_conversation(conversation_id)
+
+            self._celery_task = analyze_conversation_task
+
+        logger.info(f"✅ Background tasks enabled ({'local broker' if broker == 'local' else 'celery'})")
+
+    def schedule_turn_analytics(self, conversation_id: int):
+        """תזמון ניתוח השיחה אחרי תור שהסתיים - לא זורק ולא חוסם"""
+        if not self.enabled or not conversation_id:
+            return
+        try:
+            if self._local is not None:
+                queued = self._local.submit(conversation_id)
+            else:
+                self._celery_task.apply_async((conversation_id,), countdown=self.delay)
+                queued = True
+        except Exception as e:
+            logger.warning(f"Could not schedule analytics for conversation {conversation_id}: {e}")
+            queued = False
+        metrics.BACKGROUND_TASKS.labels(task='analyze_conversation', outcome='queued' if queued else 'dropped').inc()
+
+    def get_stats(self) -> Dict[str, Any]:
+        if not self.enabled:
+            return {'enabled': False}
+        if self._local is not None:
+            return {'enabled': True, **self._local.get_stats()}
+        return {'enabled': True, 'broker': 'celery'}
+
+# מופע גלובלי לכל worker
+background_tasks = BackgroundTasks()
+
+__all__ = [
+    'BACKGROUND_TASKS_ENABLED',
+    'analyze_conversation',
+    'backfill_message_scores',
+    'LocalTaskRunner',
+    'BackgroundTasks',
+    'background_tasks'
+]
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# bench_intent_matching.py - השוואת זיהוי כוונות ורגשות: מימוש ישן מול סריקה אחת
+"""
+Benchmark for AdvancedFallbackSystem intent/emotion detection.
+
+Compares the previous implementation (one re.search per pattern family plus
+a rebuilt emotion dict and a substring scan per keyword, reproduced below as
+a reference) with the single-pass PhraseMatcher, and checks both produce the
+same results on the corpus.
+
+Usage:
+    python benchmarks/bench_intent_matching.py [--iterations N]
+"""
+
+import argparse
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from advanced_fallback_system import AdvancedFallbackSystem  # noqa: E402
+
+# הודעות אופייניות של הורים (כולל הודעות ארוכות וכאלה שלא מזוהה בהן כלום)
+CORPUS = [
+    "שלום, אני צריך עזרה עם הבן שלי",
+    "הוא לא מקשיב לי בכלל, נמאס לי, אני לא יכול יותר",
+    "מה עושים כשהיא מסתגרת בחדר כל היום עם הטלפון?",
+    "כבר ניסיתי הכל וזה לא עוזר, אתה לא מבין את המצב שלי",
+    "אני כל כך מתוסכל וכועס, מספיק כבר עם הצעקות בבית",
+    "דחוף! הוא יצא מהבית ולא עונה לטלפון, אני מתמוטט",
+    "תודה רבה, זה עבד! השיחה אתמול הייתה טובה יותר",
+    "הבת שלי בת 15 ויש לה מבחן מחר והיא לא לומדת, איך מתמודדים עם זה?",
+    "אני דואג מה יהיה איתו בעתיד, הוא לא רוצה ללכת לבית הספר",
+    "אולי בואו ננסה לקבוע זמן מסך קבוע, יש לי תקווה שזה ישפר",
+    "הבעיה היא שאנחנו לא מדברים בכלל, הוא עונה רק במילה אחת",
+    "קשה לי לראות אותה עצובה ובוכה כל ערב, אני לא יודע מה לעשות",
+    "בוקר טוב יונתן",
+    "המצב הוא שהם רבים כל הזמן ואני עייף ומותש מזה, אין לי כוח",
+    "אני מרגיש רע שצעקתי עליו אתמול, איך אני מתקן את זה?",
+    "הילד לא מכבד, עונה בחוצפה ומתווכח על כל דבר קטן שאני מבקש ממנו לעשות בבית, "
+    "ואני כבר לא יודע איך להגיב בלי להתפרץ. ניסיתי לדבר בשקט, ניסיתי עונשים, "
+    "ניסיתי לוותר, ושום דבר לא עובד. מה אפשר לעשות?",
+    "ok",
+    "סתם רציתי לספר שהיה יום רגיל",
+]
+
+
+class LegacyDetector:
+    """המימוש הקודם של identify_intent / detect_emotional_state (להשוואה בלבד)"""
+
+    def __init__(self, intent_patterns):
+        self.intent_patterns = intent_patterns
+
+    def identify_intent(self, user_input):
+        user_input_lower = user_input.lower()
+        scores = {
+            "urgent_help": self._calculate_pattern_score(user_input_lower, self.intent_patterns["urgency"]),
+            "emotional_expression": self._calculate_pattern_score(user_input_lower, self.intent_patterns["emotional_expression"]),
+            "seeking_advice": self._calculate_pattern_score(user_input_lower, self.intent_patterns["seeking_advice"]),
+            "resistance": self._calculate_pattern_score(user_input_lower, self.intent_patterns["resistance"]),
+        }
+        if max(scores.values()) > 0:
+            intent = max(scores, key=scores.get)
+            return intent, scores[intent]
+        return "general_conversation", 0.5
+
+    def _calculate_pattern_score(self, text, patterns):
+        score = 0
+        for pattern in patterns:
+            if re.search(pattern, text):
+                score += 1
+        return score / len(patterns) if patterns else 0
+
+    def detect_emotional_state(self, user_input):
+        emotional_indicators = {
+            "stress": {
+                "keywords": ["מתח", "לחץ", "עייף", "מותש", "עמוס", "לא מספיק"],
+                "patterns": [r"אין לי כוח", r"מספיק לי", r"נמאס לי"]
+            },
+            "anger": {
+                "keywords": ["כועס", "זועם", "עצבני", "מתוסכל", "מרגיז"],
+                "patterns": [r"מספיק כבר", r"לא יכול יותר", r"מטריף אותי"]
+            },
+            "sadness": {
+                "keywords": ["עצוב", "מדוכא", "כואב", "קשה", "בוכה"],
+                "patterns": [r"לא יודע מה לעשות", r"מרגיש רע", r"כל כך קשה"]
+            },
+            "anxiety": {
+                "keywords": ["חרד", "דואג", "פחד", "מתרגש", "בהלה"],
+                "patterns": [r"מה יהיה", r"איך אני", r"מה אם"]
+            },
+            "hope": {
+                "keywords": ["מקווה", "רוצה לנסות", "יש אפשרות", "אולי"],
+                "patterns": [r"אם רק", r"בואו ננסה", r"יש לי תקווה"]
+            }
+        }
+        user_input_lower = user_input.lower()
+        emotion_scores = {}
+        for emotion, indicators in emotional_indicators.items():
+            score = 0
+            for keyword in indicators["keywords"]:
+                if keyword in user_input_lower:
+                    score += 1
+            for pattern in indicators["patterns"]:
+                if re.search(pattern, user_input_lower):
+                    score += 2
+            if score > 0:
+                emotion_scores[emotion] = score / (len(indicators["keywords"]) + len(indicators["patterns"]))
+        if not emotion_scores:
+            return "neutral", 0.5
+        dominant_emotion = max(emotion_scores, key=emotion_scores.get)
+        return dominant_emotion, emotion_scores[dominant_emotion]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Intent/emotion detection benchmark")
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    system = AdvancedFallbackSystem()
+    legacy = LegacyDetector(system.intent_patterns)
+
+    # בדיקת זהות תוצאות
+    for message in CORPUS:
+        expected = (legacy.identify_intent(message), legacy.detect_emotional_state(message))
+        actual = system.analyze_message(message)
+        if expected != actual:
+            print(f"❌ Mismatch for {message!r}: legacy={expected} new={actual}")
+            sys.exit(1)
+    print(f"✅ Results identical on {len(CORPUS)} messages")
+
+    def run_legacy():
+        for message in CORPUS:
+            legacy.identify_intent(message)
+            legacy.detect_emotional_state(message)
+
+    def run_matcher():
+        for message in CORPUS:
+            system.analyze_message(message)
+
+    calls = args.iterations * len(CORPUS)
+    legacy_time = min(timeit.repeat(run_legacy, number=args.iterations, repeat=3))
+    matcher_time = min(timeit.repeat(run_matcher, number=args.iterations, repeat=3))
+
+    print(f"legacy:  {legacy_time / calls * 1e6:8.2f} µs/message")
+    print(f"matcher: {matcher_time / calls * 1e6:8.2f} µs/message")
+    print(f"speedup: {legacy_time / matcher_time:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# load_chat.py - בדיקת עומס ל-/api/chat מול מודל Gemini מדומה
+"""
+Load test for the chat path.
+
+Starts the app in-process against a throwaway SQLite database with the Gemini
+model replaced by a local stand-in (configurable first-token latency, chunk
+pacing and error rate), then drives concurrent sessions through /api/init and
+/api/chat over real HTTP.
+
+Reports p50/p95/p99 time-to-first-byte and total latency, requests per second
+and DB queries per chat turn. Results are written as JSON so runs can be
+compared with --compare.
+
+Usage:
+    python benchmarks/load_chat.py [--sessions 20] [--turns 5] [--concurrency 20]
+                                   [--server wsgi|asgi] [--latency-ms 300]
+                                   [--chunk-ms 20] [--chunks 10] [--error-rate 0]
+                                   [--output results.json] [--compare baseline.json]
+"""
+
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import platform
+import random
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+MESSAGES = [
+    "שלום, אני צריך עזרה עם הבן שלי",
+    "הוא לא מקשיב לי בכלל, נמאס לי",
+    "מה עושים כשהיא מסתגרת בחדר כל היום עם הטלפון?",
+    "אני כל כך מתוסכל וכועס, מספיק כבר עם הצעקות בבית",
+    "הבת שלי בת 15 ויש לה מבחן מחר והיא לא לומדת, איך מתמודדים עם זה?",
+    "תודה רבה, זה עבד! השיחה אתמול הייתה טובה יותר",
+]
+
+
+# --- Gemini stand-in ---
+
+class StubChunk:
+    """חלק תגובה בממשק של google.generativeai"""
+
+    def __init__(self, text: str):
+        self.text = text
+
+class StubGenerativeModel:
+    """תחליף מקומי ל-genai.GenerativeModel עם השהיה ושיעור שגיאות מוגדרים"""
+
+    model_name = 'models/stub-gemini'
+
+    def __init__(self, latency_ms: float = 300, chunk_ms: float = 20, chunks: int = 10,
+                 error_rate: float = 0.0, seed: Optional[int] = None):
+        self.latency = latency_ms / 1000
+        self.chunk_delay = chunk_ms / 1000
+        self.chunks = chunks
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _should_fail(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def _chunk_text(self, index: int) -> str:
+        return f"CARD[טיפ {index + 1}|זוהי תשובת בדיקה מהמודל המדומה.] "
+
+    def generate_content(self, prompt: str, stream: bool = False, **kwargs):
+        time.sleep(self.latency)
+        if self._should_fail():
+            raise RuntimeError("stub model error")
+        if not stream:
+            return StubChunk("".join(self._chunk_text(i) for i in range(self.chunks)))
+        return self._stream()
+
+    def _stream(self):
+        for index in range(self.chunks):
+            if index:
+                time.sleep(self.chunk_delay)
+            yield StubChunk(self._chunk_text(index))
+
+    async def generate_content_async(self, prompt: str, stream: bool = False, **kwargs):
+        await asyncio.sleep(self.latency)
+        if self._should_fail():
+            raise RuntimeError("stub model error")
+        if not stream:
+            return StubChunk("".join(self._chunk_text(i) for i in range(self.chunks)))
+        return self._stream_async()
+
+    async def _stream_async(self):
+        for index in range(self.chunks):
+            if index:
+                await asyncio.sleep(self.chunk_delay)
+            yield StubChunk(self._chunk_text(index))
+
+
+# --- App under test ---
+
+class QueryCounter:
+    """ספירת שאילתות SQL שעוברות במנוע"""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        with self._lock:
+            self.count += 1
+
+def load_app(db_path: str, stub_model: StubGenerativeModel):
+    """ייבוא האפליקציה מול DB זמני ומודל מדומה"""
+    os.environ['FLASK_ENV'] = 'testing'
+    os.environ['TEST_DATABASE_URL'] = f"sqlite:///{db_path}"
+    os.environ.setdefault('GOOGLE_API_KEY', 'load-test-key')
+    # Keep the health prober's SELECT 1 out of the query counts
+    os.environ['HEALTH_DB_PROBE_INTERVAL'] = '86400'
+    os.environ['HEALTH_AI_PROBE_INTERVAL'] = '86400'
+
+    import app as app_module
+    from models import db
+
+    app_module.model = stub_model
+    with app_module.app.app_context():
+        db.create_all()
+    return app_module
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_server(server_type: str, port: int):
+    """הפעלת השרת ב-thread רקע"""
+    if server_type == 'asgi':
+        import uvicorn
+        from asgi import application
+
+        server = uvicorn.Server(uvicorn.Config(application, host='127.0.0.1', port=port,
+                                               log_level='warning', lifespan='on'))
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        while not server.started:
+            time.sleep(0.05)
+
+        def stop():
+            server.should_exit = True
+            thread.join(timeout=5)
+        return stop
+
+    from werkzeug.serving import make_server
+    from app import app
+
+    server = make_server('127.0.0.1', port, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server.shutdown
+
+
+# --- Load driver ---
+
+def timed_request(port: int, method: str, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """בקשת HTTP אחת עם מדידת TTFB וזמן כולל"""
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    started = time.perf_counter()
+    try:
+        conn.request(method, path, body=body, headers={'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        first = response.read(1)
+        ttfb = time.perf_counter() - started
+        rest = response.read()
+        total = time.perf_counter() - started
+        return {
+            'status': response.status,
+            'ttfb': ttfb,
+            'total': total,
+            'body': (first + rest).decode('utf-8', errors='replace')
+        }
+    except Exception as e:
+        return {'status': 0, 'ttfb': None, 'total': time.perf_counter() - started, 'body': str(e)}
+    finally:
+        conn.close()
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    """p50/p95/p99 במילישניות"""
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None, 'mean': None}
+    if len(values) == 1:
+        cuts = values * 99
+    else:
+        cuts = statistics.quantiles(values, n=100, method='inclusive')
+    return {
+        'p50': round(cuts[49] * 1000, 2),
+        'p95': round(cuts[94] * 1000, 2),
+        'p99': round(cuts[98] * 1000, 2),
+        'mean': round(statistics.fmean(values) * 1000, 2)
+    }
+
+def summarize(requests: List[Dict[str, Any]], elapsed: float) -> Dict[str, Any]:
+    ok = [r for r in requests if r['status'] == 200]
+    return {
+        'requests': len(requests),
+        'errors': len(requests) - len(ok),
+        'requests_per_second': round(len(requests) / elapsed, 2) if elapsed else None,
+        'ttfb_ms': percentiles([r['ttfb'] for r in ok if r['ttfb'] is not None]),
+        'total_ms': percentiles([r['total'] for r in ok])
+    }
+
+
+# --- Reporting ---
+
+def print_report(results: Dict[str, Any]):
+    print(f"\n📊 {results['config']['sessions']} sessions × {results['config']['turns']} turns, "
+          f"concurrency {results['config']['concurrency']}, server {results['config']['server']}")
+    for name in ('init', 'chat'):
+        section = results[name]
+        print(f"\n/api/{name}: {section['requests']} requests, {section['errors']} errors, "
+              f"{section['requests_per_second']} req/s")
+        for metric in ('ttfb_ms', 'total_ms'):
+            values = section[metric]
+            print(f"  {metric:9s} p50={values['p50']}  p95={values['p95']}  p99={values['p99']}")
+    print(f"\nDB queries per chat turn: {results['chat']['db_queries_per_turn']}")
+
+def print_comparison(results: Dict[str, Any], baseline: Dict[str, Any]):
+    """השוואה לריצה קודמת"""
+    def delta(new, old):
+        if new is None or old is None or old == 0:
+            return "n/a"
+        return f"{(new - old) / old * 100:+.1f}%"
+
+    print(f"\n🔍 Compared with run from {baseline.get('timestamp', '?')}:")
+    for metric in ('ttfb_ms', 'total_ms'):
+        for p in ('p50', 'p95', 'p99'):
+            new = results['chat'][metric][p]
+            old = baseline['chat'][metric][p]
+            print(f"  chat {metric} {p}: {old} → {new} ({delta(new, old)})")
+    for key in ('requests_per_second', 'db_queries_per_turn'):
+        new = results['chat'][key]
+        old = baseline['chat'].get(key)
+        print(f"  chat {key}: {old} → {new} ({delta(new, old)})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="/api/chat load test with a stubbed Gemini model")
+    parser.add_argument('--sessions', type=int, default=20)
+    parser.add_argument('--turns', type=int, default=5, help="chat turns per session")
+    parser.add_argument('--concurrency', type=int, default=20, help="sessions running at once")
+    parser.add_argument('--server', choices=('wsgi', 'asgi'), default='wsgi')
+    parser.add_argument('--latency-ms', type=float, default=300, help="stub model time to first token")
+    parser.add_argument('--chunk-ms', type=float, default=20, help="delay between streamed chunks")
+    parser.add_argument('--chunks', type=int, default=10)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of model calls that raise")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="JSON results file (default: benchmarks/results/load_chat-<time>.json)")
+    parser.add_argument('--compare', help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    stub_model = StubGenerativeModel(args.latency_ms, args.chunk_ms, args.chunks, args.error_rate, args.seed)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        app_module = load_app(os.path.join(tmpdir, 'load_chat.db'), stub_model)
+        from models import db
+        from sqlalchemy import event
+
+        port = free_port()
+        stop_server = start_server(args.server, port)
+        try:
+            with app_module.app.app_context():
+                engine = db.engine
+
+            # Sessions first, so the chat phase only counts chat queries
+            with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                started = time.perf_counter()
+                inits = list(pool.map(lambda _: timed_request(port, 'POST', '/api/init', {}), range(args.sessions)))
+                init_elapsed = time.perf_counter() - started
+
+            session_ids = [json.loads(r['body'])['session_id'] for r in inits if r['status'] == 200]
+
+            counter = QueryCounter()
+            event.listen(engine, 'before_cursor_execute', counter)
+
+            def chat_session(index: int) -> List[Dict[str, Any]]:
+                rng = random.Random(args.seed + index)
+                return [
+                    timed_request(port, 'POST', '/api/chat', {
+                        'session_id': session_ids[index],
+                        'message': rng.choice(MESSAGES)
+                    })
+                    for _ in range(args.turns)
+                ]
+
+            with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                started = time.perf_counter()
+                chats = [r for session in pool.map(chat_session, range(len(session_ids))) for r in session]
+                chat_elapsed = time.perf_counter() - started
+
+            event.remove(engine, 'before_cursor_execute', counter)
+        finally:
+            stop_server()
+
+    results = {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'config': vars(args),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform()},
+        'init': summarize(inits, init_elapsed),
+        'chat': summarize(chats, chat_elapsed)
+    }
+    results['chat']['db_queries'] = counter.count
+    results['chat']['db_queries_per_turn'] = round(counter.count / len(chats), 2) if chats else None
+
+    print_report(results)
+
+    output = args.output or os.path.join(
+        ROOT, 'benchmarks', 'results',
+        f"load_chat-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"\n💾 Results saved to {output}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            print_comparison(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
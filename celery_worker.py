@@ -0,0 +1,21 @@
+# celery_worker.py - נקודת כניסה ל-worker של Celery למשימות הרקע
+"""
+Celery worker entry point for background_tasks.py.
+
+Requires ENABLE_BACKGROUND_TASKS=true and BACKGROUND_TASK_BROKER set to a
+broker URL:
+
+    celery -A celery_worker.celery_app worker --loglevel=info
+
+Importing the Flask app loads the configuration and registers the tasks.
+"""
+
+from app import app
+from background_tasks import background_tasks
+
+celery_app = background_tasks.celery
+
+if celery_app is None:
+    raise RuntimeError("Celery is not configured - set ENABLE_BACKGROUND_TASKS=true and BACKGROUND_TASK_BROKER to a broker URL")
+
+__all__ = ['app', 'celery_app']
@@ -36,6 +36,7 @@ class Config:
     RATELIMIT_STORAGE_URL = os.environ.get('RATELIMIT_STORAGE_URL', 'memory://')
     RATELIMIT_STRATEGY = 'fixed-window'
     RATELIMIT_HEADERS_ENABLED = True
+    CHAT_RATE_LIMIT = f"{int(os.environ.get('CHAT_RATE_LIMIT', '30'))} per minute"  # /api/chat, sync and async
     
     # Security Headers - UPDATED Content-Security-Policy (for base Config)
     SECURITY_HEADERS = {
@@ -63,11 +64,86 @@ class Config:
     
     # Features
     ENABLE_FALLBACK_SYSTEM = os.environ.get('FALLBACK_ENABLED', 'True').lower() == 'true'
-    FALLBACK_TIMEOUT = int(os.environ.get('FALLBACK_TIMEOUT', '10'))
+    FALLBACK_TIMEOUT = int(os.environ.get('FALLBACK_TIMEOUT', '10'))  # seconds to each Gemini chunk before switching to fallback
+    
+    # AI circuit breaker - see ai_guard.py
+    CIRCUIT_BREAKER_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_BREAKER_FAILURE_THRESHOLD', '3'))  # consecutive 5xx failures
+    CIRCUIT_BREAKER_COOLDOWN = int(os.environ.get('CIRCUIT_BREAKER_COOLDOWN', '30'))  # seconds before probing Gemini again
+    AI_WORKER_THREADS = int(os.environ.get('AI_WORKER_THREADS', '32'))
+    
+    # Gemini concurrency limiter and in-flight coalescing (per worker) - see ai_limiter.py
+    AI_MAX_CONCURRENT_CALLS = int(os.environ.get('AI_MAX_CONCURRENT_CALLS', '8'))
+    AI_MAX_QUEUED_CALLS = int(os.environ.get('AI_MAX_QUEUED_CALLS', '32'))
+    AI_QUEUE_TIMEOUT = float(os.environ.get('AI_QUEUE_TIMEOUT', '5'))  # seconds
+    AI_COALESCE_PROMPTS = os.environ.get('AI_COALESCE_PROMPTS', 'True').lower() == 'true'
+    
+    # Post-turn analytics (ENABLE_BACKGROUND_TASKS) - see background_tasks.py
+    BACKGROUND_TASK_BROKER = os.environ.get('BACKGROUND_TASK_BROKER', 'local')  # local, or a Celery broker URL
+    BACKGROUND_TASK_DELAY = float(os.environ.get('BACKGROUND_TASK_DELAY', '2'))  # seconds after the turn
+    BACKGROUND_TASK_MAX_QUEUE = int(os.environ.get('BACKGROUND_TASK_MAX_QUEUE', '10000'))
+    
+    # Cold storage for finished conversations - see conversation_archive.py
+    ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', '180'))
+    
+    # Questionnaire retention - maintenance.py anonymize-questionnaires
+    ANONYMIZE_QUESTIONNAIRES_AFTER_DAYS = int(os.environ.get('ANONYMIZE_QUESTIONNAIRES_AFTER_DAYS', '365'))
+    
+    # Fallback conversation state store - see session_store.py
+    FALLBACK_STATE_BACKEND = os.environ.get('FALLBACK_STATE_BACKEND', 'memory')  # memory, sqlite, redis
+    # REDIS_URL is only a default for the redis backend - for sqlite the URL is a file path
+    FALLBACK_STATE_URL = os.environ.get('FALLBACK_STATE_URL') or (
+        os.environ.get('REDIS_URL') if FALLBACK_STATE_BACKEND == 'redis' else None
+    )
+    FALLBACK_STATE_TTL = int(os.environ.get('FALLBACK_STATE_TTL', '3600'))  # seconds
+    FALLBACK_STATE_MAX_SESSIONS = int(os.environ.get('FALLBACK_STATE_MAX_SESSIONS', '10000'))
+    FALLBACK_STATE_MAX_BYTES = int(os.environ.get('FALLBACK_STATE_MAX_BYTES', str(64 * 1024 * 1024)))
+    FALLBACK_STATE_MAX_HISTORY = int(os.environ.get('FALLBACK_STATE_MAX_HISTORY', '50'))  # messages per session
+    
+    # Conversation history in the prompt (ENABLE_CONVERSATION_HISTORY) - see conversation_history.py
+    HISTORY_RECENT_TOKENS = int(os.environ.get('HISTORY_RECENT_TOKENS', '1500'))  # verbatim recent turns
+    HISTORY_SUMMARY_TOKENS = int(os.environ.get('HISTORY_SUMMARY_TOKENS', '400'))  # rolling summary of older turns
+    HISTORY_MAX_MESSAGES = int(os.environ.get('HISTORY_MAX_MESSAGES', '20'))
+    HISTORY_SUMMARY_SOURCE_LIMIT = int(os.environ.get('HISTORY_SUMMARY_SOURCE_LIMIT', '200'))
+    HISTORY_SUMMARY_CACHE_SIZE = int(os.environ.get('HISTORY_SUMMARY_CACHE_SIZE', '5000'))
+    
+    # GET /api/history pages - see history_pages.py
+    HISTORY_PAGE_SIZE = int(os.environ.get('HISTORY_PAGE_SIZE', '50'))
+    HISTORY_MAX_PAGE_SIZE = int(os.environ.get('HISTORY_MAX_PAGE_SIZE', '200'))
+    
+    # Gemini response cache - see response_cache.py
+    RESPONSE_CACHE_ENABLED = os.environ.get('RESPONSE_CACHE_ENABLED', 'False').lower() == 'true'
+    RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', '86400'))  # seconds
+    RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', '5000'))
+    RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+    RESPONSE_CACHE_NEAR_DISTANCE = int(os.environ.get('RESPONSE_CACHE_NEAR_DISTANCE', '6'))  # SimHash bits, 0 = exact only
+    
+    # Write-behind message persistence - see message_writer.py
+    MESSAGE_WRITE_MODE = os.environ.get('MESSAGE_WRITE_MODE', 'sync')  # sync, write_behind
+    MESSAGE_WRITE_DURABILITY = os.environ.get('MESSAGE_WRITE_DURABILITY', 'buffered')  # buffered, commit
+    MESSAGE_FLUSH_INTERVAL_MS = int(os.environ.get('MESSAGE_FLUSH_INTERVAL_MS', '50'))
+    MESSAGE_FLUSH_MAX_ROWS = int(os.environ.get('MESSAGE_FLUSH_MAX_ROWS', '200'))
+    MESSAGE_QUEUE_MAX_ROWS = int(os.environ.get('MESSAGE_QUEUE_MAX_ROWS', '10000'))
+    MESSAGE_COMMIT_TIMEOUT = float(os.environ.get('MESSAGE_COMMIT_TIMEOUT', '5'))  # seconds, commit durability only
+    
+    # Request profiling (ENABLE_PROFILING) - see profiling.py
+    PROFILING_SAMPLE_RATE = float(os.environ.get('PROFILING_SAMPLE_RATE', '0'))  # fraction of requests
+    PROFILING_INTERVAL_MS = float(os.environ.get('PROFILING_INTERVAL_MS', '5'))
+    PROFILING_OUTPUT_DIR = os.environ.get('PROFILING_OUTPUT_DIR', 'logs/profiles')
+    PROFILING_TOKEN = os.environ.get('PROFILING_TOKEN')  # X-Profile header value that forces profiling
+    
+    # Health probes - see health.py
+    HEALTH_AI_PROBE_INTERVAL = int(os.environ.get('HEALTH_AI_PROBE_INTERVAL', '60'))  # seconds
+    HEALTH_DB_PROBE_INTERVAL = int(os.environ.get('HEALTH_DB_PROBE_INTERVAL', '10'))  # seconds
+    HEALTH_DB_TIMEOUT = float(os.environ.get('HEALTH_DB_TIMEOUT', '2'))  # seconds
+    HEALTH_AI_TIMEOUT = float(os.environ.get('HEALTH_AI_TIMEOUT', '5'))  # seconds
     
     # CORS
     CORS_ORIGINS = os.environ.get('CORS_ORIGINS', 'http://localhost:5000').split(',')
     
+    # Session context cache (per worker) - see session_context.py
+    SESSION_CONTEXT_CACHE_TTL = int(os.environ.get('SESSION_CONTEXT_CACHE_TTL', '60'))  # seconds, 0 disables
+    SESSION_CONTEXT_CACHE_SIZE = int(os.environ.get('SESSION_CONTEXT_CACHE_SIZE', '10000'))
+    
     # Performance
     ENABLE_CACHING = os.environ.get('ENABLE_CACHING', 'True').lower() == 'true'
     CACHE_TYPE = os.environ.get('CACHE_TYPE', 'simple')
@@ -243,7 +319,7 @@ class ProductionConfig(Config):
 class TestingConfig(Config):
     """הגדרות בדיקות"""
     TESTING = True
-    SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
+    SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL', 'sqlite:///:memory:')
     WTF_CSRF_ENABLED = False
     
     # Testing specific settings
@@ -0,0 +1,199 @@
+# conversation_archive.py - העברת שיחות שהסתיימו לאחסון קר דחוס
+"""
+Cold storage for finished conversations.
+
+`archive_conversations()` moves every completed or abandoned conversation that
+ended more than ARCHIVE_AFTER_DAYS ago out of the hot `conversation` and
+`message` tables. A conversation without an end_time counts from its
+start_time. Each conversation becomes one row in `conversation_archive`:
+- a few columns for lookup (parent, status, times, message count)
+- a zlib-compressed JSON payload holding the full conversation row and all of
+  its message rows, column by column, so nothing is lost
+
+Batches of ARCHIVE_BATCH_SIZE conversations are moved in one transaction each
+(bulk insert of the archive rows, then bulk delete of the messages and the
+conversations). The hot tables and their indexes stay the size of the recent
+traffic.
+
+An archived conversation is read back with `get_archived_conversation()` in the
+exact `Conversation.to_dict(include_messages=True)` shape - the rows are
+rebuilt as transient model objects and the model's own to_dict() is used.
+`restore_conversation()` moves it back into the hot tables with its original
+ids.
+"""
+
+import json
+import logging
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+from sqlalchemy import DateTime, and_, delete, insert, or_, select
+
+from models import db, Conversation, ConversationArchive, Message
+
+logger = logging.getLogger(__name__)
+
+PAYLOAD_FORMAT = 'zlib-json-v1'
+ARCHIVABLE_STATUSES = ('completed', 'abandoned')
+COMPRESSION_LEVEL = 6
+
+def _encode_value(value: Any) -> Any:
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def row_values(table, row) -> Dict[str, Any]:
+    """כל עמודות השורה כערכים שניתנים ל-JSON (תאריכים כ-ISO)"""
+    return {column.name: _encode_value(row._mapping[column]) for column in table.columns}
+
+def _decode_values(table, values: Dict[str, Any]) -> Dict[str, Any]:
+    """ערכי עמודות מה-payload, עם תאריכים כ-datetime. עמודות שכבר לא קיימות נזרקות"""
+    decoded = {}
+    for column in table.columns:
+        if column.name not in values:
+            continue
+        value = values[column.name]
+        if value is not None and isinstance(column.type, DateTime):
+            value = datetime.fromisoformat(value)
+        decoded[column.name] = value
+    return decoded
+
+def encode_payload(conversation_row: Dict[str, Any], message_rows: List[Dict[str, Any]]) -> bytes:
+    """דחיסת שורת השיחה ושורות ההודעות"""
+    document = {'conversation': conversation_row, 'messages': message_rows}
+    raw = json.dumps(document, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return zlib.compress(raw, COMPRESSION_LEVEL)
+
+def decode_payload(archive) -> Dict[str, Any]:
+    """פריסת ה-payload של שורת ארכיון (אובייקט או שורת Core): {'conversation': {...}, 'messages': [...]}"""
+    if archive.payload_format != PAYLOAD_FORMAT:
+        raise ValueError(f"Unknown archive payload format: {archive.payload_format}")
+    document = json.loads(zlib.decompress(archive.payload).decode('utf-8'))
+    return {
+        'conversation': _decode_values(Conversation.__table__, document['conversation']),
+        'messages': [_decode_values(Message.__table__, row) for row in document['messages']]
+    }
+
+def _archive_batch(conversation_ids: Sequence[int]) -> int:
+    """העברת אצוות שיחות לארכיון בטרנזקציה אחת. מחזיר את מספר ההודעות שהועברו"""
+    conversation = Conversation.__table__
+    message = Message.__table__
+
+    conversations = db.session.execute(
+        select(conversation).where(conversation.c.id.in_(conversation_ids))
+    ).all()
+    messages_by_conversation: Dict[int, List[Dict[str, Any]]] = {cid: [] for cid in conversation_ids}
+    for row in db.session.execute(
+        select(message)
+        .where(message.c.conversation_id.in_(conversation_ids))
+        .order_by(message.c.conversation_id, message.c.timestamp, message.c.id)
+    ):
+        messages_by_conversation[row.conversation_id].append(row_values(message, row))
+
+    now = datetime.now(timezone.utc)
+    archive_rows = []
+    moved_messages = 0
+    for row in conversations:
+        message_rows = messages_by_conversation[row.id]
+        moved_messages += len(message_rows)
+        archive_rows.append({
+            'conversation_id': row.id,
+            'parent_id': row.parent_id,
+            'status': row.status,
+            'start_time': row.start_time,
+            'end_time': row.end_time,
+            'message_count': len(message_rows),
+            'archived_at': now,
+            'payload_format': PAYLOAD_FORMAT,
+            'payload': encode_payload(row_values(conversation, row), message_rows)
+        })
+
+    try:
+        if archive_rows:
+            db.session.execute(insert(ConversationArchive.__table__), archive_rows)
+        # Core deletes bypass the message_count hook - the conversations themselves go in the same transaction
+        db.session.execute(delete(message).where(message.c.conversation_id.in_(conversation_ids)))
+        db.session.execute(delete(conversation).where(conversation.c.id.in_(conversation_ids)))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return moved_messages
+
+def archive_conversations(older_than_days: int, batch_size: int = 200) -> Iterator[Dict[str, int]]:
+    """העברת שיחות שהסתיימו לפני older_than_days ימים לארכיון. מחזיר סיכום לכל אצווה (דורש app context)"""
+    conversation = Conversation.__table__
+    cutoff = datetime.now(timezone.utc) - timedelta(days=older_than_days)
+    last_id = 0
+
+    while True:
+        conversation_ids = db.session.scalars(
+            select(conversation.c.id)
+            .where(
+                conversation.c.id > last_id,
+                conversation.c.status.in_(ARCHIVABLE_STATUSES),
+                or_(
+                    conversation.c.end_time < cutoff,
+                    and_(conversation.c.end_time.is_(None), conversation.c.start_time < cutoff)
+                )
+            )
+            .order_by(conversation.c.id)
+            .limit(batch_size)
+        ).all()
+        if not conversation_ids:
+            return
+        moved_messages = _archive_batch(conversation_ids)
+        last_id = conversation_ids[-1]
+        yield {'conversations': len(conversation_ids), 'messages': moved_messages}
+
+def _transient_conversation(document: Dict[str, Any]) -> Conversation:
+    """אובייקטי מודל שלא נכנסים ל-session - רק כדי להשתמש ב-to_dict של המודל"""
+    conversation = Conversation(**document['conversation'])
+    conversation.messages = [Message(**row) for row in document['messages']]
+    return conversation
+
+def get_archived_conversation(conversation_id: int) -> Optional[Dict[str, Any]]:
+    """שיחה מהארכיון בצורה של Conversation.to_dict(include_messages=True), או None"""
+    archive = db.session.get(ConversationArchive, conversation_id)
+    if archive is None:
+        return None
+    data = _transient_conversation(decode_payload(archive)).to_dict(include_messages=True)
+    data['archived'] = True
+    data['archived_at'] = archive.archived_at.isoformat() if archive.archived_at else None
+    return data
+
+def get_conversation_dict(conversation_id: int) -> Optional[Dict[str, Any]]:
+    """שיחה עם ההודעות שלה - מהטבלאות החמות, או מהארכיון אם הועברה"""
+    conversation = db.session.get(Conversation, conversation_id)
+    if conversation is not None:
+        return conversation.to_dict(include_messages=True)
+    return get_archived_conversation(conversation_id)
+
+def restore_conversation(conversation_id: int) -> bool:
+    """החזרת שיחה מהארכיון לטבלאות החמות, עם המזהים המקוריים. False אם אינה בארכיון"""
+    archive = db.session.get(ConversationArchive, conversation_id)
+    if archive is None:
+        return False
+    document = decode_payload(archive)
+    try:
+        db.session.execute(insert(Conversation.__table__), [document['conversation']])
+        if document['messages']:
+            # Core insert - message_count comes back with the conversation row
+            db.session.execute(insert(Message.__table__), document['messages'])
+        db.session.delete(archive)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    logger.info(f"Restored conversation {conversation_id} from the archive ({len(document['messages'])} messages)")
+    return True
+
+__all__ = [
+    'PAYLOAD_FORMAT',
+    'ARCHIVABLE_STATUSES',
+    'row_values',
+    'decode_payload',
+    'archive_conversations',
+    'get_archived_conversation',
+    'get_conversation_dict',
+    'restore_conversation'
+]
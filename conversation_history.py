@@ -0,0 +1,239 @@
+# conversation_history.py - היסטוריית שיחה לפרומפט בתקציב טוקנים קבוע
+"""
+Multi-turn context for the Gemini prompt within a fixed token budget.
+
+The newest turns are included verbatim, newest first, until
+HISTORY_RECENT_TOKENS is used up. They come from one query on
+ix_message_conversation_timestamp, capped at HISTORY_MAX_MESSAGES rows.
+Everything older is folded into a rolling extractive summary of at most
+HISTORY_SUMMARY_TOKENS:
+- the parent's messages are kept as their first sentence
+- bot replies are kept as their CARD titles
+- once the cap is hit, the oldest lines are dropped
+
+The summary is cached per conversation together with the id of the last
+message folded into it. Each turn only folds the messages that left the
+verbatim window since then. On a cache miss (new worker, eviction) it is
+rebuilt from at most HISTORY_SUMMARY_SOURCE_LIMIT older messages. Prompt size
+and per-turn work stay flat however long the conversation runs.
+
+Token counts are estimated (about CHARS_PER_TOKEN characters per token for
+Hebrew text) - cheap, and good enough for budgeting.
+"""
+
+import logging
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from sqlalchemy import select
+
+from models import db, Message
+
+logger = logging.getLogger(__name__)
+
+CHARS_PER_TOKEN = 3
+SUMMARY_LINE_CHARS = 160
+
+_CARD_TITLE = re.compile(r"CARD\[([^|\]]+)\|")
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s")
+
+def estimate_tokens(text: str) -> int:
+    """הערכת מספר טוקנים לפי אורך הטקסט"""
+    return max(1, -(-len(text) // CHARS_PER_TOKEN)) if text else 0
+
+@dataclass
+class HistoryTurn:
+    """הודעה אחת בהיסטוריה"""
+    sender_type: str
+    content: str
+
+@dataclass
+class ConversationHistory:
+    """מה שנכנס לפרומפט: סיכום מתגלגל ותורות אחרונים (מהישן לחדש)"""
+    summary: str = ""
+    recent: List[HistoryTurn] = field(default_factory=list)
+
+    def is_empty(self) -> bool:
+        return not self.summary and not self.recent
+
+    def to_prompt(self) -> str:
+        """טקסט ההיסטוריה לפרומפט"""
+        parts = []
+        if self.summary:
+            parts.append(f"סיכום השיחה עד כה:\n{self.summary}")
+        if self.recent:
+            lines = [
+                f"{'הורה' if turn.sender_type == 'user' else 'יונתן'}: {turn.content}"
+                for turn in self.recent
+            ]
+            parts.append("הודעות אחרונות:\n" + "\n".join(lines))
+        return "\n\n".join(parts)
+
+@dataclass
+class SummaryState:
+    """סיכום מתגלגל שמור של שיחה אחת"""
+    lines: List[str] = field(default_factory=list)
+    tokens: int = 0
+    last_message_id: int = 0
+    window_start_id: int = 0
+
+def summarize_message(sender_type: str, content: str) -> Optional[str]:
+    """שורת סיכום להודעה: המשפט הראשון של ההורה, כותרות הכרטיסים של יונתן"""
+    content = content.strip()
+    if not content:
+        return None
+    if sender_type == 'user':
+        first = _SENTENCE_END.split(content, maxsplit=1)[0]
+        if len(first) > SUMMARY_LINE_CHARS:
+            first = first[:SUMMARY_LINE_CHARS].rstrip() + "..."
+        return f"- ההורה: {first}"
+    titles = _CARD_TITLE.findall(content)
+    if titles:
+        return f"- יונתן הציע: {', '.join(title.strip() for title in titles[:3])}"
+    first = content.split('\n', 1)[0]
+    if len(first) > SUMMARY_LINE_CHARS:
+        first = first[:SUMMARY_LINE_CHARS].rstrip() + "..."
+    return f"- יונתן: {first}"
+
+class HistoryBuilder:
+    """בניית היסטוריה בתקציב, עם מטמון LRU לסיכומים לכל worker"""
+
+    def __init__(self, recent_tokens: int = 1500, summary_tokens: int = 400,
+                 max_messages: int = 20, source_limit: int = 200, cache_size: int = 5000):
+        self.recent_tokens = recent_tokens
+        self.summary_tokens = summary_tokens
+        self.max_messages = max_messages
+        self.source_limit = source_limit
+        self.cache_size = cache_size
+        self._summaries: "OrderedDict[int, SummaryState]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, recent_tokens: int, summary_tokens: int, max_messages: int,
+                  source_limit: int, cache_size: int):
+        """עדכון הגדרות (נקרא בזמן אתחול האפליקציה)"""
+        with self._lock:
+            self.recent_tokens = recent_tokens
+            self.summary_tokens = summary_tokens
+            self.max_messages = max_messages
+            self.source_limit = source_limit
+            self.cache_size = cache_size
+            self._summaries.clear()
+
+    def build(self, conversation_id: int, current_message: Optional[str] = None) -> ConversationHistory:
+        """היסטוריה לשיחה: תורות אחרונים מילה במילה + סיכום של כל מה שקדם להם"""
+        rows = db.session.execute(
+            select(Message.id, Message.sender_type, Message.content)
+            .where(Message.conversation_id == conversation_id)
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(self.max_messages)
+        ).all()
+        fetched = len(rows)
+        if current_message and rows and rows[0].sender_type == 'user' and rows[0].content == current_message:
+            # An unanswered copy of this message is a client retry, not context - keeps the prompt identical
+            rows = rows[1:]
+
+        recent: List[HistoryTurn] = []
+        used = 0
+        window_start_id = None
+        for row in rows:
+            cost = estimate_tokens(row.content)
+            if recent and used + cost > self.recent_tokens:
+                break
+            if not recent and cost > self.recent_tokens:
+                # A single huge message - keep its tail so the newest context survives
+                content = row.content[-self.recent_tokens * CHARS_PER_TOKEN:]
+                cost = self.recent_tokens
+            else:
+                content = row.content
+            recent.append(HistoryTurn(row.sender_type, content))
+            used += cost
+            window_start_id = row.id
+        recent.reverse()
+
+        summary = ""
+        reached_end = fetched < self.max_messages and len(recent) == len(rows)
+        if window_start_id is not None and not reached_end and self.summary_tokens > 0:
+            summary = self._update_summary(conversation_id, window_start_id)
+
+        return ConversationHistory(summary=summary, recent=recent)
+
+    def _update_summary(self, conversation_id: int, window_start_id: int) -> str:
+        """קיפול ההודעות שיצאו מהחלון מאז הפעם הקודמת לתוך הסיכום השמור"""
+        with self._lock:
+            state = self._summaries.get(conversation_id)
+            if state is not None:
+                self._summaries.move_to_end(conversation_id)
+                if state.window_start_id == window_start_id:
+                    # Nothing left the verbatim window since the last turn
+                    return "\n".join(state.lines)
+                state = SummaryState(list(state.lines), state.tokens, state.last_message_id)
+
+        if state is None:
+            state = SummaryState()
+
+        # Newest first, capped - on a cold cache only the tail that can fit is read
+        rows = db.session.execute(
+            select(Message.id, Message.sender_type, Message.content)
+            .where(
+                Message.conversation_id == conversation_id,
+                Message.id > state.last_message_id,
+                Message.id < window_start_id
+            )
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(self.source_limit)
+        ).all()
+
+        for row in reversed(rows):
+            line = summarize_message(row.sender_type, row.content)
+            if line:
+                state.lines.append(line)
+                state.tokens += estimate_tokens(line) + 1
+            state.last_message_id = max(state.last_message_id, row.id)
+
+        state.window_start_id = window_start_id
+        while state.lines and state.tokens > self.summary_tokens:
+            dropped = state.lines.pop(0)
+            state.tokens -= estimate_tokens(dropped) + 1
+
+        with self._lock:
+            self._summaries[conversation_id] = state
+            self._summaries.move_to_end(conversation_id)
+            while len(self._summaries) > self.cache_size:
+                self._summaries.popitem(last=False)
+
+        return "\n".join(state.lines)
+
+    def invalidate(self, conversation_id: int):
+        """הסרת הסיכום השמור של שיחה"""
+        with self._lock:
+            self._summaries.pop(conversation_id, None)
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'cached_summaries': len(self._summaries)}
+
+# מופע גלובלי לכל worker
+history_builder = HistoryBuilder()
+
+def init_history_builder(app):
+    """הגדרת בונה ההיסטוריה לפי הגדרות האפליקציה"""
+    history_builder.configure(
+        recent_tokens=app.config.get('HISTORY_RECENT_TOKENS', 1500),
+        summary_tokens=app.config.get('HISTORY_SUMMARY_TOKENS', 400),
+        max_messages=app.config.get('HISTORY_MAX_MESSAGES', 20),
+        source_limit=app.config.get('HISTORY_SUMMARY_SOURCE_LIMIT', 200),
+        cache_size=app.config.get('HISTORY_SUMMARY_CACHE_SIZE', 5000)
+    )
+
+__all__ = [
+    'estimate_tokens',
+    'HistoryTurn',
+    'ConversationHistory',
+    'HistoryBuilder',
+    'history_builder',
+    'init_history_builder',
+    'summarize_message'
+]
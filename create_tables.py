@@ -49,7 +49,7 @@ def create_tables():
                     print(f"   ✓ {table}")
                 
                 # בדיקה שכל הטבלאות הנדרשות נוצרו
-                expected_tables = ['parent', 'child', 'conversation', 'message', 'questionnaire_response']
+                expected_tables = ['parent', 'child', 'conversation', 'message', 'questionnaire_response', 'conversation_archive']
                 missing_tables = [t for t in expected_tables if t not in tables]
                 
                 if missing_tables:
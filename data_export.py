@@ -0,0 +1,124 @@
+# data_export.py - ייצוא כל הנתונים של הורה כ-NDJSON בזרימה
+"""
+Streaming export of everything stored for one parent, for privacy requests
+and support escalations.
+
+Output is NDJSON - one JSON object per line, {"record": <type>, "data": {...}}
+- in this order:
+- parent
+- child
+- questionnaire_response
+- conversation, then every message of those conversations
+  (ordered by conversation, timestamp, id)
+- the same two record types for archived conversations, with "archived": true
+- export_summary - the record counts, last
+
+Every record carries all the columns of its row, as stored. Each table is read
+with one Core query using `yield_per`, which runs on a server-side cursor
+where the driver supports it (PostgreSQL). Rows are serialised and written as
+they arrive, and archived conversations are decompressed one at a time. Memory
+use stays flat however much history the parent has - no ORM objects, no lazy
+relationships, no N+1.
+
+Used by GET /api/export and `python maintenance.py export-parent`.
+"""
+
+import json
+from datetime import datetime
+from typing import Any, Dict, Iterator
+
+from sqlalchemy import select
+
+from conversation_archive import decode_payload, row_values
+from errors import ParentNotFoundError
+from models import db, Child, Conversation, ConversationArchive, Message, Parent, QuestionnaireResponse
+
+# Rows fetched per round trip from the server-side cursor
+EXPORT_YIELD_PER = 1000
+# Archive rows hold whole compressed conversations - fetch fewer at a time
+ARCHIVE_YIELD_PER = 20
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot export {type(value).__name__}")
+
+def _line(record: str, data: Dict[str, Any], archived: bool = False) -> str:
+    payload = {'record': record, 'data': data}
+    if archived:
+        payload['archived'] = True
+    return json.dumps(payload, ensure_ascii=False, default=_json_default) + '\n'
+
+def _stream_rows(query, yield_per: int = EXPORT_YIELD_PER):
+    return db.session.execute(query.execution_options(yield_per=yield_per))
+
+def open_parent_export(parent_id: str) -> Iterator[str]:
+    """שורות NDJSON עם כל הנתונים של ההורה. ההורה נבדק לפני שמוחזר הזרם (דורש app context)"""
+    parent = Parent.__table__
+    parent_row = db.session.execute(select(parent).where(parent.c.id == parent_id)).first()
+    if parent_row is None:
+        raise ParentNotFoundError(f"Parent {parent_id} not found")
+    return _export_lines(parent_id, row_values(parent, parent_row))
+
+def _export_lines(parent_id: str, parent_values: Dict[str, Any]) -> Iterator[str]:
+    child = Child.__table__
+    questionnaire = QuestionnaireResponse.__table__
+    conversation = Conversation.__table__
+    message = Message.__table__
+    archive = ConversationArchive.__table__
+
+    counts = {
+        'child': 0,
+        'questionnaire_response': 0,
+        'conversation': 0,
+        'message': 0,
+        'archived_conversation': 0,
+        'archived_message': 0
+    }
+    yield _line('parent', parent_values)
+
+    for row in _stream_rows(select(child).where(child.c.parent_id == parent_id).order_by(child.c.id)):
+        counts['child'] += 1
+        yield _line('child', row_values(child, row))
+
+    for row in _stream_rows(
+        select(questionnaire)
+        .where(questionnaire.c.parent_id == parent_id)
+        .order_by(questionnaire.c.created_at, questionnaire.c.id)
+    ):
+        counts['questionnaire_response'] += 1
+        yield _line('questionnaire_response', row_values(questionnaire, row))
+
+    for row in _stream_rows(
+        select(conversation).where(conversation.c.parent_id == parent_id).order_by(conversation.c.id)
+    ):
+        counts['conversation'] += 1
+        yield _line('conversation', row_values(conversation, row))
+
+    for row in _stream_rows(
+        select(message)
+        .join(conversation, message.c.conversation_id == conversation.c.id)
+        .where(conversation.c.parent_id == parent_id)
+        .order_by(message.c.conversation_id, message.c.timestamp, message.c.id)
+    ):
+        counts['message'] += 1
+        yield _line('message', row_values(message, row))
+
+    for archived in _stream_rows(
+        select(archive.c.payload_format, archive.c.payload)
+        .where(archive.c.parent_id == parent_id)
+        .order_by(archive.c.conversation_id),
+        yield_per=ARCHIVE_YIELD_PER
+    ):
+        document = decode_payload(archived)
+        counts['archived_conversation'] += 1
+        yield _line('conversation', document['conversation'], archived=True)
+        for values in document['messages']:
+            counts['archived_message'] += 1
+            yield _line('message', values, archived=True)
+
+    yield _line('export_summary', {'parent_id': parent_id, 'counts': counts})
+
+__all__ = [
+    'open_parent_export'
+]
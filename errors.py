@@ -132,6 +132,13 @@ class ConversationNotFoundError(SessionNotFoundError):
     user_message = "השיחה לא נמצאה"
 
 
+class AICapacityExceededError(AIModelError):
+    """שגיאת עומס מקומי - אין slot פנוי לקריאת AI"""
+    status_code = 503
+    error_type = "ai_capacity_exceeded"
+    user_message = "המערכת עמוסה, אנא נסה שוב מאוחר יותר"
+
+
 def handle_generic_error(error: Exception) -> BotError:
     """
     טיפול בשגיאות כלליות שלא נתפסו
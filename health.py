@@ -0,0 +1,204 @@
+# health.py - בדיקות liveness/readiness עם תוצאות שמורות במטמון
+"""
+Cached health probes for /api/health.
+
+Load balancers hit the health endpoints every few seconds. Calling Gemini from
+each hit burned generation quota and added seconds of latency, so the checks
+now run on a background thread per worker:
+
+- the database is pinged with `SELECT 1`, bounded by HEALTH_DB_TIMEOUT
+- Gemini reachability is checked with a model metadata lookup (no generation
+  quota) every HEALTH_AI_PROBE_INTERVAL seconds, bounded by HEALTH_AI_TIMEOUT
+
+Each check runs on its own single-thread executor, so a hung call only fails
+its own probe. The endpoints only read the last results, so they answer
+without any I/O. A result older than STALE_AFTER_INTERVALS probe intervals
+(the prober thread died or is stuck) is reported as stale and not ok.
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, asdict
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class ProbeResult:
+    """תוצאת בדיקה אחרונה של רכיב אחד"""
+    ok: bool = False
+    checked_at: Optional[str] = None
+    latency_ms: Optional[float] = None
+    error: Optional[str] = None
+
+    def is_stale(self, max_age: float) -> bool:
+        """האם הבדיקה האחרונה ישנה מ-max_age שניות (או לא רצה מעולם)"""
+        if self.checked_at is None:
+            return True
+        age = datetime.now(timezone.utc) - datetime.fromisoformat(self.checked_at)
+        return age.total_seconds() > max_age
+
+class HealthProber:
+    """בודק רקע שמריץ בדיקות DB ו-AI ושומר את התוצאה האחרונה"""
+
+    # תוצאה שלא התעדכנה כמה מחזורי בדיקה נחשבת ישנה
+    STALE_AFTER_INTERVALS = 3
+
+    def __init__(self,
+                 db_check: Callable[[], Any],
+                 ai_check: Optional[Callable[[], Any]] = None,
+                 db_interval: float = 10,
+                 ai_interval: float = 60,
+                 db_timeout: float = 2,
+                 ai_timeout: float = 5):
+        self.db_check = db_check
+        self.ai_check = ai_check
+        self.db_interval = db_interval
+        self.ai_interval = ai_interval
+        self.db_timeout = db_timeout
+        self.ai_timeout = ai_timeout
+        self.database = ProbeResult()
+        self.ai_model = ProbeResult()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self._executors: Dict[str, ThreadPoolExecutor] = {}
+        self._pending: Dict[str, Future] = {}
+
+    def ensure_started(self):
+        """הפעלת thread הבדיקה אם לא רץ בתהליך הנוכחי (בטוח אחרי fork של gunicorn)"""
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._executors = {}
+            self._pending = {}
+            self._thread = threading.Thread(target=self._run, name='health-prober', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        next_db = next_ai = 0.0
+        while True:
+            now = time.monotonic()
+            try:
+                if now >= next_db:
+                    next_db = now + self.db_interval
+                    self.probe_database()
+                if now >= next_ai:
+                    next_ai = now + self.ai_interval
+                    self.probe_ai()
+            except RuntimeError as e:
+                if 'shutdown' in str(e):
+                    # Executors refuse new work once the interpreter is exiting - nothing left to probe
+                    logger.info("Health prober stopped: executors are shut down")
+                    return
+                logger.exception("Health probe iteration failed")
+            except Exception:
+                logger.exception("Health probe iteration failed")
+            self._wakeup.wait(max(0.0, min(next_db, next_ai) - time.monotonic()))
+            self._wakeup.clear()
+
+    def _run_bounded(self, name: str, check: Callable[[], Any], timeout: float) -> ProbeResult:
+        """הרצת בדיקה ב-executor משלה עם הגבלת זמן - קריאה תקועה לא עוצרת את הבודק"""
+        started = time.monotonic()
+        executor = self._executors.get(name)
+        if executor is None:
+            executor = self._executors[name] = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'health-{name}')
+        pending = self._pending.get(name)
+        if pending is not None and not pending.done():
+            # Previous check is still hanging - don't queue another one behind it
+            return self._result(False, started, f"previous {name} check still running")
+        pending = self._pending[name] = executor.submit(check)
+        try:
+            pending.result(timeout=timeout)
+            return self._result(True, started)
+        except FutureTimeoutError:
+            logger.error(f"Health check '{name}' timed out after {timeout}s")
+            return self._result(False, started, "timeout")
+        except Exception as e:
+            logger.error(f"Health check '{name}' failed: {e}")
+            return self._result(False, started, str(e))
+
+    def probe_database(self):
+        """בדיקת DB מוגבלת בזמן"""
+        self.database = self._run_bounded('db', self.db_check, self.db_timeout)
+
+    def probe_ai(self):
+        """בדיקת זמינות AI ללא צריכת מכסת generation, מוגבלת בזמן"""
+        if self.ai_check is None:
+            self.ai_model = self._result(False, time.monotonic(), "model not configured")
+            return
+        self.ai_model = self._run_bounded('ai', self.ai_check, self.ai_timeout)
+
+    def refresh(self):
+        """בקשה מה-thread להריץ את הבדיקות מיד"""
+        self._wakeup.set()
+
+    @staticmethod
+    def _result(ok: bool, started: float, error: Optional[str] = None) -> ProbeResult:
+        return ProbeResult(
+            ok=ok,
+            checked_at=datetime.now(timezone.utc).isoformat(),
+            latency_ms=round((time.monotonic() - started) * 1000, 1),
+            error=error
+        )
+
+    def _database_stale(self) -> bool:
+        return self.database.is_stale(self.STALE_AFTER_INTERVALS * self.db_interval + self.db_timeout)
+
+    def _ai_stale(self) -> bool:
+        return self.ai_model.is_stale(self.STALE_AFTER_INTERVALS * self.ai_interval + self.ai_timeout)
+
+    @property
+    def ready(self) -> bool:
+        """מוכן לקבל תעבורה: DB זמין ונבדק לאחרונה (ה-AI אינו חובה - יש fallback)"""
+        return self.database.ok and not self._database_stale()
+
+    @staticmethod
+    def _describe(result: ProbeResult, stale: bool) -> Dict[str, Any]:
+        data = asdict(result)
+        data['stale'] = stale
+        if stale:
+            data['ok'] = False
+        return data
+
+    def snapshot(self) -> Dict[str, Any]:
+        """התוצאות האחרונות, ללא I/O"""
+        return {
+            'database': self._describe(self.database, self._database_stale()),
+            'ai_model': self._describe(self.ai_model, self._ai_stale())
+        }
+
+def create_health_prober(app, db, model=None) -> HealthProber:
+    """יצירת בודק בריאות לפי הגדרות האפליקציה"""
+    def db_check():
+        with app.app_context():
+            with db.engine.connect() as connection:
+                connection.execute(db.text("SELECT 1"))
+
+    def _probe_model():
+        import google.generativeai as genai
+        # Metadata lookup - reachability and key validity without spending generation quota
+        genai.get_model(model.model_name)
+
+    return HealthProber(
+        db_check=db_check,
+        ai_check=_probe_model if model is not None else None,
+        db_interval=app.config.get('HEALTH_DB_PROBE_INTERVAL', 10),
+        ai_interval=app.config.get('HEALTH_AI_PROBE_INTERVAL', 60),
+        db_timeout=app.config.get('HEALTH_DB_TIMEOUT', 2),
+        ai_timeout=app.config.get('HEALTH_AI_TIMEOUT', 5)
+    )
+
+__all__ = [
+    'ProbeResult',
+    'HealthProber',
+    'create_health_prober'
+]
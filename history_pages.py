@@ -0,0 +1,139 @@
+# history_pages.py - דפדוף בהיסטוריית שיחה עם cursor על (timestamp, id)
+"""
+Keyset-paginated conversation history for GET /api/history.
+
+A page is the next `limit` messages after an opaque cursor that encodes the
+(timestamp, id) of the last message of the previous page. The query is a
+range scan on ix_message_conversation_timestamp (conversation_id, timestamp,
+id), so page N costs the same as page 1 - there is no OFFSET to skip over.
+Pages run newest first by default (what the widget needs to restore a chat
+after a reload); order=asc reads the conversation from the start.
+
+The response is streamed: the JSON object is written message by message from
+the result rows, and `next_cursor` comes last, once the page is known to have
+a successor (one extra row is fetched to tell). Conversations moved to the
+archive (see conversation_archive.py) page the same way from their payload.
+
+Messages still in the write-behind queue (MESSAGE_WRITE_MODE=write_behind)
+appear once they are flushed.
+"""
+
+import base64
+import binascii
+import json
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+
+from sqlalchemy import select, tuple_
+
+from conversation_archive import decode_payload
+from errors import ConversationNotFoundError, ValidationError
+from models import db, Conversation, ConversationArchive, Message
+
+ORDERS = ('desc', 'asc')
+
+# Same keys as Message.to_dict()
+_MESSAGE_COLUMNS = (
+    Message.id, Message.sender_type, Message.content, Message.timestamp,
+    Message.message_type, Message.character_count, Message.word_count, Message.is_edited
+)
+
+def encode_cursor(timestamp: datetime, message_id: int) -> str:
+    """cursor אטום להודעה האחרונה בעמוד"""
+    raw = f"{timestamp.isoformat()}|{message_id}".encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """(timestamp, id) מתוך cursor. זורק ValidationError על cursor פגום"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        timestamp, message_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(timestamp), int(message_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValidationError("Invalid history cursor", user_message="cursor לא תקין")
+
+def _message_dict(row) -> Dict[str, Any]:
+    return {
+        'id': row.id,
+        'sender_type': row.sender_type,
+        'content': row.content,
+        'timestamp': row.timestamp.isoformat(),
+        'message_type': row.message_type,
+        'character_count': row.character_count,
+        'word_count': row.word_count,
+        'is_edited': row.is_edited
+    }
+
+def _hot_rows(conversation_id: int, after: Optional[Tuple[datetime, int]], limit: int, order: str) -> Iterable:
+    query = select(*_MESSAGE_COLUMNS).where(Message.conversation_id == conversation_id)
+    key = tuple_(Message.timestamp, Message.id)
+    if order == 'desc':
+        if after is not None:
+            query = query.where(key < tuple_(*after))
+        query = query.order_by(Message.timestamp.desc(), Message.id.desc())
+    else:
+        if after is not None:
+            query = query.where(key > tuple_(*after))
+        query = query.order_by(Message.timestamp, Message.id)
+    return db.session.execute(query.limit(limit + 1).execution_options(stream_results=True))
+
+class _ArchivedRow:
+    __slots__ = [column.key for column in _MESSAGE_COLUMNS]
+
+    def __init__(self, values: Dict[str, Any]):
+        for name in self.__slots__:
+            setattr(self, name, values.get(name))
+
+def _archived_rows(archive: ConversationArchive, after: Optional[Tuple[datetime, int]], limit: int, order: str) -> Iterable:
+    rows = [_ArchivedRow(values) for values in decode_payload(archive)['messages']]
+    rows.sort(key=lambda row: (row.timestamp, row.id), reverse=(order == 'desc'))
+    if after is not None:
+        if order == 'desc':
+            rows = [row for row in rows if (row.timestamp, row.id) < after]
+        else:
+            rows = [row for row in rows if (row.timestamp, row.id) > after]
+    return rows[:limit + 1]
+
+def open_history_page(parent_id: str, conversation_id: int, cursor: Optional[str],
+                      limit: int, order: str = 'desc') -> Iterator[str]:
+    """עמוד היסטוריה כזרם JSON. הבדיקות (בעלות, cursor) רצות לפני שמוחזר הזרם"""
+    if order not in ORDERS:
+        raise ValidationError("Invalid history order", user_message="order חייב להיות asc או desc")
+    after = decode_cursor(cursor) if cursor else None
+
+    owner = db.session.scalar(select(Conversation.parent_id).where(Conversation.id == conversation_id))
+    if owner is not None:
+        if owner != parent_id:
+            raise ConversationNotFoundError(f"Conversation {conversation_id} not found for this session")
+        rows = _hot_rows(conversation_id, after, limit, order)
+        archived = False
+    else:
+        archive = db.session.get(ConversationArchive, conversation_id)
+        if archive is None or archive.parent_id != parent_id:
+            raise ConversationNotFoundError(f"Conversation {conversation_id} not found for this session")
+        rows = _archived_rows(archive, after, limit, order)
+        archived = True
+
+    return _stream_page(conversation_id, rows, limit, order, archived)
+
+def _stream_page(conversation_id: int, rows: Iterable, limit: int, order: str, archived: bool) -> Iterator[str]:
+    yield f'{{"conversation_id":{conversation_id},"order":"{order}","archived":{json.dumps(archived)},"messages":['
+    sent = 0
+    last = None
+    has_more = False
+    for row in rows:
+        if sent == limit:
+            has_more = True
+            break
+        yield ('' if sent == 0 else ',') + json.dumps(_message_dict(row), ensure_ascii=False)
+        last = row
+        sent += 1
+    next_cursor = encode_cursor(last.timestamp, last.id) if has_more else None
+    yield f'],"count":{sent},"next_cursor":{json.dumps(next_cursor)}}}'
+
+__all__ = [
+    'ORDERS',
+    'encode_cursor',
+    'decode_cursor',
+    'open_history_page'
+]
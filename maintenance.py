@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# maintenance.py - משימות תחזוקה לבסיס הנתונים
+"""
+Maintenance jobs for the Yonatan database.
+
+Usage:
+    python maintenance.py reconcile-counts [--batch-size N]
+    python maintenance.py score-messages [--chunk-size N] [--rescore]
+    python maintenance.py archive-conversations [--older-than-days N] [--batch-size N]
+    python maintenance.py restore-conversation CONVERSATION_ID
+    python maintenance.py export-parent PARENT_ID [--output FILE]
+    python maintenance.py db-stats [--approximate]
+    python maintenance.py anonymize-questionnaires [--older-than-days N] [--chunk-size N]
+                                                   [--checkpoint FILE] [--pause SECONDS]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+
+def cmd_reconcile_counts(args) -> int:
+    """תיקון message_count שסטה מהמספר האמיתי של ההודעות"""
+    from models import reconcile_message_counts
+
+    started = time.monotonic()
+    repaired = reconcile_message_counts(batch_size=args.batch_size)
+    elapsed = time.monotonic() - started
+    print(f"✅ תוקנו {repaired} שיחות ({elapsed:.1f} שניות)")
+    return 0
+
+
+def cmd_score_messages(args) -> int:
+    """מילוי sentiment_score ו-toxicity_score לכל ההודעות, ב-chunks"""
+    from background_tasks import backfill_message_scores
+    from text_analytics import VECTOR_SCORING_AVAILABLE
+
+    if not VECTOR_SCORING_AVAILABLE:
+        print("⚠️ numpy/scipy לא מותקנים - ציון הודעה אחר הודעה (איטי)")
+
+    started = time.monotonic()
+    total = 0
+    scoring_seconds = 0.0
+    for scored, seconds in backfill_message_scores(chunk_size=args.chunk_size, rescore=args.rescore):
+        total += scored
+        scoring_seconds += seconds
+        elapsed = time.monotonic() - started
+        print(f"   {total:,} הודעות ({total / elapsed:,.0f} הודעות/שנייה)", flush=True)
+
+    elapsed = time.monotonic() - started
+    print(f"✅ צוינו {total:,} הודעות ב-{elapsed:.1f} שניות "
+          f"({total / elapsed if elapsed else 0:,.0f} הודעות/שנייה כולל DB, "
+          f"{total / scoring_seconds if scoring_seconds else 0:,.0f} הודעות/שנייה בחישוב)")
+    return 0
+
+
+def cmd_archive_conversations(args) -> int:
+    """העברת שיחות שהסתיימו לפני N ימים לארכיון הדחוס"""
+    from flask import current_app
+    from conversation_archive import archive_conversations
+
+    older_than_days = args.older_than_days
+    if older_than_days is None:
+        older_than_days = current_app.config.get('ARCHIVE_AFTER_DAYS', 180)
+
+    started = time.monotonic()
+    conversations = messages = 0
+    for batch in archive_conversations(older_than_days, batch_size=args.batch_size):
+        conversations += batch['conversations']
+        messages += batch['messages']
+        print(f"   {conversations:,} שיחות, {messages:,} הודעות", flush=True)
+
+    elapsed = time.monotonic() - started
+    print(f"✅ הועברו לארכיון {conversations:,} שיחות ({messages:,} הודעות) "
+          f"שהסתיימו לפני יותר מ-{older_than_days} ימים ({elapsed:.1f} שניות)")
+    return 0
+
+
+def cmd_restore_conversation(args) -> int:
+    """החזרת שיחה מהארכיון לטבלאות הפעילות"""
+    from conversation_archive import restore_conversation
+
+    if not restore_conversation(args.conversation_id):
+        print(f"❌ שיחה {args.conversation_id} לא נמצאה בארכיון")
+        return 1
+    print(f"✅ שיחה {args.conversation_id} הוחזרה מהארכיון")
+    return 0
+
+
+def cmd_export_parent(args) -> int:
+    """ייצוא כל הנתונים של הורה כ-NDJSON (לקובץ או ל-stdout)"""
+    from data_export import open_parent_export
+    from errors import ParentNotFoundError
+
+    try:
+        lines = open_parent_export(args.parent_id)
+    except ParentNotFoundError:
+        print(f"❌ הורה {args.parent_id} לא נמצא", file=sys.stderr)
+        return 1
+
+    if args.output == '-':
+        sys.stdout.writelines(lines)
+        return 0
+
+    started = time.monotonic()
+    written = 0
+    with open(args.output, 'w', encoding='utf-8') as output:
+        for line in lines:
+            output.write(line)
+            written += 1
+    elapsed = time.monotonic() - started
+    print(f"✅ יוצאו {written:,} רשומות ל-{args.output} ({elapsed:.1f} שניות)")
+    return 0
+
+
+def cmd_db_stats(args) -> int:
+    """סטטיסטיקות מסד הנתונים בשאילתה מאוחדת אחת"""
+    from models import get_db_stats
+
+    started = time.monotonic()
+    stats = get_db_stats(approximate=args.approximate)
+    elapsed = time.monotonic() - started
+    print(json.dumps(stats, indent=2))
+    print(f"⏱️  {elapsed * 1000:.0f} ms", file=sys.stderr)
+    return 0
+
+
+def _read_checkpoint(path: str):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as checkpoint_file:
+        return json.load(checkpoint_file)
+
+
+def _write_checkpoint(path: str, checkpoint: dict):
+    # Written aside and renamed, so an interrupted run never leaves half a checkpoint
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path + '.tmp', 'w', encoding='utf-8') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(path + '.tmp', path)
+
+
+def cmd_anonymize_questionnaires(args) -> int:
+    """אנונימיזציה של שאלונים ישנים ב-chunks, עם נקודת המשך בקובץ"""
+    from flask import current_app
+    from models import anonymize_questionnaire_responses
+
+    checkpoint = _read_checkpoint(args.checkpoint)
+    if checkpoint:
+        # Resume with the original cutoff - rows between two cutoffs below last_id would be skipped otherwise
+        cutoff = datetime.fromisoformat(checkpoint['cutoff'])
+        start_after_id = checkpoint['last_id']
+        print(f"↩️  ממשיך מ-id {start_after_id} (לפני {cutoff:%Y-%m-%d})")
+    else:
+        older_than_days = args.older_than_days
+        if older_than_days is None:
+            older_than_days = current_app.config.get('ANONYMIZE_QUESTIONNAIRES_AFTER_DAYS', 365)
+        cutoff = datetime.now(timezone.utc) - timedelta(days=older_than_days)
+        start_after_id = 0
+
+    started = time.monotonic()
+    total = 0
+    for last_id, rows, _ in anonymize_questionnaire_responses(cutoff, chunk_size=args.chunk_size,
+                                                               start_after_id=start_after_id):
+        total += rows
+        _write_checkpoint(args.checkpoint, {'cutoff': cutoff.isoformat(), 'last_id': last_id})
+        elapsed = time.monotonic() - started
+        print(f"   {total:,} שאלונים עד id {last_id} ({total / elapsed:,.0f} שורות/שנייה)", flush=True)
+        if args.pause:
+            # Leave room between chunks for live traffic
+            time.sleep(args.pause)
+
+    if os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    elapsed = time.monotonic() - started
+    print(f"✅ עברו אנונימיזציה {total:,} שאלונים שנוצרו לפני {cutoff:%Y-%m-%d} ב-{elapsed:.1f} שניות "
+          f"({total / elapsed if elapsed else 0:,.0f} שורות/שנייה)")
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """בניית ממשק שורת הפקודה"""
+    parser = argparse.ArgumentParser(description="משימות תחזוקה ליונתן הפסיכו-בוט")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    reconcile = subparsers.add_parser('reconcile-counts', help="תיקון message_count בשיחות")
+    reconcile.add_argument('--batch-size', type=int, default=1000)
+    reconcile.set_defaults(func=cmd_reconcile_counts)
+
+    score = subparsers.add_parser('score-messages', help="מילוי ציוני סנטימנט ורעילות להודעות")
+    score.add_argument('--chunk-size', type=int, default=5000)
+    score.add_argument('--rescore', action='store_true', help="ציון מחדש גם של הודעות שכבר צוינו")
+    score.set_defaults(func=cmd_score_messages)
+
+    archive = subparsers.add_parser('archive-conversations', help="העברת שיחות ישנות שהסתיימו לארכיון")
+    archive.add_argument('--older-than-days', type=int, default=None,
+                         help="ברירת מחדל: ARCHIVE_AFTER_DAYS")
+    archive.add_argument('--batch-size', type=int, default=200)
+    archive.set_defaults(func=cmd_archive_conversations)
+
+    restore = subparsers.add_parser('restore-conversation', help="החזרת שיחה מהארכיון")
+    restore.add_argument('conversation_id', type=int)
+    restore.set_defaults(func=cmd_restore_conversation)
+
+    export = subparsers.add_parser('export-parent', help="ייצוא כל הנתונים של הורה (NDJSON)")
+    export.add_argument('parent_id')
+    export.add_argument('--output', default='-', help="קובץ יעד (ברירת מחדל: stdout)")
+    export.set_defaults(func=cmd_export_parent)
+
+    stats = subparsers.add_parser('db-stats', help="ספירות הטבלאות והשיחות לפי סטטוס")
+    stats.add_argument('--approximate', action='store_true',
+                       help="סה\"כ שורות מסטטיסטיקות ה-planner במקום COUNT (ללא סריקת טבלה)")
+    stats.set_defaults(func=cmd_db_stats)
+
+    anonymize = subparsers.add_parser('anonymize-questionnaires', help="אנונימיזציה של שאלונים ישנים")
+    anonymize.add_argument('--older-than-days', type=int, default=None,
+                           help="ברירת מחדל: ANONYMIZE_QUESTIONNAIRES_AFTER_DAYS")
+    anonymize.add_argument('--chunk-size', type=int, default=1000)
+    anonymize.add_argument('--checkpoint', default='logs/anonymize-questionnaires.checkpoint',
+                           help="קובץ נקודת ההמשך - הרצה חוזרת ממשיכה ממנו")
+    anonymize.add_argument('--pause', type=float, default=0.0, help="שניות המתנה בין chunks")
+    anonymize.set_defaults(func=cmd_anonymize_questionnaires)
+
+    return parser
+
+
+def main():
+    """פונקציה ראשית"""
+    args = build_parser().parse_args()
+
+    from app import app
+    with app.app_context():
+        sys.exit(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+# message_writer.py - כתיבת הודעות צ'אט באצוות (write-behind)
+"""
+Write-behind persistence for chat messages.
+
+By default every chat turn commits the user Message and the bot Message in
+two separate transactions. With MESSAGE_WRITE_MODE=write_behind the messages
+are queued per worker and a background thread inserts them in bulk, together
+with one message_count UPDATE per conversation, every
+MESSAGE_FLUSH_INTERVAL_MS milliseconds or as soon as MESSAGE_FLUSH_MAX_ROWS
+rows are waiting - one transaction (and one fsync) for many turns.
+
+Durability (MESSAGE_WRITE_DURABILITY):
+- buffered: the caller returns as soon as the row is queued. Rows still in the
+  queue are lost if the process is killed (a normal shutdown drains it).
+- commit: the caller waits until the batch holding its row is committed
+  (group commit) - same guarantee as a direct commit, fewer transactions.
+  If the row is dropped, or not committed within MESSAGE_COMMIT_TIMEOUT,
+  write() returns False and the caller commits it directly.
+
+A batch that fails on a row-level error (integrity or data error, e.g. a
+message for a conversation that was just archived) is split in halves until
+only the offending rows fail; the rest are written. Other failures (the
+database is unreachable) retry the whole batch.
+
+Bulk inserts go through Core, so the Message after_insert hook that keeps
+conversation.message_count does not fire; the writer applies the counts
+itself in the same transaction.
+"""
+
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime, timezone
+from typing import Any, Deque, Dict, List, Optional
+
+from sqlalchemy import bindparam, func, insert, update
+from sqlalchemy.exc import DataError, IntegrityError
+
+from models import db, Conversation, Message
+
+logger = logging.getLogger(__name__)
+
+# Failed batches are retried this many times before being dropped
+MAX_FLUSH_ATTEMPTS = 3
+
+class PendingMessage:
+    """שורת הודעה שממתינה לכתיבה"""
+    __slots__ = ('row', 'done', 'attempts', 'committed')
+
+    def __init__(self, row: Dict[str, Any], wait: bool):
+        self.row = row
+        self.done = threading.Event() if wait else None
+        self.attempts = 0
+        self.committed = False
+
+def message_row(conversation_id: int, sender_type: str, content: str, **fields) -> Dict[str, Any]:
+    """ערכי עמודות להודעה, כמו שמחשב Message.__init__"""
+    row = {
+        'conversation_id': conversation_id,
+        'sender_type': sender_type,
+        'content': content,
+        'timestamp': datetime.now(timezone.utc),
+        'message_type': 'text',
+        'is_edited': False,
+        'character_count': len(content),
+        'word_count': len(content.split())
+    }
+    row.update(fields)
+    return row
+
+class MessageWriter:
+    """תור הודעות לכל worker עם thread שמבצע flush באצוות"""
+
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.interval = 0.05
+        self.max_rows = 200
+        self.max_queue = 10000
+        self.wait_for_commit = False
+        self.commit_timeout = 5.0
+        self._queue: Deque[PendingMessage] = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self._stopping = False
+        self.flushed_rows = 0
+        self.flushed_batches = 0
+        self.dropped_rows = 0
+
+    def init_app(self, app):
+        """הגדרת הכותב לפי הגדרות האפליקציה"""
+        self.app = app
+        self.enabled = app.config.get('MESSAGE_WRITE_MODE', 'sync') == 'write_behind'
+        self.interval = app.config.get('MESSAGE_FLUSH_INTERVAL_MS', 50) / 1000
+        self.max_rows = max(1, app.config.get('MESSAGE_FLUSH_MAX_ROWS', 200))
+        self.max_queue = app.config.get('MESSAGE_QUEUE_MAX_ROWS', 10000)
+        self.wait_for_commit = app.config.get('MESSAGE_WRITE_DURABILITY', 'buffered') == 'commit'
+        self.commit_timeout = app.config.get('MESSAGE_COMMIT_TIMEOUT', 5.0)
+        if self.enabled:
+            atexit.register(self.close)
+            logger.info(f"✅ Write-behind message persistence enabled "
+                        f"({self.interval * 1000:.0f}ms / {self.max_rows} rows, "
+                        f"{'commit' if self.wait_for_commit else 'buffered'})")
+
+    def _ensure_started(self):
+        # Threads don't survive a fork - start one per worker process
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            if self._pid != os.getpid():
+                # A forked child starts with an empty queue and its own lifecycle
+                self._queue.clear()
+                self._stopping = False
+            elif self._stopping:
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='message-writer', daemon=True)
+            self._thread.start()
+
+    def write(self, conversation_id: int, sender_type: str, content: str, **fields) -> bool:
+        """תור הודעה לכתיבה. מחזיר False אם הכותב כבוי, התור מלא, או (במצב commit) שהשורה לא נכתבה - על הקורא לכתוב ישירות"""
+        if not self.enabled:
+            return False
+        self._ensure_started()
+
+        pending = PendingMessage(message_row(conversation_id, sender_type, content, **fields), self.wait_for_commit)
+        with self._lock:
+            if self._stopping:
+                return False
+            if len(self._queue) >= self.max_queue:
+                logger.warning("Message write-behind queue full, writing directly")
+                return False
+            self._queue.append(pending)
+            if len(self._queue) >= self.max_rows:
+                self._wakeup.set()
+
+        if pending.done is None:
+            return True
+        if not pending.done.wait(self.commit_timeout):
+            with self._lock:
+                if pending in self._queue:
+                    # Not picked up yet - withdraw it so the caller's direct commit is the only copy
+                    self._queue.remove(pending)
+                    logger.warning(f"Message for conversation {conversation_id} not committed within "
+                                   f"{self.commit_timeout}s, writing directly")
+                    return False
+            # Its batch is being written right now - wait for the outcome
+            if not pending.done.wait(self.commit_timeout):
+                logger.error(f"Message for conversation {conversation_id} still in flight after "
+                             f"{2 * self.commit_timeout}s, writing directly")
+                return False
+        return pending.committed
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def _take_batch(self) -> List[PendingMessage]:
+        with self._lock:
+            count = min(len(self._queue), self.max_rows)
+            return [self._queue.popleft() for _ in range(count)]
+
+    def flush(self) -> int:
+        """כתיבת כל ההודעות שבתור, באצוות של עד max_rows. מחזיר את מספר השורות שנכתבו"""
+        written = 0
+        with self._flush_lock:
+            while True:
+                batch = self._take_batch()
+                if not batch:
+                    return written
+                failed = self._write_rows(batch)
+                written += len(batch) - len(failed)
+                if failed:
+                    self._requeue(failed)
+                    if len(failed) == len(batch):
+                        return written
+
+    def _write_rows(self, batch: List[PendingMessage]) -> List[PendingMessage]:
+        """כתיבת אצווה; בשגיאה ברמת שורה - פיצול לחצאים עד שרק השורות הפגומות נכשלות. מחזיר את מה שלא נכתב"""
+        try:
+            self._write_batch(batch)
+        except (IntegrityError, DataError) as e:
+            if len(batch) == 1:
+                logger.error(f"Message for conversation {batch[0].row['conversation_id']} rejected: {e}")
+                return batch
+            middle = len(batch) // 2
+            return self._write_rows(batch[:middle]) + self._write_rows(batch[middle:])
+        except Exception as e:
+            logger.error(f"Message batch flush failed ({len(batch)} rows): {e}")
+            return batch
+        return []
+
+    def _write_batch(self, batch: List[PendingMessage]):
+        rows = [pending.row for pending in batch]
+        counts = Counter(row['conversation_id'] for row in rows)
+        conversation = Conversation.__table__
+        with self.app.app_context():
+            try:
+                db.session.execute(insert(Message.__table__), rows)
+                db.session.execute(
+                    update(conversation)
+                    .where(conversation.c.id == bindparam('conversation_id_'))
+                    .values(message_count=func.coalesce(conversation.c.message_count, 0) + bindparam('added')),
+                    [{'conversation_id_': cid, 'added': added} for cid, added in counts.items()]
+                )
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+
+        self.flushed_rows += len(rows)
+        self.flushed_batches += 1
+        for pending in batch:
+            pending.committed = True
+            if pending.done is not None:
+                pending.done.set()
+
+    def _requeue(self, batch: List[PendingMessage]):
+        retry = []
+        for pending in batch:
+            pending.attempts += 1
+            if pending.attempts < MAX_FLUSH_ATTEMPTS:
+                retry.append(pending)
+            else:
+                self.dropped_rows += 1
+                logger.error(f"Dropping message for conversation {pending.row['conversation_id']} "
+                             f"after {MAX_FLUSH_ATTEMPTS} failed flushes")
+                if pending.done is not None:
+                    pending.done.set()
+        with self._lock:
+            self._queue.extendleft(reversed(retry))
+
+    def close(self, timeout: float = 10.0):
+        """ריקון התור בכיבוי: עצירת ה-thread וכתיבת כל מה שנשאר"""
+        if not self.enabled or self._pid != os.getpid():
+            return
+        with self._lock:
+            self._stopping = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        deadline = time.monotonic() + timeout
+        while self.pending() and time.monotonic() < deadline:
+            self.flush()
+        if self.pending():
+            logger.error(f"Shutdown with {self.pending()} unwritten messages")
+
+    def pending(self) -> int:
+        """מספר ההודעות שממתינות בתור"""
+        with self._lock:
+            return len(self._queue)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """סטטיסטיקות כתיבה"""
+        return {
+            'enabled': self.enabled,
+            'pending': self.pending(),
+            'flushed_rows': self.flushed_rows,
+            'flushed_batches': self.flushed_batches,
+            'dropped_rows': self.dropped_rows
+        }
+
+# מופע גלובלי לכל worker
+message_writer = MessageWriter()
+
+__all__ = [
+    'MessageWriter',
+    'message_writer',
+    'message_row'
+]
@@ -0,0 +1,257 @@
+# metrics.py - מדדי Prometheus ליונתן (מופעל עם ENABLE_METRICS)
+"""
+Prometheus metrics for the chat service.
+
+Enabled with ENABLE_METRICS=true and requires `prometheus-client`. When metrics
+are disabled (or the package is missing) every instrument below is a no-op, so
+call sites never need to check.
+
+Multiple gunicorn workers: set PROMETHEUS_MULTIPROC_DIR to an empty directory
+shared by the workers (wiped on deploy). Each worker then writes its samples
+to mmap files and /api/metrics aggregates all of them. Add to gunicorn.conf.py:
+
+    from prometheus_client import multiprocess
+    def child_exit(server, worker):
+        multiprocess.mark_process_dead(worker.pid)
+
+Recording a sample is a dict lookup plus a float add (an mmap write in
+multiprocess mode) - no locks are held across the request.
+"""
+
+import logging
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional, Tuple
+
+from config import ADVANCED_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+try:
+    from prometheus_client import (
+        CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram,
+        generate_latest, multiprocess
+    )
+    PROMETHEUS_AVAILABLE = True
+except ImportError:
+    PROMETHEUS_AVAILABLE = False
+    CONTENT_TYPE_LATEST = 'text/plain; version=0.0.4; charset=utf-8'
+
+METRICS_ENABLED = ADVANCED_SETTINGS['ENABLE_METRICS'] and PROMETHEUS_AVAILABLE
+if ADVANCED_SETTINGS['ENABLE_METRICS'] and not PROMETHEUS_AVAILABLE:
+    logger.warning("ENABLE_METRICS is set but prometheus-client is not installed - metrics disabled")
+
+MULTIPROCESS = bool(os.environ.get('PROMETHEUS_MULTIPROC_DIR'))
+
+# Latency buckets (seconds) - chat turns run from tens of ms (fallback) to tens of seconds (long AI answers)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+
+class _NoopMetric:
+    """מדד ריק כשהמדדים כבויים"""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount: float = 1):
+        pass
+
+    def dec(self, amount: float = 1):
+        pass
+
+    def observe(self, amount: float):
+        pass
+
+
+if METRICS_ENABLED:
+    REQUEST_LATENCY = Histogram(
+        'yonatan_http_request_duration_seconds', "Request latency by endpoint, including streamed bodies",
+        ['endpoint', 'method', 'status'], buckets=LATENCY_BUCKETS
+    )
+    CHAT_TIME_TO_FIRST_CHUNK = Histogram(
+        'yonatan_chat_time_to_first_chunk_seconds', "Time from receiving a chat request to its first body chunk",
+        ['source'], buckets=LATENCY_BUCKETS
+    )
+    GEMINI_LATENCY = Histogram(
+        'yonatan_gemini_request_duration_seconds', "Gemini call duration until the stream is fully consumed",
+        ['outcome'], buckets=LATENCY_BUCKETS
+    )
+    GEMINI_ERRORS = Counter(
+        'yonatan_gemini_errors_total', "Gemini call failures by exception class", ['error_class']
+    )
+    FALLBACK_ACTIVATIONS = Counter(
+        'yonatan_fallback_activations_total', "Replies produced by the fallback system, by detected intent", ['intent']
+    )
+    DB_QUERIES_PER_REQUEST = Histogram(
+        'yonatan_db_queries_per_request', "SQL statements executed per request", ['endpoint'],
+        buckets=QUERY_COUNT_BUCKETS
+    )
+    DB_TIME_PER_REQUEST = Histogram(
+        'yonatan_db_time_per_request_seconds', "Time spent in SQL statements per request", ['endpoint'],
+        buckets=LATENCY_BUCKETS
+    )
+    ACTIVE_STREAMS = Gauge(
+        'yonatan_active_streams', "Chat responses currently streaming", multiprocess_mode='livesum'
+    )
+    AI_CALLS_IN_FLIGHT = Gauge(
+        'yonatan_ai_calls_in_flight', "Gemini calls currently holding a limiter slot", multiprocess_mode='livesum'
+    )
+    AI_QUEUE_DEPTH = Gauge(
+        'yonatan_ai_queue_depth', "Gemini calls waiting for a limiter slot", multiprocess_mode='livesum'
+    )
+    AI_QUEUE_WAIT = Histogram(
+        'yonatan_ai_queue_wait_seconds', "Time spent waiting for a Gemini call slot, by outcome (acquired, timeout, rejected)",
+        ['outcome'], buckets=LATENCY_BUCKETS
+    )
+    AI_COALESCED_CALLS = Counter(
+        'yonatan_ai_coalesced_calls_total', "Gemini calls served by following an identical in-flight call"
+    )
+    BACKGROUND_TASKS = Counter(
+        'yonatan_background_tasks_total', "Background tasks by outcome (queued, dropped, ok, error)", ['task', 'outcome']
+    )
+    AI_CIRCUIT_TRANSITIONS = Counter(
+        'yonatan_ai_circuit_transitions_total', "AI circuit breaker state changes by new state", ['state']
+    )
+    RESPONSE_CACHE_LOOKUPS = Counter(
+        'yonatan_response_cache_lookups_total', "Gemini response cache lookups by result (exact, near, miss)",
+        ['result']
+    )
+else:
+    REQUEST_LATENCY = CHAT_TIME_TO_FIRST_CHUNK = GEMINI_LATENCY = GEMINI_ERRORS = _NoopMetric()
+    FALLBACK_ACTIVATIONS = DB_QUERIES_PER_REQUEST = DB_TIME_PER_REQUEST = ACTIVE_STREAMS = _NoopMetric()
+    RESPONSE_CACHE_LOOKUPS = AI_CIRCUIT_TRANSITIONS = _NoopMetric()
+    AI_CALLS_IN_FLIGHT = AI_QUEUE_DEPTH = AI_QUEUE_WAIT = AI_COALESCED_CALLS = _NoopMetric()
+    BACKGROUND_TASKS = _NoopMetric()
+
+
+@contextmanager
+def track_gemini_call():
+    """מדידת קריאה ל-Gemini עד סוף הזרם, כולל סוג השגיאה אם נכשלה"""
+    started = time.perf_counter()
+    outcome = 'ok'
+    try:
+        yield
+    except Exception as e:
+        outcome = 'error'
+        GEMINI_ERRORS.labels(error_class=type(e).__name__).inc()
+        raise
+    except BaseException:
+        # GeneratorExit / CancelledError - the client went away mid-stream
+        outcome = 'cancelled'
+        raise
+    finally:
+        GEMINI_LATENCY.labels(outcome=outcome).observe(time.perf_counter() - started)
+
+
+# --- Per-request DB accounting ---
+
+class RequestDBStats:
+    """מונה שאילתות וזמן DB לבקשה אחת"""
+    __slots__ = ('queries', 'seconds')
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+# Follows asyncio.to_thread, so queries run for the async chat route are attributed too
+_request_db_stats: ContextVar[Optional[RequestDBStats]] = ContextVar('request_db_stats', default=None)
+
+def start_request_db_stats() -> RequestDBStats:
+    stats = RequestDBStats()
+    _request_db_stats.set(stats)
+    return stats
+
+def finish_request_db_stats(endpoint: str, stats: Optional[RequestDBStats] = None):
+    """רישום סטטיסטיקות ה-DB של הבקשה וניתוקן מההקשר"""
+    if stats is None:
+        stats = _request_db_stats.get()
+    _request_db_stats.set(None)
+    if stats is not None:
+        DB_QUERIES_PER_REQUEST.labels(endpoint=endpoint).observe(stats.queries)
+        DB_TIME_PER_REQUEST.labels(endpoint=endpoint).observe(stats.seconds)
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['metrics_query_start'] = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('metrics_query_start', None)
+    stats = _request_db_stats.get()
+    if stats is not None and started is not None:
+        stats.queries += 1
+        stats.seconds += time.perf_counter() - started
+
+
+# --- Flask integration ---
+
+def init_metrics(app, db):
+    """חיבור המדידה לאפליקציה ולמנוע ה-DB (רק כשהמדדים מופעלים)"""
+    if not METRICS_ENABLED:
+        return
+
+    from flask import g, request
+    from sqlalchemy import event
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+    @app.before_request
+    def _start_request_metrics():
+        g.metrics_started = time.perf_counter()
+        g.metrics_db_stats = start_request_db_stats()
+
+    @app.after_request
+    def _record_response_status(response):
+        g.metrics_status = response.status_code
+        return response
+
+    # Teardown runs after a stream_with_context body is fully sent
+    @app.teardown_request
+    def _finish_request_metrics(exc):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        status = g.pop('metrics_status', 500 if exc else 200)
+        REQUEST_LATENCY.labels(endpoint=endpoint, method=request.method, status=str(status)).observe(
+            time.perf_counter() - started
+        )
+        finish_request_db_stats(endpoint, g.pop('metrics_db_stats', None))
+
+    logger.info(f"✅ Metrics enabled{' (multiprocess)' if MULTIPROCESS else ''}")
+
+def render_metrics() -> Tuple[bytes, str]:
+    """פלט המדדים בפורמט text exposition, מאוחד מכל ה-workers במצב multiprocess"""
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+__all__ = [
+    'METRICS_ENABLED',
+    'REQUEST_LATENCY',
+    'CHAT_TIME_TO_FIRST_CHUNK',
+    'GEMINI_LATENCY',
+    'GEMINI_ERRORS',
+    'FALLBACK_ACTIVATIONS',
+    'DB_QUERIES_PER_REQUEST',
+    'DB_TIME_PER_REQUEST',
+    'ACTIVE_STREAMS',
+    'RESPONSE_CACHE_LOOKUPS',
+    'AI_CIRCUIT_TRANSITIONS',
+    'AI_CALLS_IN_FLIGHT',
+    'AI_QUEUE_DEPTH',
+    'AI_QUEUE_WAIT',
+    'AI_COALESCED_CALLS',
+    'BACKGROUND_TASKS',
+    'track_gemini_call',
+    'start_request_db_stats',
+    'finish_request_db_stats',
+    'init_metrics',
+    'render_metrics'
+]
@@ -0,0 +1,158 @@
+# migrate.py
+# סקריפט מיגרציות לבסיס נתונים קיים - עובד בפיתוח ובפרודקשן
+"""
+Schema migrations for databases that already exist.
+
+create_tables.py only creates missing tables, it never alters existing ones.
+Every change to an existing schema (indexes, new columns, new tables) is
+registered here as a migration and recorded in the `schema_migration` table,
+so running the script again is a no-op.
+
+On PostgreSQL indexes are built with CREATE INDEX CONCURRENTLY so the chat
+tables stay writable while the index is built. That statement cannot run
+inside a transaction, so migrations run on an AUTOCOMMIT connection. If a
+concurrent build is interrupted Postgres leaves an INVALID index behind;
+drop it by hand and rerun this script.
+
+Usage:
+    python migrate.py            # apply pending migrations
+    python migrate.py --status   # list applied / pending migrations
+"""
+
+import os
+import sys
+from datetime import datetime, timezone
+from typing import Callable, List, Sequence, Tuple
+
+from sqlalchemy import text
+
+MIGRATION_TABLE = 'schema_migration'
+
+
+def create_index(connection, name: str, table: str, columns: Sequence[str]):
+    """יצירת אינדקס בלי לנעול את הטבלה (CONCURRENTLY בפוסטגרס)"""
+    column_list = ', '.join(columns)
+    if connection.dialect.name == 'postgresql':
+        sql = f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({column_list})"
+    else:
+        sql = f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({column_list})"
+    connection.exec_driver_sql(sql)
+
+
+def analyze_tables(connection, tables: Sequence[str]):
+    """עדכון סטטיסטיקות כדי שה-planner ישתמש באינדקסים החדשים"""
+    for table in tables:
+        connection.exec_driver_sql(f"ANALYZE {table}")
+
+
+def migration_001_chat_hot_path_indexes(connection):
+    """אינדקסים לשאילתות של כל תור צ'אט"""
+    create_index(connection, 'ix_conversation_parent_status', 'conversation', ['parent_id', 'status'])
+    create_index(connection, 'ix_message_conversation_timestamp', 'message', ['conversation_id', 'timestamp', 'id'])
+    create_index(connection, 'ix_questionnaire_response_parent_created', 'questionnaire_response', ['parent_id', 'created_at'])
+    create_index(connection, 'ix_child_parent_id', 'child', ['parent_id'])
+    analyze_tables(connection, ['conversation', 'message', 'questionnaire_response', 'child'])
+
+
+def migration_002_conversation_archive(connection):
+    """טבלת הארכיון לשיחות ישנות ואינדקס לבחירת השיחות להעברה"""
+    from models import ConversationArchive
+
+    ConversationArchive.__table__.create(bind=connection, checkfirst=True)
+    create_index(connection, 'ix_conversation_archive_parent', 'conversation_archive', ['parent_id', 'conversation_id'])
+    create_index(connection, 'ix_conversation_status_end_time', 'conversation', ['status', 'end_time'])
+    analyze_tables(connection, ['conversation'])
+
+
+def migration_003_conversation_parent_start_time(connection):
+    """אינדקס לשיחות האחרונות של הורה (Parent.get_active_conversations)"""
+    create_index(connection, 'ix_conversation_parent_start_time', 'conversation', ['parent_id', 'start_time'])
+    analyze_tables(connection, ['conversation'])
+
+
+# רשימת המיגרציות לפי סדר ההרצה - לעולם לא לשנות מזהה של מיגרציה שכבר רצה
+MIGRATIONS: List[Tuple[str, Callable]] = [
+    ('001_chat_hot_path_indexes', migration_001_chat_hot_path_indexes),
+    ('002_conversation_archive', migration_002_conversation_archive),
+    ('003_conversation_parent_start_time', migration_003_conversation_parent_start_time),
+]
+
+
+def ensure_migration_table(connection):
+    """יצירת טבלת המעקב אחרי מיגרציות"""
+    connection.exec_driver_sql(
+        f"CREATE TABLE IF NOT EXISTS {MIGRATION_TABLE} ("
+        "id VARCHAR(100) PRIMARY KEY, "
+        "applied_at TIMESTAMP NOT NULL)"
+    )
+
+
+def get_applied_migrations(connection) -> set:
+    """מזהי המיגרציות שכבר הורצו"""
+    result = connection.exec_driver_sql(f"SELECT id FROM {MIGRATION_TABLE}")
+    return {row[0] for row in result}
+
+
+def run_migrations(engine, status_only: bool = False) -> bool:
+    """הרצת כל המיגרציות שעדיין לא הורצו"""
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        ensure_migration_table(connection)
+        applied = get_applied_migrations(connection)
+
+        pending = [(migration_id, func) for migration_id, func in MIGRATIONS if migration_id not in applied]
+
+        if status_only:
+            for migration_id, _ in MIGRATIONS:
+                mark = "✅" if migration_id in applied else "⏳"
+                print(f"   {mark} {migration_id}")
+            return True
+
+        if not pending:
+            print("✅ אין מיגרציות ממתינות")
+            return True
+
+        for migration_id, func in pending:
+            print(f"🔧 מריץ מיגרציה {migration_id}...")
+            try:
+                func(connection)
+            except Exception as e:
+                print(f"❌ מיגרציה {migration_id} נכשלה: {e}")
+                return False
+
+            connection.execute(
+                text(f"INSERT INTO {MIGRATION_TABLE} (id, applied_at) VALUES (:id, :applied_at)"),
+                {'id': migration_id, 'applied_at': datetime.now(timezone.utc)}
+            )
+            print(f"   ✓ {migration_id}")
+
+    return True
+
+
+def main():
+    """פונקציה ראשית"""
+    print("=" * 60)
+    print("🧱 מיגרציות למסד הנתונים של יונתן הפסיכו-בוט")
+    print("=" * 60)
+
+    try:
+        from app import app, db
+    except ImportError as e:
+        print(f"❌ שגיאה בייבוא מודולים: {e}")
+        sys.exit(1)
+
+    status_only = '--status' in sys.argv
+
+    with app.app_context():
+        print(f"🌍 סביבה: {os.environ.get('FLASK_ENV', 'production')}")
+        print(f"🗄️  בסיס נתונים: {app.config['SQLALCHEMY_DATABASE_URI'][:50]}...")
+        success = run_migrations(db.engine, status_only=status_only)
+
+    if not success:
+        print("🚨 המיגרציות לא הושלמו - בדוק את השגיאות למעלה")
+        sys.exit(1)
+
+    print("🎉 מסד הנתונים מעודכן!")
+
+
+if __name__ == "__main__":
+    main()
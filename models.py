@@ -1,9 +1,14 @@
 # models.py - v10.1 - Fixed metadata naming conflict
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import bindparam, event, func, or_, select, text, update
+from sqlalchemy.orm import object_session
+from sqlalchemy.orm.attributes import set_committed_value
 from datetime import datetime, timezone
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, Iterator, List, Tuple
 import json
 import hashlib
+import threading
+import time
 
 db = SQLAlchemy()
 
@@ -40,6 +45,7 @@ class Parent(db.Model):
     children = db.relationship('Child', backref='parent', lazy=True, cascade="all, delete-orphan")
     conversations = db.relationship('Conversation', backref='parent', lazy=True, cascade="all, delete-orphan")
     questionnaires = db.relationship('QuestionnaireResponse', backref='parent', lazy=True, cascade="all, delete-orphan")
+    archived_conversations = db.relationship('ConversationArchive', backref='parent', lazy=True, cascade="all, delete-orphan")
     
     def __repr__(self):
         return f'<Parent {self.name}>'
@@ -53,7 +59,7 @@ class Parent(db.Model):
             'created_at': self.created_at.isoformat(),
             'last_activity': self.last_activity.isoformat(),
             'preferred_language': self.preferred_language,
-            'children_count': len(self.children)
+            'children_count': self.get_children_count()
         }
         
         if include_sensitive:
@@ -71,13 +77,27 @@ class Parent(db.Model):
         self.last_activity = datetime.now(timezone.utc)
     
     def get_active_conversations(self) -> List['Conversation']:
-        """Get active conversations from last 24 hours"""
+        """Get active conversations from last 24 hours (range scan on ix_conversation_parent_start_time)"""
         from datetime import timedelta
         last_24h = datetime.now(timezone.utc) - timedelta(hours=24)
-        return [conv for conv in self.conversations if conv.start_time >= last_24h]
+        return db.session.scalars(
+            select(Conversation)
+            .where(Conversation.parent_id == self.id, Conversation.start_time >= last_24h)
+            .order_by(Conversation.start_time, Conversation.id)
+        ).all()
+    
+    def get_children_count(self) -> int:
+        """Number of children - a COUNT on ix_child_parent_id unless the relationship is already loaded"""
+        if 'children' in self.__dict__:
+            return len(self.children)
+        return db.session.scalar(select(func.count(Child.id)).where(Child.parent_id == self.id)) or 0
 
 class Child(db.Model):
     __tablename__ = 'child'
+    __table_args__ = (
+        # parent.children lookup when opening a conversation
+        db.Index('ix_child_parent_id', 'parent_id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
@@ -155,6 +175,14 @@ class Child(db.Model):
 
 class Conversation(db.Model):
     __tablename__ = 'conversation'
+    __table_args__ = (
+        # Active conversation lookup on every chat turn: filter_by(parent_id=..., status='active')
+        db.Index('ix_conversation_parent_status', 'parent_id', 'status'),
+        # Archival job: finished conversations by age
+        db.Index('ix_conversation_status_end_time', 'status', 'end_time'),
+        # Parent.get_active_conversations(): a parent's conversations since a given time
+        db.Index('ix_conversation_parent_start_time', 'parent_id', 'start_time'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     parent_id = db.Column(db.String(100), db.ForeignKey('parent.id'), nullable=False)
@@ -222,8 +250,10 @@ class Conversation(db.Model):
         self.update_message_count()
     
     def update_message_count(self):
-        """Update message count"""
-        self.message_count = len(self.messages)
+        """Recount messages with a COUNT query (message_count is normally kept by the Message insert hook)"""
+        self.message_count = db.session.scalar(
+            select(func.count(Message.id)).where(Message.conversation_id == self.id)
+        )
     
     def get_duration(self) -> Optional[float]:
         """Get conversation duration in minutes"""
@@ -233,6 +263,10 @@ class Conversation(db.Model):
 
 class Message(db.Model):
     __tablename__ = 'message'
+    __table_args__ = (
+        # Conversation history in chronological order (id breaks timestamp ties)
+        db.Index('ix_message_conversation_timestamp', 'conversation_id', 'timestamp', 'id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     conversation_id = db.Column(db.Integer, db.ForeignKey('conversation.id'), nullable=False)
@@ -308,8 +342,77 @@ class Message(db.Model):
         message_metadata = json.loads(self.message_metadata)
         return message_metadata.get(key, default)
 
+def _adjust_message_count(connection, message: 'Message', delta: int):
+    """Atomically bump conversation.message_count in the flush transaction"""
+    connection.execute(
+        update(Conversation.__table__)
+        .where(Conversation.__table__.c.id == message.conversation_id)
+        .values(message_count=func.coalesce(Conversation.__table__.c.message_count, 0) + delta)
+    )
+    
+    # Keep an already-loaded Conversation in the session in step with the row
+    session = object_session(message)
+    if session is not None:
+        conversation = session.identity_map.get(
+            session.identity_key(Conversation, message.conversation_id)
+        )
+        if conversation is not None and 'message_count' in conversation.__dict__:
+            set_committed_value(conversation, 'message_count', (conversation.message_count or 0) + delta)
+
+@event.listens_for(Message, 'after_insert')
+def _increment_message_count(mapper, connection, target):
+    _adjust_message_count(connection, target, 1)
+
+@event.listens_for(Message, 'after_delete')
+def _decrement_message_count(mapper, connection, target):
+    _adjust_message_count(connection, target, -1)
+
+class ConversationArchive(db.Model):
+    """Finished conversation moved out of the hot tables - see conversation_archive.py"""
+    __tablename__ = 'conversation_archive'
+    __table_args__ = (
+        db.Index('ix_conversation_archive_parent', 'parent_id', 'conversation_id'),
+    )
+    
+    conversation_id = db.Column(db.Integer, primary_key=True, autoincrement=False)  # original conversation.id
+    parent_id = db.Column(db.String(100), db.ForeignKey('parent.id'), nullable=False)
+    status = db.Column(db.String(20), nullable=False)
+    start_time = db.Column(db.DateTime, nullable=True)
+    end_time = db.Column(db.DateTime, nullable=True)
+    message_count = db.Column(db.Integer, default=0)
+    archived_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    
+    # zlib-compressed JSON of the conversation row and all its message rows
+    payload_format = db.Column(db.String(20), nullable=False)
+    payload = db.Column(db.LargeBinary, nullable=False)
+    
+    def __repr__(self):
+        return f'<ConversationArchive {self.conversation_id}>'
+
+# Completely identifying answers, removed on anonymization
+ANONYMIZED_REMOVED_KEYS = ('email', 'phone', 'address')
+
+def anonymize_response_data(response_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Anonymized copy of questionnaire answers: names hashed, contact details removed"""
+    response_data = dict(response_data)
+    
+    # Remove or hash sensitive data
+    if 'parent_name' in response_data:
+        response_data['parent_name'] = f"Parent_{generate_secure_id(response_data['parent_name'])[:8]}"
+    if 'child_name' in response_data:
+        response_data['child_name'] = f"Child_{generate_secure_id(response_data['child_name'])[:8]}"
+    
+    for key in ANONYMIZED_REMOVED_KEYS:
+        response_data.pop(key, None)
+    
+    return response_data
+
 class QuestionnaireResponse(db.Model):
     __tablename__ = 'questionnaire_response'
+    __table_args__ = (
+        # Latest questionnaire of a parent: filter_by(parent_id=...) ordered by created_at
+        db.Index('ix_questionnaire_response_parent_created', 'parent_id', 'created_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     parent_id = db.Column(db.String(100), db.ForeignKey('parent.id'), nullable=False)
@@ -364,19 +467,7 @@ class QuestionnaireResponse(db.Model):
     def anonymize(self):
         """Anonymize the questionnaire response"""
         if not self.is_anonymized:
-            response_data = json.loads(self.response_data)
-            
-            # Remove or hash sensitive data
-            if 'parent_name' in response_data:
-                response_data['parent_name'] = f"Parent_{generate_secure_id(response_data['parent_name'])[:8]}"
-            if 'child_name' in response_data:
-                response_data['child_name'] = f"Child_{generate_secure_id(response_data['child_name'])[:8]}"
-            
-            # Remove completely identifying information
-            for key in ['email', 'phone', 'address']:
-                if key in response_data:
-                    del response_data[key]
-            
+            response_data = anonymize_response_data(json.loads(self.response_data))
             self.response_data = json.dumps(response_data, ensure_ascii=False)
             self.is_anonymized = True
             self.anonymized_at = datetime.now(timezone.utc)
@@ -401,17 +492,190 @@ def drop_all_tables():
     """Drop all database tables"""
     db.drop_all()
 
-def get_db_stats() -> Dict[str, Any]:
-    """Get database statistics"""
-    return {
-        'total_parents': Parent.query.count(),
-        'total_children': Child.query.count(),
-        'total_conversations': Conversation.query.count(),
-        'total_messages': Message.query.count(),
-        'total_questionnaires': QuestionnaireResponse.query.count(),
-        'active_conversations': Conversation.query.filter_by(status='active').count(),
-        'completed_conversations': Conversation.query.filter_by(status='completed').count()
-    }
+# get_db_stats() table totals
+STATS_TABLE_COUNTS = {
+    'total_parents': Parent,
+    'total_children': Child,
+    'total_conversations': Conversation,
+    'total_messages': Message,
+    'total_questionnaires': QuestionnaireResponse,
+    'archived_conversations': ConversationArchive
+}
+
+# get_db_stats() conversation counts by status - index scans on ix_conversation_status_end_time
+STATS_STATUS_COUNTS = {
+    'active_conversations': 'active',
+    'completed_conversations': 'completed'
+}
+
+_db_stats_snapshot: Dict[bool, Tuple[float, Dict[str, Any]]] = {}
+_db_stats_lock = threading.Lock()
+
+def _estimated_row_counts() -> Dict[str, int]:
+    """Row counts from the planner statistics (no table scan). Tables never analyzed are missing."""
+    tables = [model.__tablename__ for model in STATS_TABLE_COUNTS.values()]
+    dialect = db.session.get_bind().dialect.name
+    estimates: Dict[str, int] = {}
+    if dialect == 'postgresql':
+        regclasses = ', '.join(f"to_regclass('{table}')" for table in tables)
+        for relname, reltuples in db.session.execute(
+            text(f"SELECT relname, reltuples FROM pg_class WHERE oid IN ({regclasses})")
+        ):
+            # reltuples is -1 until the first VACUUM / ANALYZE
+            if reltuples is not None and reltuples >= 0:
+                estimates[relname] = int(reltuples)
+    elif dialect == 'sqlite':
+        try:
+            rows = db.session.execute(text("SELECT tbl, stat FROM sqlite_stat1")).all()
+        except Exception:
+            # No sqlite_stat1 before the first ANALYZE
+            return estimates
+        for table, stat in rows:
+            if table in tables and stat:
+                estimates[table] = max(estimates.get(table, 0), int(stat.split()[0]))
+    return estimates
+
+def get_db_stats(approximate: bool = False, max_age: float = 0) -> Dict[str, Any]:
+    """Get database statistics in one aggregated query.
+
+    approximate=True takes the table totals from the planner statistics
+    (pg_class.reltuples / sqlite_stat1) and only counts what is missing there.
+    The status counts are always exact - they are index scans. With max_age,
+    a snapshot up to that many seconds old is served from this worker's memory.
+    """
+    if max_age > 0:
+        with _db_stats_lock:
+            snapshot = _db_stats_snapshot.get(approximate)
+        if snapshot is not None and time.monotonic() - snapshot[0] < max_age:
+            return dict(snapshot[1])
+    
+    stats: Dict[str, Any] = {}
+    if approximate:
+        estimates = _estimated_row_counts()
+        for key, model in STATS_TABLE_COUNTS.items():
+            if model.__tablename__ in estimates:
+                stats[key] = estimates[model.__tablename__]
+    
+    counters = [
+        select(func.count()).select_from(model.__table__).scalar_subquery().label(key)
+        for key, model in STATS_TABLE_COUNTS.items() if key not in stats
+    ]
+    conversation = Conversation.__table__
+    counters.extend(
+        select(func.count()).select_from(conversation).where(conversation.c.status == status)
+        .scalar_subquery().label(key)
+        for key, status in STATS_STATUS_COUNTS.items()
+    )
+    stats.update(db.session.execute(select(*counters)).one()._mapping)
+    stats = {key: stats[key] for key in (*STATS_TABLE_COUNTS, *STATS_STATUS_COUNTS)}
+    stats['approximate'] = approximate
+    
+    with _db_stats_lock:
+        _db_stats_snapshot[approximate] = (time.monotonic(), stats)
+    return dict(stats)
+
+def reconcile_message_counts(batch_size: int = 1000) -> int:
+    """Repair drift between conversation.message_count and the actual message rows.
+
+    Walks conversations in id ranges and fixes each range with one set-based
+    UPDATE, committing per batch so row locks are short. Returns the number
+    of conversations that were corrected.
+    """
+    conversation = Conversation.__table__
+    message = Message.__table__
+    
+    max_id = db.session.scalar(select(func.max(conversation.c.id))) or 0
+    repaired = 0
+    
+    for start_id in range(1, max_id + 1, batch_size):
+        end_id = start_id + batch_size - 1
+        actual_count = (
+            select(func.count(message.c.id))
+            .where(message.c.conversation_id == conversation.c.id)
+            .scalar_subquery()
+        )
+        result = db.session.execute(
+            update(conversation)
+            .where(
+                conversation.c.id.between(start_id, end_id),
+                func.coalesce(conversation.c.message_count, -1) != actual_count
+            )
+            .values(message_count=actual_count)
+        )
+        db.session.commit()
+        repaired += result.rowcount or 0
+    
+    return repaired
+
+def anonymize_questionnaire_responses(cutoff: datetime, chunk_size: int = 1000,
+                                      start_after_id: int = 0) -> Iterator[Tuple[int, int, float]]:
+    """Anonymize every questionnaire response created before cutoff, in id-ordered chunks.
+
+    Each chunk is one short transaction: the answers that hold names or
+    contact details are rewritten with a single executemany UPDATE, and the
+    flags, anonymized_at, ip_address and user_agent of the whole chunk are
+    cleared with one set-based UPDATE. Both skip rows anonymized concurrently.
+    Yields (last_id, rows, seconds) per chunk - last_id is the checkpoint
+    to pass as start_after_id to resume.
+    """
+    questionnaire = QuestionnaireResponse.__table__
+    not_anonymized = or_(questionnaire.c.is_anonymized.is_(False), questionnaire.c.is_anonymized.is_(None))
+    last_id = start_after_id
+    
+    while True:
+        started = time.perf_counter()
+        rows = db.session.execute(
+            select(questionnaire.c.id, questionnaire.c.response_data)
+            .where(questionnaire.c.id > last_id, questionnaire.c.created_at < cutoff, not_anonymized)
+            .order_by(questionnaire.c.id)
+            .limit(chunk_size)
+        ).all()
+        if not rows:
+            return
+        
+        rewritten = []
+        for row in rows:
+            try:
+                response_data = json.loads(row.response_data)
+            except (TypeError, json.JSONDecodeError):
+                response_data = None
+            if not isinstance(response_data, dict):
+                # Unreadable or unexpected answers may still hold personal details - drop them
+                rewritten.append({'response_id': row.id, 'b_response_data': '{}'})
+                continue
+            anonymized = anonymize_response_data(response_data)
+            if anonymized != response_data:
+                rewritten.append({
+                    'response_id': row.id,
+                    'b_response_data': json.dumps(anonymized, ensure_ascii=False)
+                })
+        
+        ids = [row.id for row in rows]
+        try:
+            if rewritten:
+                db.session.execute(
+                    update(questionnaire)
+                    .where(questionnaire.c.id == bindparam('response_id'), not_anonymized)
+                    .values(response_data=bindparam('b_response_data')),
+                    rewritten
+                )
+            db.session.execute(
+                update(questionnaire)
+                .where(questionnaire.c.id.in_(ids), not_anonymized)
+                .values(
+                    is_anonymized=True,
+                    anonymized_at=datetime.now(timezone.utc),
+                    ip_address=None,
+                    user_agent=None
+                )
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        
+        last_id = ids[-1]
+        yield last_id, len(rows), time.perf_counter() - started
 
 # Export all models
 __all__ = [
@@ -422,7 +686,11 @@ __all__ = [
     'Conversation',
     'Message',
     'QuestionnaireResponse',
+    'ConversationArchive',
     'create_all_tables',
     'drop_all_tables',
-    'get_db_stats'
+    'get_db_stats',
+    'reconcile_message_counts',
+    'anonymize_response_data',
+    'anonymize_questionnaire_responses'
 ]
\ No newline at end of file
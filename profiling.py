@@ -0,0 +1,190 @@
+# profiling.py - פרופיילר דוגם לבקשות (מופעל עם ENABLE_PROFILING)
+"""
+Sampling profiler for production requests.
+
+Enabled with ENABLE_PROFILING=true. A profiled request gets a sampler thread
+that reads the request thread's stack every PROFILING_INTERVAL_MS through
+`sys._current_frames()` until teardown - which, for stream_with_context
+responses, is after the last chunk, so the streaming generator is included.
+
+A request is profiled when:
+- it carries `X-Profile: <PROFILING_TOKEN>` (ignored if no token is set), or
+- it is picked by PROFILING_SAMPLE_RATE (0.0 - 1.0), or
+- a profiling window is open: POST /api/profiling/window with the same header
+  and {"seconds": N} samples every thread of that worker for N seconds, which
+  also covers the asyncio chat route in asgi.py.
+
+Output is one folded-stacks file per profile in PROFILING_OUTPUT_DIR
+(`frame;frame;frame count` per line), ready for flamegraph.pl or speedscope.
+Sampling costs nothing on requests that are not profiled.
+"""
+
+import hmac
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, Optional
+
+from config import ADVANCED_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+PROFILING_ENABLED = ADVANCED_SETTINGS['ENABLE_PROFILING']
+
+# Longest window a single POST may open
+MAX_WINDOW_SECONDS = 300
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+def _fold(frame) -> str:
+    """מחסנית בפורמט folded: מהשורש אל העלה, מופרדת ב-;"""
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+class StackSampler:
+    """thread שדוגם מחסניות של thread אחד (או של כל ה-threads) במרווח קבוע"""
+
+    def __init__(self, interval: float, thread_id: Optional[int] = None):
+        self.interval = interval
+        self.thread_id = thread_id
+        self.samples: Counter = Counter()
+        self.started_at = time.time()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiling-sampler', daemon=True)
+
+    def start(self) -> 'StackSampler':
+        self._thread.start()
+        return self
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            if self.thread_id is not None:
+                frame = frames.get(self.thread_id)
+                if frame is not None:
+                    self.samples[_fold(frame)] += 1
+            else:
+                for thread_id, frame in frames.items():
+                    if thread_id != own_id:
+                        self.samples[_fold(frame)] += 1
+
+    def stop(self) -> Counter:
+        self._stop.set()
+        self._thread.join()
+        return self.samples
+
+class RequestProfiler:
+    """הגדרות הפרופיילר וכתיבת הפלט לדיסק"""
+
+    def __init__(self):
+        self.enabled = False
+        self.sample_rate = 0.0
+        self.interval = 0.005
+        self.output_dir = 'logs/profiles'
+        self.token: Optional[str] = None
+        self._window: Optional[StackSampler] = None
+        self._window_lock = threading.Lock()
+
+    def init_app(self, app):
+        """הגדרה לפי האפליקציה וחיבור ל-hooks של הבקשה"""
+        self.enabled = PROFILING_ENABLED
+        self.sample_rate = app.config.get('PROFILING_SAMPLE_RATE', 0.0)
+        self.interval = app.config.get('PROFILING_INTERVAL_MS', 5) / 1000
+        self.output_dir = app.config.get('PROFILING_OUTPUT_DIR', 'logs/profiles')
+        self.token = app.config.get('PROFILING_TOKEN') or None
+        if not self.enabled:
+            return
+
+        from flask import g, request
+
+        @app.before_request
+        def _start_request_profile():
+            if self.window_open() or not self.should_profile(request.headers.get('X-Profile')):
+                return
+            g.profile_sampler = StackSampler(self.interval, threading.get_ident()).start()
+
+        # Teardown runs after a stream_with_context body is fully sent
+        @app.teardown_request
+        def _finish_request_profile(exc):
+            sampler = g.pop('profile_sampler', None)
+            if sampler is None:
+                return
+            endpoint = request.url_rule.endpoint if request.url_rule else 'unmatched'
+            self.write(sampler.stop(), endpoint, sampler.started_at)
+
+        logger.info(f"✅ Profiling enabled (sample rate {self.sample_rate}, output {self.output_dir})")
+
+    def token_matches(self, value: Optional[str]) -> bool:
+        return bool(self.token and value and hmac.compare_digest(value, self.token))
+
+    def should_profile(self, header_value: Optional[str]) -> bool:
+        if self.token_matches(header_value):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def window_open(self) -> bool:
+        return self._window is not None
+
+    def open_window(self, seconds: float) -> bool:
+        """דגימת כל ה-threads של ה-worker למשך מספר שניות. False אם חלון כבר פתוח"""
+        seconds = min(max(seconds, 1), MAX_WINDOW_SECONDS)
+        with self._window_lock:
+            if self._window is not None:
+                return False
+            self._window = StackSampler(self.interval).start()
+        timer = threading.Timer(seconds, self._close_window)
+        timer.daemon = True
+        timer.start()
+        return True
+
+    def _close_window(self):
+        with self._window_lock:
+            sampler, self._window = self._window, None
+        if sampler is not None:
+            self.write(sampler.stop(), 'window', sampler.started_at)
+
+    def write(self, samples: Counter, label: str, started_at: float) -> Optional[str]:
+        """כתיבת המחסניות בפורמט folded. מחזיר את נתיב הקובץ"""
+        if not samples:
+            return None
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            stamp = datetime.fromtimestamp(started_at).strftime('%Y%m%d-%H%M%S-%f')
+            path = os.path.join(self.output_dir, f"{stamp}-{label}-{os.getpid()}.folded")
+            with open(path, 'w', encoding='utf-8') as f:
+                for stack, count in samples.most_common():
+                    f.write(f"{stack} {count}\n")
+            logger.info(f"Profile written: {path} ({sum(samples.values())} samples)")
+            return path
+        except OSError as e:
+            logger.error(f"Could not write profile: {e}")
+            return None
+
+    def get_stats(self) -> Dict[str, object]:
+        return {
+            'enabled': self.enabled,
+            'sample_rate': self.sample_rate,
+            'window_open': self.window_open(),
+            'output_dir': self.output_dir
+        }
+
+# מופע גלובלי לכל worker
+request_profiler = RequestProfiler()
+
+__all__ = [
+    'PROFILING_ENABLED',
+    'StackSampler',
+    'RequestProfiler',
+    'request_profiler'
+]
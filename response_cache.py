@@ -0,0 +1,350 @@
+# response_cache.py - מטמון תגובות Gemini להודעות חוזרות
+"""
+Response cache in front of the Gemini call.
+
+Many opening messages are near-identical ("הוא לא מדבר איתי") for the same
+main challenge and age band. A cached answer is served in one chunk instead of
+paying for a new generation.
+
+Key: the normalised message (niqqud, punctuation and final letter forms
+folded) within a profile bucket built from exactly the questionnaire fields
+the prompt sends besides the names: main_challenge, child age band,
+distress_level, and a hash of the free-text past_solutions and goal. An
+answer shaped by one parent's free text is only ever served for the same text.
+
+Lookup order:
+1. exact match on the normalised text
+2. near-duplicate: a 64-bit SimHash over character trigrams of the Hebrew
+   words. Candidates are found through 8 bands of 8 bits (any fingerprint
+   within 7 bits shares at least one band) and accepted within
+   RESPONSE_CACHE_NEAR_DISTANCE differing bits.
+
+Names and the exact age are stored as placeholders and filled back in for the
+reader, so one parent's details never reach another. A name is only replaced
+as a whole word (with up to three Hebrew prefix letters, as in "לדנה"); a
+response where the name also appears inside another word is not cached. The
+age is only replaced inside an age phrase ("בן 15", "בגיל 15"); a response
+that uses the same number for anything else ("15 דקות") is not cached. Only turns without
+conversation history are cached; follow-ups depend on earlier turns. Entries
+expire after RESPONSE_CACHE_TTL seconds and are evicted LRU by count and by
+approximate size. A request opts out with `"cache": false` in the JSON body or
+a `Cache-Control: no-cache` header.
+"""
+
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SIMHASH_BITS = 64
+BAND_BITS = 8
+BANDS = SIMHASH_BITS // BAND_BITS
+
+_NIQQUD = re.compile(r"[\u0591-\u05C7]")
+_NON_WORD = re.compile(r"[^\w\s]")
+_WHITESPACE = re.compile(r"\s+")
+_FINAL_LETTERS = str.maketrans("ךםןףץ", "כמנפצ")
+
+PLACEHOLDERS = {
+    'parent_name': '\u2063PARENT\u2063',
+    'child_name': '\u2063CHILD\u2063',
+    'child_age': '\u2063AGE\u2063'
+}
+
+def normalize_message(text: str) -> str:
+    """נרמול הודעה להשוואה: בלי ניקוד, פיסוק ואותיות סופיות"""
+    text = _NIQQUD.sub('', text.lower())
+    text = _NON_WORD.sub(' ', text).translate(_FINAL_LETTERS)
+    return _WHITESPACE.sub(' ', text).strip()
+
+def normalize_many(texts: List[str]) -> List[str]:
+    """נרמול הרבה הודעות במעבר regex אחד (כל הודעה לשורה). התוצאה מתאימה ל-split() של normalize_message"""
+    joined = "\n".join(text.replace("\n", " ") for text in texts).lower()
+    joined = _NON_WORD.sub(' ', _NIQQUD.sub('', joined)).translate(_FINAL_LETTERS)
+    return joined.split("\n")
+
+def _trigrams(normalized: str):
+    # Character trigrams inside padded words - robust to Hebrew prefixes and inflections
+    for word in normalized.split():
+        padded = f" {word} "
+        for i in range(len(padded) - 2):
+            yield padded[i:i + 3]
+
+def simhash(normalized: str) -> int:
+    """SimHash של 64 ביט מעל טריגרמות של אותיות"""
+    features = list(_trigrams(normalized))
+    if not features:
+        return 0
+    weights = [0] * SIMHASH_BITS
+    for feature in features:
+        value = int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'big')
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)
+
+def age_band(age: Any) -> str:
+    """קבוצת גיל, כמו Child.get_age_group"""
+    try:
+        age = int(age)
+    except (TypeError, ValueError):
+        return "unknown"
+    if age <= 14:
+        return "early_teen"
+    elif age <= 16:
+        return "mid_teen"
+    elif age <= 18:
+        return "late_teen"
+    return "young_adult"
+
+# Free-text questionnaire fields that go into the prompt - keyed by hash
+FREE_TEXT_FIELDS = ('past_solutions', 'goal')
+
+def _text_hash(value: Any) -> str:
+    text = str(value or '').strip()
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16] if text else ''
+
+def profile_key(questionnaire_data: Dict[str, Any]) -> str:
+    """שדות השאלון שנכנסים לפרומפט (חוץ מהשמות, שנשמרים כמצייני מקום)"""
+    data = questionnaire_data or {}
+    return "|".join([
+        str(data.get('main_challenge') or ''),
+        age_band(data.get('child_age')),
+        str(data.get('distress_level') or ''),
+        *(_text_hash(data.get(field_name)) for field_name in FREE_TEXT_FIELDS)
+    ])
+
+def _personal_values(questionnaire_data: Dict[str, Any]) -> Dict[str, str]:
+    data = questionnaire_data or {}
+    values = {}
+    for field_name in PLACEHOLDERS:
+        value = str(data.get(field_name, '') or '').strip()
+        if len(value) >= 2:
+            values[field_name] = value
+    return values
+
+# Hebrew one-letter prefixes (ו, ה, ש, ב, ל, מ, כ) that may precede a name
+NAME_PREFIXES = "והשבלמכ"
+
+def _name_pattern(name: str) -> str:
+    # The name as a whole word, optionally after prefix letters (kept in group 1)
+    return rf"(?<!\w)([{NAME_PREFIXES}]{{0,3}}){re.escape(name)}(?!\w)"
+
+def _age_pattern(age: str) -> str:
+    # The age right after "בן"/"בת"/"גיל" (with prefix letters, as in "בגיל") - the phrase is kept in group 1
+    return rf"(?<!\w)((?:[{NAME_PREFIXES}]{{0,3}}גיל|בן|בת)\s+){re.escape(age)}(?!\d)"
+
+def depersonalize(response: str, questionnaire_data: Dict[str, Any]) -> Optional[str]:
+    """החלפת שמות וגיל במצייני מקום לפני שמירה. None אם שם או גיל מופיעים גם בהקשר אחר"""
+    for field_name, value in _personal_values(questionnaire_data).items():
+        placeholder = PLACEHOLDERS[field_name]
+        if value.isdigit():
+            response = re.sub(_age_pattern(value), lambda match: match.group(1) + placeholder, response)
+            if re.search(rf"(?<!\d){re.escape(value)}(?!\d)", response):
+                # The same number as a quantity ("15 דקות") - not safe to swap for another age
+                return None
+            continue
+        response = re.sub(_name_pattern(value), lambda match: match.group(1) + placeholder, response)
+        if value in response:
+            # Part of an ordinary word - can't be told apart from the name, so don't share it
+            return None
+    return response
+
+def personalize(response: str, questionnaire_data: Dict[str, Any]) -> str:
+    """מילוי מצייני המקום בפרטי הקורא"""
+    data = questionnaire_data or {}
+    defaults = {'parent_name': 'הורה יקר', 'child_name': 'המתבגר שלך', 'child_age': ''}
+    for field_name, placeholder in PLACEHOLDERS.items():
+        if placeholder in response:
+            response = response.replace(placeholder, str(data.get(field_name) or defaults[field_name]))
+    return response
+
+@dataclass
+class CacheEntry:
+    """תגובה שמורה"""
+    response: str
+    fingerprint: int
+    expires_at: float
+    size: int
+
+class ResponseCache:
+    """מטמון LRU עם TTL, התאמה מדויקת והתאמת כמעט-כפילות"""
+
+    def __init__(self, enabled: bool = False, ttl_seconds: float = 86400, max_entries: int = 5000,
+                 max_bytes: int = 32 * 1024 * 1024, near_distance: int = 6):
+        self._entries: "OrderedDict[Tuple[str, str], CacheEntry]" = OrderedDict()
+        self._bands: Dict[Tuple[str, int, int], Set[Tuple[str, str]]] = {}
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.configure(enabled, ttl_seconds, max_entries, max_bytes, near_distance)
+
+    def configure(self, enabled: bool, ttl_seconds: float, max_entries: int, max_bytes: int, near_distance: int):
+        """עדכון הגדרות (נקרא בזמן אתחול האפליקציה)"""
+        with self._lock:
+            self.enabled = enabled
+            self.ttl_seconds = ttl_seconds
+            self.max_entries = max_entries
+            self.max_bytes = max_bytes
+            self.near_distance = near_distance
+            self._entries.clear()
+            self._bands.clear()
+            self._bytes = 0
+
+    def _band_keys(self, profile: str, fingerprint: int):
+        mask = (1 << BAND_BITS) - 1
+        return [(profile, band, fingerprint >> (band * BAND_BITS) & mask) for band in range(BANDS)]
+
+    def _remove(self, key: Tuple[str, str]):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._bytes -= entry.size
+        for band_key in self._band_keys(key[0], entry.fingerprint):
+            members = self._bands.get(band_key)
+            if members is not None:
+                members.discard(key)
+                if not members:
+                    del self._bands[band_key]
+
+    def _live_entry(self, key: Tuple[str, str], now: float) -> Optional[CacheEntry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at < now:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def get(self, message: str, questionnaire_data: Dict[str, Any]) -> Optional[str]:
+        """תגובה שמורה להודעה זהה או כמעט זהה באותו פרופיל, או None"""
+        if not self.enabled:
+            return None
+        profile = profile_key(questionnaire_data)
+        normalized = normalize_message(message)
+        if not normalized:
+            return None
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._live_entry((profile, normalized), now)
+            result = 'exact' if entry is not None else 'miss'
+
+            if entry is None and self.near_distance > 0:
+                fingerprint = simhash(normalized)
+                candidates = set()
+                for band_key in self._band_keys(profile, fingerprint):
+                    candidates |= self._bands.get(band_key, set())
+                best = None
+                for key in candidates:
+                    distance = bin(self._entries[key].fingerprint ^ fingerprint).count('1')
+                    if distance <= self.near_distance and (best is None or distance < best[0]):
+                        best = (distance, key)
+                if best is not None:
+                    entry = self._live_entry(best[1], now)
+                    if entry is not None:
+                        result = 'near'
+
+            if result == 'exact':
+                self.hits += 1
+            elif result == 'near':
+                self.near_hits += 1
+            else:
+                self.misses += 1
+
+        metrics.RESPONSE_CACHE_LOOKUPS.labels(result=result).inc()
+        if entry is None:
+            return None
+        return personalize(entry.response, questionnaire_data)
+
+    def set(self, message: str, questionnaire_data: Dict[str, Any], response: str):
+        """שמירת תגובה מלאה של Gemini"""
+        if not self.enabled or not response:
+            return
+        profile = profile_key(questionnaire_data)
+        normalized = normalize_message(message)
+        if not normalized:
+            return
+        stored = depersonalize(response, questionnaire_data)
+        if stored is None:
+            return
+        fingerprint = simhash(normalized)
+        key = (profile, normalized)
+        entry = CacheEntry(
+            response=stored,
+            fingerprint=fingerprint,
+            expires_at=time.monotonic() + self.ttl_seconds,
+            size=len(stored.encode('utf-8')) + len(normalized.encode('utf-8'))
+        )
+
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = entry
+            self._bytes += entry.size
+            for band_key in self._band_keys(profile, fingerprint):
+                self._bands.setdefault(band_key, set()).add(key)
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        """ניקוי כל המטמון"""
+        with self._lock:
+            self._entries.clear()
+            self._bands.clear()
+            self._bytes = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        """סטטיסטיקות מטמון"""
+        with self._lock:
+            lookups = self.hits + self.near_hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'near_hits': self.near_hits,
+                'misses': self.misses,
+                'hit_rate': round((self.hits + self.near_hits) / lookups, 4) if lookups else 0.0
+            }
+
+# מופע גלובלי לכל worker
+response_cache = ResponseCache()
+
+def init_response_cache(app):
+    """הגדרת המטמון לפי הגדרות האפליקציה"""
+    response_cache.configure(
+        enabled=app.config.get('RESPONSE_CACHE_ENABLED', False),
+        ttl_seconds=app.config.get('RESPONSE_CACHE_TTL', 86400),
+        max_entries=app.config.get('RESPONSE_CACHE_MAX_ENTRIES', 5000),
+        max_bytes=app.config.get('RESPONSE_CACHE_MAX_BYTES', 32 * 1024 * 1024),
+        near_distance=app.config.get('RESPONSE_CACHE_NEAR_DISTANCE', 6)
+    )
+
+def cache_allowed(data: Any, cache_control: Optional[str]) -> bool:
+    """האם הבקשה מרשה שימוש במטמון (opt-out עם "cache": false או Cache-Control: no-cache)"""
+    if isinstance(data, dict) and data.get('cache') is False:
+        return False
+    if cache_control and any(d.strip() in ('no-cache', 'no-store') for d in cache_control.lower().split(',')):
+        return False
+    return True
+
+__all__ = [
+    'normalize_message',
+    'normalize_many',
+    'simhash',
+    'profile_key',
+    'ResponseCache',
+    'response_cache',
+    'init_response_cache',
+    'cache_allowed'
+]
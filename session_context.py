@@ -0,0 +1,216 @@
+# session_context.py - טעינת הקשר סשן לצ'אט בשאילתה אחת עם מטמון קצר
+"""
+Session context loader for /api/chat.
+
+Everything a chat turn needs before calling the AI (the latest questionnaire,
+the active conversation and a child to attach a new conversation to) is
+fetched in a single joined query and kept in a small per-worker cache, so
+repeat turns in the same session skip the lookups entirely.
+
+The cache is invalidated explicitly through `invalidate_session_context()`
+and automatically by ORM events whenever a questionnaire is saved or a
+conversation changes status in this process. Writes made by other workers
+become visible once the (short) TTL expires.
+"""
+
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional
+
+from sqlalchemy import and_, event, inspect, select
+
+from models import db, Parent, Child, Conversation, QuestionnaireResponse
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class SessionContext:
+    """כל מה שתור צ'אט צריך לפני הקריאה ל-AI"""
+    session_id: str
+    questionnaire_data: Dict[str, Any] = field(default_factory=dict)
+    conversation_id: Optional[int] = None
+    child_id: Optional[int] = None
+
+class SessionContextCache:
+    """מטמון TTL + LRU תהליכי לאובייקטי SessionContext"""
+
+    def __init__(self, ttl_seconds: float = 60, max_entries: int = 10000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, ttl_seconds: float, max_entries: int):
+        """עדכון הגדרות המטמון (נקרא בזמן אתחול האפליקציה)"""
+        with self._lock:
+            self.ttl_seconds = ttl_seconds
+            self.max_entries = max_entries
+            self._entries.clear()
+
+    def get(self, session_id: str) -> Optional[SessionContext]:
+        """קבלת הקשר מהמטמון אם עדיין בתוקף"""
+        if self.ttl_seconds <= 0:
+            return None
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, context = entry
+            if expires_at < time.monotonic():
+                del self._entries[session_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(session_id)
+            self.hits += 1
+            return context
+
+    def set(self, context: SessionContext):
+        """שמירת הקשר במטמון"""
+        if self.ttl_seconds <= 0:
+            return
+        with self._lock:
+            self._entries[context.session_id] = (time.monotonic() + self.ttl_seconds, context)
+            self._entries.move_to_end(context.session_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, session_id: str):
+        """הסרת סשן מהמטמון"""
+        with self._lock:
+            self._entries.pop(session_id, None)
+
+    def clear(self):
+        """ניקוי כל המטמון"""
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """סטטיסטיקות מטמון"""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+# מופע גלובלי לכל worker
+session_context_cache = SessionContextCache()
+
+def init_session_context_cache(app):
+    """הגדרת המטמון לפי הגדרות האפליקציה"""
+    session_context_cache.configure(
+        ttl_seconds=app.config.get('SESSION_CONTEXT_CACHE_TTL', 60),
+        max_entries=app.config.get('SESSION_CONTEXT_CACHE_SIZE', 10000)
+    )
+
+def fetch_session_context(session_id: str) -> Optional[SessionContext]:
+    """טעינת הקשר הסשן מבסיס הנתונים בשאילתה אחת.
+
+    Parent LEFT JOIN the active conversation, with correlated scalar
+    subqueries for the latest questionnaire and the first child. Returns
+    None if the parent does not exist.
+    """
+    latest_questionnaire = (
+        select(QuestionnaireResponse.response_data)
+        .where(QuestionnaireResponse.parent_id == Parent.id)
+        .order_by(QuestionnaireResponse.created_at.desc())
+        .limit(1)
+        .correlate(Parent)
+        .scalar_subquery()
+    )
+    first_child = (
+        select(Child.id)
+        .where(Child.parent_id == Parent.id)
+        .order_by(Child.id)
+        .limit(1)
+        .correlate(Parent)
+        .scalar_subquery()
+    )
+    stmt = (
+        select(
+            latest_questionnaire.label('response_data'),
+            first_child.label('child_id'),
+            Conversation.id.label('conversation_id')
+        )
+        .select_from(Parent)
+        .outerjoin(Conversation, and_(
+            Conversation.parent_id == Parent.id,
+            Conversation.status == 'active'
+        ))
+        .where(Parent.id == session_id)
+        .order_by(Conversation.id)
+        .limit(1)
+    )
+
+    row = db.session.execute(stmt).first()
+    if row is None:
+        return None
+
+    questionnaire_data = {}
+    if row.response_data:
+        try:
+            questionnaire_data = json.loads(row.response_data)
+        except (TypeError, ValueError):
+            logger.warning(f"Malformed questionnaire data for session {session_id[:8]}...")
+
+    return SessionContext(
+        session_id=session_id,
+        questionnaire_data=questionnaire_data,
+        conversation_id=row.conversation_id,
+        child_id=row.child_id
+    )
+
+def get_session_context(session_id: str) -> Optional[SessionContext]:
+    """הקשר הסשן מהמטמון, או מבסיס הנתונים אם אינו במטמון"""
+    context = session_context_cache.get(session_id)
+    if context is not None:
+        return context
+
+    context = fetch_session_context(session_id)
+    if context is not None:
+        session_context_cache.set(context)
+    return context
+
+def invalidate_session_context(session_id: str):
+    """ביטול מפורש של הקשר סשן (אחרי שינוי שאלון, סגירת שיחה וכו')"""
+    session_context_cache.invalidate(session_id)
+
+
+# --- Automatic invalidation for writes made in this worker ---
+
+@event.listens_for(QuestionnaireResponse, 'after_insert')
+@event.listens_for(QuestionnaireResponse, 'after_update')
+@event.listens_for(QuestionnaireResponse, 'after_delete')
+def _invalidate_on_questionnaire_change(mapper, connection, target):
+    invalidate_session_context(target.parent_id)
+
+@event.listens_for(Conversation, 'after_update')
+def _invalidate_on_conversation_status_change(mapper, connection, target):
+    # message_count and other analytics updates don't affect the context
+    if inspect(target).attrs.status.history.has_changes():
+        invalidate_session_context(target.parent_id)
+
+@event.listens_for(Conversation, 'after_delete')
+def _invalidate_on_conversation_delete(mapper, connection, target):
+    invalidate_session_context(target.parent_id)
+
+@event.listens_for(Parent, 'after_delete')
+def _invalidate_on_parent_delete(mapper, connection, target):
+    invalidate_session_context(target.id)
+
+__all__ = [
+    'SessionContext',
+    'SessionContextCache',
+    'session_context_cache',
+    'init_session_context_cache',
+    'fetch_session_context',
+    'get_session_context',
+    'invalidate_session_context'
+]
@@ -0,0 +1,274 @@
+# session_store.py - אחסון מצב שיחה למערכת ה-fallback
+"""
+Pluggable session-state stores for the advanced fallback system.
+
+Session state is handled as a JSON-serialisable dict, so the same data can
+live in process memory or in a store shared by every gunicorn worker:
+
+- MemorySessionStore: bounded in-process store (TTL, LRU eviction, entry
+  count and approximate memory cap). Each worker sees only its own turns.
+- SQLiteSessionStore: shared by all workers on one host through a local
+  SQLite file (WAL mode), with TTL and a cap on stored sessions.
+- RedisSessionStore: shared by the whole fleet; Redis handles TTL and
+  eviction (configure maxmemory-policy on the server).
+"""
+
+import copy
+import json
+import logging
+import sqlite3
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+class SessionStore(ABC):
+    """ממשק בסיס לאחסון מצב שיחה"""
+
+    def __init__(self, ttl_seconds: int = 3600):
+        self.ttl_seconds = ttl_seconds
+
+    @abstractmethod
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """קבלת מצב סשן, או None אם אינו קיים / פג תוקף"""
+
+    @abstractmethod
+    def set(self, session_id: str, state: Dict[str, Any]):
+        """שמירת מצב סשן (מאפס את ה-TTL)"""
+
+    @abstractmethod
+    def delete(self, session_id: str):
+        """מחיקת מצב סשן"""
+
+    def __contains__(self, session_id: str) -> bool:
+        return self.get(session_id) is not None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """סטטיסטיקות אחסון"""
+        return {'backend': self.__class__.__name__, 'ttl_seconds': self.ttl_seconds}
+
+class MemorySessionStore(SessionStore):
+    """אחסון תהליכי מוגבל: TTL, פינוי LRU, מספר סשנים מרבי ותקרת זיכרון משוערת"""
+
+    def __init__(self, ttl_seconds: int = 3600, max_sessions: int = 10000, max_bytes: int = 64 * 1024 * 1024):
+        super().__init__(ttl_seconds)
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # session_id -> (expires_at, size, state)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    @staticmethod
+    def _estimate_size(state: Dict[str, Any]) -> int:
+        """הערכת גודל הסשן בזיכרון (מחרוזות + תקורה קבועה)"""
+        size = sys.getsizeof(state)
+        for value in state.values():
+            if isinstance(value, list):
+                size += sys.getsizeof(value) + sum(sys.getsizeof(item) for item in value)
+            else:
+                size += sys.getsizeof(value)
+        return size
+
+    def _remove(self, session_id: str):
+        _, size, _ = self._entries.pop(session_id)
+        self._total_bytes -= size
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return None
+            expires_at, _, state = entry
+            if expires_at < time.monotonic():
+                self._remove(session_id)
+                return None
+            self._entries.move_to_end(session_id)
+            # עותק - כמו בשאר האחסונים, שינוי אצל הקורא לא נכנס לאחסון בלי set
+            return copy.deepcopy(state)
+
+    def set(self, session_id: str, state: Dict[str, Any]):
+        state = copy.deepcopy(state)
+        size = self._estimate_size(state)
+        with self._lock:
+            if session_id in self._entries:
+                self._remove(session_id)
+            self._entries[session_id] = (time.monotonic() + self.ttl_seconds, size, state)
+            self._total_bytes += size
+
+            # פינוי LRU עד שחוזרים למגבלות
+            while self._entries and (len(self._entries) > self.max_sessions or self._total_bytes > self.max_bytes):
+                oldest_id = next(iter(self._entries))
+                self._remove(oldest_id)
+                self.evictions += 1
+
+    def delete(self, session_id: str):
+        with self._lock:
+            if session_id in self._entries:
+                self._remove(session_id)
+
+    def purge_expired(self) -> int:
+        """מחיקת כל הסשנים שפג תוקפם"""
+        now = time.monotonic()
+        with self._lock:
+            expired = [session_id for session_id, (expires_at, _, _) in self._entries.items() if expires_at < now]
+            for session_id in expired:
+                self._remove(session_id)
+        return len(expired)
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = super().get_stats()
+        with self._lock:
+            stats.update({
+                'sessions': len(self._entries),
+                'approx_bytes': self._total_bytes,
+                'max_sessions': self.max_sessions,
+                'max_bytes': self.max_bytes,
+                'evictions': self.evictions
+            })
+        return stats
+
+class SQLiteSessionStore(SessionStore):
+    """אחסון משותף לכל ה-workers על אותו שרת באמצעות קובץ SQLite"""
+
+    # ניקוי סשנים ישנים פעם בכמה כתיבות
+    PURGE_EVERY_WRITES = 500
+
+    def __init__(self, path: str, ttl_seconds: int = 3600, max_sessions: int = 100000):
+        super().__init__(ttl_seconds)
+        self.path = path
+        self.max_sessions = max_sessions
+        self._local = threading.local()
+        self._writes = 0
+
+        connection = self._connection()
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS fallback_session_state ("
+            "session_id TEXT PRIMARY KEY, "
+            "state TEXT NOT NULL, "
+            "expires_at REAL NOT NULL)"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS ix_fallback_session_state_expires "
+            "ON fallback_session_state (expires_at)"
+        )
+        connection.commit()
+
+    def _connection(self) -> sqlite3.Connection:
+        """חיבור נפרד לכל thread"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        row = self._connection().execute(
+            "SELECT state FROM fallback_session_state WHERE session_id = ? AND expires_at >= ?",
+            (session_id, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, session_id: str, state: Dict[str, Any]):
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO fallback_session_state (session_id, state, expires_at) VALUES (?, ?, ?)",
+            (session_id, json.dumps(state, ensure_ascii=False), time.time() + self.ttl_seconds)
+        )
+        connection.commit()
+
+        self._writes += 1
+        if self._writes % self.PURGE_EVERY_WRITES == 0:
+            self.purge_expired()
+
+    def delete(self, session_id: str):
+        connection = self._connection()
+        connection.execute("DELETE FROM fallback_session_state WHERE session_id = ?", (session_id,))
+        connection.commit()
+
+    def purge_expired(self) -> int:
+        """מחיקת סשנים שפג תוקפם וסשנים ישנים מעבר למגבלה"""
+        connection = self._connection()
+        deleted = connection.execute(
+            "DELETE FROM fallback_session_state WHERE expires_at < ?", (time.time(),)
+        ).rowcount
+        deleted += connection.execute(
+            "DELETE FROM fallback_session_state WHERE session_id IN ("
+            "SELECT session_id FROM fallback_session_state ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_sessions,)
+        ).rowcount
+        connection.commit()
+        return deleted
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = super().get_stats()
+        stats['sessions'] = self._connection().execute("SELECT COUNT(*) FROM fallback_session_state").fetchone()[0]
+        stats['path'] = self.path
+        return stats
+
+class RedisSessionStore(SessionStore):
+    """אחסון משותף לכל השרתים ב-Redis"""
+
+    def __init__(self, url: str, ttl_seconds: int = 3600, key_prefix: str = 'yonatan:fallback:',
+                 socket_timeout: float = 2.0):
+        super().__init__(ttl_seconds)
+        try:
+            import redis
+        except ImportError:
+            raise ImportError("redis package is required for RedisSessionStore")
+        # Redis תקוע לא יחזיק את ה-fallback - כל פקודה מוגבלת בזמן
+        self._redis = redis.Redis.from_url(
+            url,
+            socket_timeout=socket_timeout,
+            socket_connect_timeout=socket_timeout
+        )
+        # בדיקת חיבור כבר ביצירה, כדי ש-create_session_store יוכל לחזור לזיכרון
+        self._redis.ping()
+        self.key_prefix = key_prefix
+
+    def _key(self, session_id: str) -> str:
+        return f"{self.key_prefix}{session_id}"
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        raw = self._redis.get(self._key(session_id))
+        return json.loads(raw) if raw else None
+
+    def set(self, session_id: str, state: Dict[str, Any]):
+        self._redis.set(self._key(session_id), json.dumps(state, ensure_ascii=False), ex=self.ttl_seconds)
+
+    def delete(self, session_id: str):
+        self._redis.delete(self._key(session_id))
+
+def create_session_store(backend: str = 'memory',
+                         url: Optional[str] = None,
+                         ttl_seconds: int = 3600,
+                         max_sessions: int = 10000,
+                         max_bytes: int = 64 * 1024 * 1024) -> SessionStore:
+    """יצירת אחסון לפי סוג. חוזר לאחסון בזיכרון אם האחסון המשותף לא זמין"""
+    try:
+        if backend == 'redis':
+            if not url:
+                raise ValueError("Redis session store requires a URL")
+            return RedisSessionStore(url, ttl_seconds=ttl_seconds)
+        if backend == 'sqlite':
+            return SQLiteSessionStore(url or 'instance/fallback_state.db', ttl_seconds=ttl_seconds, max_sessions=max_sessions)
+        if backend != 'memory':
+            logger.warning(f"Unknown session store backend '{backend}', using memory")
+    except Exception as e:
+        logger.error(f"Could not create {backend} session store, using memory: {e}")
+
+    return MemorySessionStore(ttl_seconds=ttl_seconds, max_sessions=max_sessions, max_bytes=max_bytes)
+
+__all__ = [
+    'SessionStore',
+    'MemorySessionStore',
+    'SQLiteSessionStore',
+    'RedisSessionStore',
+    'create_session_store'
+]
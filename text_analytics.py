@@ -0,0 +1,237 @@
+# text_analytics.py - ניתוח טקסט להודעות: סנטימנט, רעילות ונושאים
+"""
+Lexicon-based text analytics for stored messages.
+
+Messages are tokenised on the normalised text (see response_cache.normalize_message:
+no niqqud or punctuation, final letters folded). Each token is reduced to a
+lexicon entry by stripping up to two Hebrew prefix letters (ו, ה, ב, ל, מ, ש, כ).
+A token right after a negator (לא, אין, בלי...) is marked as negated, and a
+negated token counts with the opposite polarity.
+
+- sentiment_score: (positive - negative) / (positive + negative + 1), in (-1, 1)
+- toxicity_score: 1 - 0.5 ** toxic_hits, in [0, 1)
+- topics: ChallengeCategory values whose keywords appear in the text
+
+score_batch() scores a whole chunk of messages at once. The chunk is
+normalised in one regex pass, and every token is resolved with a single dict
+lookup in a precomputed table of all prefixed forms. The lexicon hits form a
+sparse messages x (lemma, negated lemma) count matrix (scipy.sparse CSR), and
+one multiplication by a (2V x 3) weight matrix gives the positive, negative
+and toxic counts of every message. Without numpy/scipy it falls back to
+scoring message by message, with identical results.
+
+Cheap and deterministic - good enough for dashboards and flagging, not a model.
+"""
+
+from typing import Dict, FrozenSet, Iterable, List, Sequence, Set, Tuple
+
+from response_cache import normalize_many, normalize_message
+
+try:
+    import numpy as np
+    from scipy import sparse
+    VECTOR_SCORING_AVAILABLE = True
+except ImportError:
+    VECTOR_SCORING_AVAILABLE = False
+
+PREFIX_LETTERS = frozenset("והבלמשכ")
+MAX_PREFIX_STRIP = 2
+NEGATED = "!"
+
+NEGATORS = frozenset(normalize_message(word) for word in ("לא", "אין", "בלי", "אינו", "אינה", "אף", "מעולם"))
+
+_POSITIVE_WORDS = """
+טוב טובה טובים טובות מצוין מצוינת נהדר נהדרת מעולה נפלא נפלאה נחמד נחמדה
+שמח שמחה שמחים שמחתי תודה מודה עזר עזרה עוזר עוזרת הועיל
+הצלחה הצליח הצליחה הצלחנו הצלחתי שיפור השתפר השתפרה משתפר משתפרת
+אוהב אוהבת אהבה רגוע רגועה רגועים רוגע מקווה תקווה אופטימי אופטימית
+גאה גאים מרוצה מרוצים קרוב קרובה קרובים קרבה ביטחון בטוח בטוחה הקלה
+"""
+
+_NEGATIVE_WORDS = """
+רע רעה רעים גרוע גרועה נורא נוראי קשה קשים קשות בעיה בעיות
+עצוב עצובה עצובים עצב כועס כועסת כועסים כעס מתוסכל מתוסכלת תסכול
+לחץ לחוץ לחוצה לחוצים דואג דואגת דאגה פחד מפחד מפחדת פוחד פוחדת חרדה חרד
+ריב ריבים צועק צועקת צועקים צעקות בוכה בוכים בכי נואש נואשת ייאוש
+עייף עייפה מותש מותשת בודד בודדה בדידות אשמה אשם כישלון נכשל נכשלה
+שונא שונאת שנאה מאוכזב מאוכזבת אכזבה מפחיד
+"""
+
+_TOXIC_WORDS = """
+מטומטם מטומטמת מטומטמים טיפש טיפשה טיפשים אידיוט אידיוטית דביל דבילית
+מפגר מפגרת סתום סתומה שתוק שתקי חרא זבל זונה כוס מניאק לעזאזל אפס
+להרביץ מרביץ מרביצה ארביץ אהרוג תמות תמותי אשבור מכות
+"""
+
+TOPIC_KEYWORDS: Dict[str, str] = {
+    'communication': "מדבר מדברת מדברים שיחה שיחות מקשיב מקשיבה עונה מתעלם מתעלמת שותק שותקת",
+    'academics': "מורה מורים ציון ציונים מבחן מבחנים לימודים שיעורים כיתה בגרות",
+    'emotional_regulation': "כעס התפרצות התפרצויות עצבים מתפרץ מתפרצת",
+    'screen_time': "מסך מסכים טלפון פלאפון נייד מחשב טיקטוק אינסטגרם משחקים פלייסטיישן",
+    'social_issues': "חברים חברות חבר חברה בודד בודדה חרם מציקים",
+    'behavioral_issues': "משקר משקרת שקרים גונב גונבת מרביץ מרביצה עונש עונשים",
+    'sleep_routine': "שינה ישן ישנה לילה ערה ער מאחר מתעורר מתעוררת",
+    'family_dynamics': "אח אחות אחים גירושים אבא אמא משפחה",
+    'self_esteem': "ביטחון מכוער מכוערת שמן שמנה דימוי",
+    'anxiety_stress': "חרדה חרדות לחץ לחוץ לחוצה פחד פחדים דואג דואגת",
+    'peer_pressure': "עישון מעשן מעשנת אלכוהול שותה מסיבות סמים",
+    'independence': "עצמאות עצמאי עצמאית גבולות חופש"
+}
+
+def _lexicon(words: str) -> FrozenSet[str]:
+    return frozenset(normalize_message(word) for word in words.split())
+
+POSITIVE = _lexicon(_POSITIVE_WORDS)
+NEGATIVE = _lexicon(_NEGATIVE_WORDS)
+TOXIC = _lexicon(_TOXIC_WORDS)
+TOPICS: Dict[str, FrozenSet[str]] = {topic: _lexicon(words) for topic, words in TOPIC_KEYWORDS.items()}
+
+# Every word the analyser recognises
+KNOWN_LEMMAS = POSITIVE | NEGATIVE | TOXIC | frozenset().union(*TOPICS.values())
+
+def _prefixed_forms(lemmas: FrozenSet[str]) -> Dict[str, str]:
+    """כל צורה עם עד שתי אותיות תחילית -> מילת הבסיס שלה.
+
+    Mirrors stripping prefixes one at a time: a prefix is only stripped from a
+    word longer than 3 letters, and a known word is never stripped further
+    (so a form that is itself a lemma, or one prefix away from one, wins).
+    """
+    forms = {word: word for word in lemmas}
+    level = dict(forms)
+    for _ in range(MAX_PREFIX_STRIP):
+        next_level = {}
+        for form, base in level.items():
+            for prefix in PREFIX_LETTERS:
+                prefixed = prefix + form
+                if len(prefixed) > 3 and prefixed not in forms and prefixed not in next_level:
+                    next_level[prefixed] = base
+        forms.update(next_level)
+        level = next_level
+    return forms
+
+LEMMA_BY_FORM = _prefixed_forms(KNOWN_LEMMAS)
+
+def lemma(token: str) -> str:
+    """צורת הבסיס של מילה: הסרת עד שתי אותיות תחילית אם כך מתקבלת מילה מוכרת"""
+    return LEMMA_BY_FORM.get(token, token)
+
+def analysis_tokens(text: str) -> List[str]:
+    """מילות ההודעה בצורת בסיס; מילה שאחרי שלילה מסומנת ב-!"""
+    tokens = []
+    negate = False
+    for token in normalize_message(text or "").split():
+        if token in NEGATORS:
+            negate = True
+            continue
+        base = lemma(token)
+        tokens.append(NEGATED + base if negate else base)
+        negate = False
+    return tokens
+
+def score_tokens(tokens: Iterable[str]) -> Tuple[float, float]:
+    """(sentiment, toxicity) לרשימת מילים מנותחת"""
+    positive = negative = toxic = 0
+    for token in tokens:
+        negated = token.startswith(NEGATED)
+        base = token[1:] if negated else token
+        if base in POSITIVE:
+            if negated:
+                negative += 1
+            else:
+                positive += 1
+        elif base in NEGATIVE:
+            if negated:
+                positive += 1
+            else:
+                negative += 1
+        if base in TOXIC:
+            toxic += 1
+    sentiment = (positive - negative) / (positive + negative + 1)
+    toxicity = 1 - 0.5 ** toxic
+    return round(sentiment, 4), round(toxicity, 4)
+
+def score_text(text: str) -> Tuple[float, float]:
+    """(sentiment_score, toxicity_score) להודעה"""
+    return score_tokens(analysis_tokens(text))
+
+# --- Batch scoring ---
+
+# Columns of the scoring matrix: lemma i is column i, "not lemma i" is column V + i
+SCORED_LEMMAS = sorted(POSITIVE | NEGATIVE | TOXIC)
+_SCORED_INDEX = {word: i for i, word in enumerate(SCORED_LEMMAS)}
+SCORED_FORM_IDS: Dict[str, int] = {
+    form: _SCORED_INDEX[base] for form, base in LEMMA_BY_FORM.items() if base in _SCORED_INDEX
+}
+
+_TOKEN_LOOKUP: Dict[str, int] = {**SCORED_FORM_IDS, **{negator: -1 for negator in NEGATORS}}
+
+def _weight_matrix():
+    """(2V x 3): ספירת חיובי, שלילי ורעיל לכל עמודה"""
+    size = len(SCORED_LEMMAS)
+    weights = np.zeros((2 * size, 3))
+    for i, word in enumerate(SCORED_LEMMAS):
+        if word in POSITIVE:
+            weights[i, 0] = weights[size + i, 1] = 1
+        elif word in NEGATIVE:
+            weights[i, 1] = weights[size + i, 0] = 1
+        if word in TOXIC:
+            weights[i, 2] = weights[size + i, 2] = 1
+    return weights
+
+_WEIGHTS = _weight_matrix() if VECTOR_SCORING_AVAILABLE else None
+
+def token_matrix(texts: Sequence[str]):
+    """מטריצה דלילה (הודעות x מילות לקסיקון, רגילות ושלולות) של ספירות מופעים"""
+    size = len(SCORED_LEMMAS)
+    lookup = _TOKEN_LOOKUP
+    indices: List[int] = []
+    indptr = [0]
+    for line in normalize_many(list(texts)):
+        negate = False
+        for token in line.split():
+            # One dict lookup per token: a column, a negator (-1) or nothing
+            column = lookup.get(token)
+            if column is None:
+                negate = False
+            elif column < 0:
+                negate = True
+            else:
+                indices.append(column + size if negate else column)
+                negate = False
+        indptr.append(len(indices))
+    data = np.ones(len(indices), dtype=np.float64)
+    return sparse.csr_matrix((data, np.asarray(indices, dtype=np.int32), np.asarray(indptr, dtype=np.int64)),
+                             shape=(len(texts), 2 * size))
+
+def score_batch(texts: Sequence[str]) -> List[Tuple[float, float]]:
+    """(sentiment_score, toxicity_score) לכל הודעה ב-chunk, בחישוב מטריציוני אחד"""
+    if not texts:
+        return []
+    if not VECTOR_SCORING_AVAILABLE:
+        return [score_text(text) for text in texts]
+    counts = token_matrix(texts) @ _WEIGHTS
+    positive, negative, toxic = counts[:, 0], counts[:, 1], counts[:, 2]
+    sentiment = np.round((positive - negative) / (positive + negative + 1), 4)
+    toxicity = np.round(1 - np.power(0.5, toxic), 4)
+    return list(zip(sentiment.tolist(), toxicity.tolist()))
+
+def detect_topics(texts: Iterable[str]) -> List[str]:
+    """נושאי השיחה (ערכי ChallengeCategory) שמילות המפתח שלהם מופיעות בטקסטים"""
+    seen: Set[str] = set()
+    for text in texts:
+        seen.update(token.lstrip(NEGATED) for token in analysis_tokens(text))
+    return [topic for topic, words in TOPICS.items() if words & seen]
+
+__all__ = [
+    'POSITIVE',
+    'NEGATIVE',
+    'TOXIC',
+    'TOPICS',
+    'analysis_tokens',
+    'score_tokens',
+    'score_text',
+    'detect_topics',
+    'VECTOR_SCORING_AVAILABLE',
+    'token_matrix',
+    'score_batch'
+]